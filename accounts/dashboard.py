@@ -0,0 +1,209 @@
+"""
+Dashboard data loader
+
+DashboardSnapshot gathers everything dashboard_view shows about a user with
+a fixed number of queries (QUERY_BUDGET), whatever the number of purchases,
+forms or records: purchases are loaded once and classified in memory, and
+totals are computed by the database.
+
+Built snapshots are cached per user (in the 'user_data' cache) under a
+version number. The version is bumped by signals (accounts/signals.py)
+whenever a purchase, payment, subscription, form or record of the user
+changes, so the next visit misses the cache and rebuilds; predefined forms,
+shared by all users, bump a shared version instead.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+from django.db.models import IntegerField, Q, Sum, Value
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+
+from gpscontrol4u.models import Form, DataRecord
+from payments.models import Subscription, PlanPurchase
+
+# Snapshots are per user: they live in their own cache, culled apart from the
+# default one that holds the API token and plan catalogue (see CACHES)
+cache = ConnectionProxy(caches, 'user_data')
+
+
+def _metadata_quantity(key):
+    """Integer value of a plan quantity stored in PlanPurchase.external_metadata"""
+    return Coalesce(Cast(KT(f'external_metadata__{key}'), IntegerField()), Value(0))
+
+
+def _new_version():
+    # Time based so a version evicted from the cache never comes back with
+    # a number that still has snapshots stored under it
+    return int(time.time() * 1000)
+
+
+def _current_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key) or _new_version()
+    return version
+
+
+def _bump_version(key):
+    # A plain set rather than incr: incr is a read-then-write on the file
+    # cache, so two concurrent bumps could store the same number. Any new
+    # time based version leaves the snapshots of the old one unreachable.
+    cache.set(key, _new_version(), None)
+
+
+class DashboardSnapshot:
+    """Everything the dashboard needs about one user, loaded in one pass"""
+
+    QUERY_BUDGET = 5
+    RECENT_RECORDS = 10
+
+    CACHE_KEY = 'dashboard_snapshot:{user_id}:{version}'
+    VERSION_KEY = 'dashboard_snapshot_version:{user_id}'
+    SHARED_VERSION_KEY = 'dashboard_snapshot_version:shared'
+
+    def __init__(self, user):
+        self.user = user
+        self.version = None
+        self.subscription = None
+        self.purchases = []
+        self.active_purchases = []
+        self.user_forms = []
+        self.predefined_forms = []
+        self.recent_records = []
+        self.total_spent = 0
+        self.total_admin_users = 0
+        self.total_subscribed_users = 0
+        self.purchased_plan_ids = set()
+        self.purchase_details = {}
+
+    def __getstate__(self):
+        # The user is attached again on every read; it is not part of the cache
+        state = self.__dict__.copy()
+        state['user'] = None
+        return state
+
+    @classmethod
+    def load(cls, user):
+        """Build a fresh snapshot from the database"""
+        snapshot = cls(user)
+        snapshot._load()
+        return snapshot
+
+    @classmethod
+    def get(cls, user):
+        """Return the cached snapshot for the user's current version, building it on a miss"""
+        version = cls.current_version(user.pk)
+        key = cls.CACHE_KEY.format(user_id=user.pk, version=version)
+        snapshot = cache.get(key)
+        if snapshot is None:
+            snapshot = cls.load(user)
+            snapshot.version = version
+            cache.set(key, snapshot, getattr(settings, 'DASHBOARD_SNAPSHOT_TTL', 5 * 60))
+        snapshot.user = user
+        return snapshot
+
+    @classmethod
+    def current_version(cls, user_id):
+        """Version string of the user's snapshot (changes on every invalidation)"""
+        user_version = _current_version(cls.VERSION_KEY.format(user_id=user_id))
+        shared_version = _current_version(cls.SHARED_VERSION_KEY)
+        return f'{user_version}.{shared_version}'
+
+    @classmethod
+    def invalidate(cls, user_id):
+        _bump_version(cls.VERSION_KEY.format(user_id=user_id))
+
+    @classmethod
+    def invalidate_all(cls):
+        _bump_version(cls.SHARED_VERSION_KEY)
+
+    def _load(self):
+        user = self.user
+        now = timezone.now()
+
+        # 1. Subscription (kept for backward compatibility)
+        self.subscription = Subscription.objects.filter(user=user).first()
+
+        # 2. Every purchase, newest first; active ones are picked in memory
+        self.purchases = list(PlanPurchase.get_user_purchase_history(user))
+        self.active_purchases = [purchase for purchase in self.purchases if purchase.is_active()]
+
+        # 3. Totals computed by the database
+        active = Q(status='active') & PlanPurchase.unexpired_q(now)
+        totals = PlanPurchase.objects.filter(user=user).aggregate(
+            total_spent=Coalesce(Sum('amount'), Value(0), output_field=PlanPurchase._meta.get_field('amount')),
+            total_admin_users=Coalesce(Sum(_metadata_quantity('admin_users_quantity'), filter=active), Value(0)),
+            total_subscribed_users=Coalesce(Sum(_metadata_quantity('subscribed_users_quantity'), filter=active), Value(0)),
+        )
+        self.total_spent = totals['total_spent']
+        self.total_admin_users = totals['total_admin_users']
+        self.total_subscribed_users = totals['total_subscribed_users']
+
+        # 4. The user's forms and the predefined ones in a single query
+        forms = list(Form.objects.filter(Q(user=user) | Q(is_predefined=True), is_active=True))
+        self.predefined_forms = [form for form in forms if form.is_predefined]
+
+        # 5. Own forms and records are only shown with an active plan
+        if self.active_purchases:
+            self.user_forms = [form for form in forms if form.user_id == user.pk]
+            self.recent_records = list(
+                DataRecord.objects.filter(user=user).select_related('form')[:self.RECENT_RECORDS]
+            )
+
+        # Derived values, computed once and cached with the snapshot
+        self.purchased_plan_ids = self._purchased_plan_ids()
+        self.purchase_details = self._purchase_details()
+
+    @property
+    def has_active_purchases(self):
+        return bool(self.active_purchases)
+
+    @property
+    def has_free_plan(self):
+        return any(purchase.plan_category == 'free' for purchase in self.purchases)
+
+    @property
+    def active_plan_ids(self):
+        return [purchase.external_plan_id for purchase in self.active_purchases]
+
+    @property
+    def total_users(self):
+        return self.total_admin_users + self.total_subscribed_users
+
+    def _purchased_plan_ids(self):
+        """Ids of every plan the user bought, as both str and int"""
+        plan_ids = {purchase.external_plan_id for purchase in self.purchases}
+        if self.subscription and self.subscription.external_plan_id:
+            plan_ids.add(self.subscription.external_plan_id)
+
+        normalized = set()
+        for plan_id in plan_ids:
+            normalized.add(str(plan_id))
+            if str(plan_id).isdigit():
+                normalized.add(int(plan_id))
+        return normalized
+
+    def _purchase_details(self):
+        """Per-plan purchase information keyed by external plan id"""
+        details = {}
+        for purchase in self.purchases:
+            details[purchase.external_plan_id] = {
+                'purchase': purchase,
+                'is_active': purchase.is_active(),
+                'is_expired': purchase.is_expired(),
+                'days_until_expiration': purchase.days_until_expiration(),
+                'purchase_date': purchase.purchase_date,
+                'activation_date': purchase.activation_date,
+                'expiration_date': purchase.expiration_date,
+                'amount': purchase.amount,
+                'currency': purchase.currency,
+                'status': purchase.status,
+                'plan_category': purchase.plan_category,
+            }
+        return details
@@ -0,0 +1,132 @@
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from accounts.models import User
+from gpscontrol4u.models import Form, DataRecord, FormTemplate
+from payments.models import Subscription, PricingPlan, Payment, PlanPurchase, PaymentEvent, WebhookEvent
+
+
+# Reasons a full scan is tolerated
+SMALL_TABLE = 'small catalogue table'
+# SQLite gets boolean columns as bare predicates ("WHERE is_active") and cannot
+# use an index for them; MySQL compares them to 1 and uses the index
+BOOLEAN_PREDICATE = 'boolean-only predicate, indexed on MySQL'
+
+
+def audited_querysets(user):
+    """
+    The querysets issued by accounts.views and api.views, in the shape the
+    views build them. Tuples of (name, queryset, reason a full scan is
+    tolerated or None).
+    """
+    user_id = user.pk
+    return [
+        # accounts.views
+        ('login: user by email', User.objects.filter(email='audit@example.com'), None),
+        ('verify_email: user by token', User.objects.filter(email_verification_token='audit'), None),
+        ('dashboard: subscription', Subscription.objects.filter(user_id=user_id), None),
+        ('dashboard: purchase history', PlanPurchase.get_user_purchase_history(user), None),
+        ('dashboard: active purchases', PlanPurchase.get_user_active_purchases(user), None),
+        ('dashboard: has free plan', PlanPurchase.objects.filter(user_id=user_id, plan_category='free'), None),
+        ('dashboard: user forms', Form.objects.filter(user_id=user_id, is_active=True), None),
+        ('dashboard: recent records', DataRecord.objects.filter(user_id=user_id)[:10], None),
+        ('dashboard: predefined forms', Form.objects.filter(is_predefined=True, is_active=True), BOOLEAN_PREDICATE),
+        ('pricing: pricing plans', PricingPlan.objects.filter(is_active=True).order_by('amount'), SMALL_TABLE),
+        ('webhook: event by payment', WebhookEvent.objects.filter(provider='mercado_pago', payment_id='1'), None),
+        ('webhook: activation claimed', PaymentEvent.objects.filter(
+            provider='mercado_pago', provider_payment_id='1', event_type='activation'), None),
+        ('webhook: payment by MP id', Payment.objects.filter(mercado_pago_payment_id='1'), None),
+        ('webhook: pending payment by reference', Payment.objects.filter(external_reference='audit', status='pending'), None),
+        ('webhook recovery: pending events', WebhookEvent.objects.filter(status='pending').order_by('created_at'), None),
+        ('expiry sweep: overdue purchases', PlanPurchase.objects.filter(status='active', expiration_date__lt=timezone.now()), None),
+        # api.views
+        ('api: forms', Form.objects.filter(Q(is_predefined=True) | Q(user_id=user_id)).filter(is_active=True), BOOLEAN_PREDICATE),
+        ('api: data records', DataRecord.objects.filter(user_id=user_id), None),
+        ('api: form templates', FormTemplate.objects.filter(is_active=True, is_premium_only=False), SMALL_TABLE),
+        ('api: payment history', Payment.objects.filter(user_id=user_id), None),
+        ('api: data records, keyset page', DataRecord.objects.filter(user_id=user_id)
+            .filter(submitted_at__lte=timezone.now()).filter(Q(submitted_at__lt=timezone.now()) | Q(id__lt=1000))
+            .order_by('-submitted_at', '-id')[:21], None),
+        ('api: payment history, keyset page', Payment.objects.filter(user_id=user_id)
+            .filter(created_at__lte=timezone.now()).filter(Q(created_at__lt=timezone.now()) | Q(id__lt=1000))
+            .order_by('-created_at', '-id')[:21], None),
+        ('api: pricing plans', PricingPlan.objects.filter(is_active=True), SMALL_TABLE),
+    ]
+
+
+def full_scans(queryset):
+    """Return the tables the database plans to read in full for this queryset"""
+    vendor = connection.vendor
+    if vendor == 'mysql':
+        plan = json.loads(queryset.explain(format='json'))
+        tables = []
+        stack = [plan]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                if node.get('access_type') == 'ALL':
+                    tables.append(node.get('table_name'))
+                stack.extend(node.values())
+            elif isinstance(node, list):
+                stack.extend(node)
+        return tables
+    if vendor == 'sqlite':
+        # "SCAN table" without an index is a full table scan, "SEARCH" is not
+        return [
+            match.group(1)
+            for match in re.finditer(r'\bSCAN (\w+)(?! USING (?:COVERING )?INDEX)', queryset.explain())
+        ]
+    if vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', queryset.explain())
+    raise CommandError(f'EXPLAIN audit is not supported on {vendor}')
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the querysets used by accounts.views and api.views and fail on full table scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user-id',
+            type=int,
+            help='User whose querysets are explained (default: the first user)'
+        )
+        parser.add_argument(
+            '--verbose-plans',
+            action='store_true',
+            help='Print the full EXPLAIN output for every queryset'
+        )
+
+    def handle(self, *args, **options):
+        if options['user_id']:
+            user = User.objects.filter(pk=options['user_id']).first()
+        else:
+            user = User.objects.order_by('pk').first()
+        if user is None:
+            raise CommandError('No user to audit with; create one or pass --user-id')
+
+        self.stdout.write(f'Auditing query plans on {connection.vendor} as user {user.pk}')
+
+        failures = []
+        for name, queryset, tolerated in audited_querysets(user):
+            if tolerated == BOOLEAN_PREDICATE and connection.vendor != 'sqlite':
+                tolerated = None
+            scans = full_scans(queryset)
+            if options['verbose_plans']:
+                self.stdout.write(f'\n{name}:\n{queryset.explain()}')
+
+            if not scans:
+                self.stdout.write(self.style.SUCCESS(f'  OK    {name}'))
+            elif tolerated:
+                self.stdout.write(self.style.WARNING(f'  SCAN  {name} ({", ".join(scans)}, tolerated: {tolerated})'))
+            else:
+                self.stdout.write(self.style.ERROR(f'  FAIL  {name} (full scan of {", ".join(scans)})'))
+                failures.append(name)
+
+        if failures:
+            raise CommandError(f'{len(failures)} querysets do full table scans: {", ".join(failures)}')
+
+        self.stdout.write(self.style.SUCCESS('No unexpected full table scans'))
@@ -0,0 +1,118 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from gpscontrol4u.models import Form
+from gpscontrol4u.schema import FormSchema, SchemaCache
+
+FIELD_TYPES = ('text', 'textarea', 'email', 'number', 'select', 'checkbox', 'date', 'file')
+OPTIONS = ['Option A', 'Option B', 'Option C', 'Option D']
+
+
+def synthetic_structure(field_count):
+    """form_structure with `field_count` fields cycling through the field types"""
+    fields = []
+    for n in range(field_count):
+        field_type = FIELD_TYPES[n % len(FIELD_TYPES)]
+        field = {'type': field_type, 'name': f'field_{n}', 'label': f'Field {n}', 'required': n % 2 == 0}
+        if field_type in ('select', 'checkbox'):
+            field['options'] = OPTIONS
+        if field_type == 'number':
+            field.update(min=0, max=1000)
+        fields.append(field)
+    return {'fields': fields}
+
+
+def synthetic_answer(field, rng):
+    field_type = field['type']
+    if field_type == 'email':
+        return f"user{rng.randint(1, 9999)}@example.com"
+    if field_type == 'number':
+        return rng.randint(0, 1000)
+    if field_type == 'select':
+        return rng.choice(OPTIONS)
+    if field_type == 'checkbox':
+        return rng.sample(OPTIONS, 2)
+    if field_type == 'date':
+        return f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+    if field_type == 'file':
+        return [f'photos/{rng.randint(1, 9999)}.jpg']
+    return f"Answer {rng.randint(1, 9999)}"
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark validation of data_content against a form_structure: compiled once and '
+        'cached per (form, updated_at), against compiling the structure for every record'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fields',
+            type=int,
+            default=200,
+            help='Fields in the synthetic form (default: 200)'
+        )
+        parser.add_argument(
+            '--records',
+            type=int,
+            default=2000,
+            help='Records validated per mode (default: 2000)'
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        structure = synthetic_structure(options['fields'])
+        form = Form(pk=1, form_name='Validation benchmark', form_structure=structure, updated_at=timezone.now())
+
+        valid = [
+            {'responses': {field['name']: synthetic_answer(field, rng) for field in structure['fields']}}
+            for _ in range(options['records'])
+        ]
+        # Every fourth field wrong or missing
+        invalid = []
+        for record in valid:
+            answers = dict(record['responses'])
+            for field in structure['fields'][::4]:
+                answers[field['name']] = None if field['required'] else {'unexpected': 'object'}
+            invalid.append({'responses': answers})
+
+        cache = SchemaCache(max_size=16)
+        schema = cache.get(form)
+        assert not any(schema.validate(record) for record in valid), 'synthetic records should be valid'
+        assert all(schema.validate(record) for record in invalid), 'broken records should fail'
+
+        self.stdout.write(f'{len(schema)} fields, {len(valid)} records per mode\n')
+        self.stdout.write(f'  compile once: {self._per_call(lambda: FormSchema(structure), 50):.1f} µs')
+        rows = [
+            ('compiled, cached: valid', lambda record: cache.get(form).validate(record), valid),
+            ('compiled, cached: invalid', lambda record: cache.get(form).validate(record), invalid),
+            ('compiled per record: valid', lambda record: FormSchema(structure).validate(record), valid),
+        ]
+        for label, validate, records in rows:
+            timings = self._time(validate, records)
+            self.stdout.write(
+                f'  {label:<28} mean {statistics.mean(timings):.1f} µs, '
+                f'p50 {statistics.median(timings):.1f} µs, p95 {self._p95(timings):.1f} µs per record'
+            )
+        self.stdout.write(self.style.SUCCESS(f'  cache: {dict(SchemaCache.stats)}'))
+
+    def _per_call(self, func, iterations):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter() - start) / iterations * 1_000_000
+
+    def _time(self, validate, records):
+        timings = []
+        for record in records:
+            start = time.perf_counter()
+            validate(record)
+            timings.append((time.perf_counter() - start) * 1_000_000)
+        return timings
+
+    def _p95(self, timings):
+        timings = sorted(timings)
+        return timings[min(len(timings) - 1, int(len(timings) * 0.95))]
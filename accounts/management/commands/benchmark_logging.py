@@ -0,0 +1,142 @@
+import logging
+import os
+import statistics
+import tempfile
+import time
+from unittest import mock
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from accounts.models import User
+from accounts.views import _activation_failed
+from log_utils import QueuedFileHandler, RedactingFilter
+from subscription_service import SubscriptionService
+
+LOGGER_NAMES = ('accounts.views', 'subscription_service')
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the logging cost of the plan activation path (subscription payload, API '
+        'response handling) with the legacy and the current logging setup; database and '
+        'cache writes are stubbed so only the Python and logging work is timed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=300,
+            help='Activation paths per workload and mode (default: 300)'
+        )
+
+    def handle(self, *args, **options):
+        subscription = mock.Mock(created=False)
+        with mock.patch.object(User, 'save'), \
+                mock.patch('subscription_service.Subscription.objects.get_or_create', return_value=(subscription, False)), \
+                mock.patch('subscription_service.RFCValidatorService.mark_registered'):
+            self._benchmark(options['iterations'])
+
+    def _benchmark(self, iterations):
+        user = User(
+            email='logging-benchmark@example.com', first_name='Bench', last_name='Mark',
+            rfc_tin='XAXX010101000', external_api_password='Apple1234',
+        )
+        service = SubscriptionService()
+        url = f"{service.base_url}/store/subscription"
+        request = httpx.Request('POST', url, json={'rfc': user.rfc_tin})
+        created = httpx.Response(200, request=request, json={'code': 200, 'message': 'ok', 'data': {
+            'client_id': 101, 'user_id': 202, 'total_licencias': 5, 'token': 'abc123',
+        }})
+        refused = httpx.Response(503, request=request, json={'code': 503, 'message': 'El usuario no esta disponible'})
+
+        def success_path():
+            api_password, _url, _params, _headers, _data = service._prepare_subscription(user, 2, True)
+            service._handle_subscription_response(created, user, 2, True, api_password, False)
+
+        def failure_path():
+            api_password, _url, _params, _headers, _data = service._prepare_subscription(user, 2, True)
+            service._handle_subscription_response(refused, user, 2, True, api_password, True)
+            _activation_failed(user, 2, True, 'El usuario no esta disponible')
+
+        workloads = [('success', success_path), ('failure', failure_path)]
+        formatters = {
+            name: logging.Formatter(config['format'], style=config.get('style', '%'))
+            for name, config in settings.LOGGING['formatters'].items()
+        }
+        loggers = [logging.getLogger(name) for name in LOGGER_NAMES]
+        saved = [(lg.handlers[:], lg.level, lg.propagate, lg.disabled) for lg in loggers]
+
+        with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+            def stream(formatter, redact=False):
+                handler = logging.StreamHandler(devnull)
+                handler.setFormatter(formatters[formatter])
+                if redact:
+                    handler.addFilter(RedactingFilter())
+                return handler
+
+            def legacy_handlers():
+                # console + plan_activation_console + plan_activation_file, all synchronous
+                file_handler = logging.FileHandler(os.path.join(tmp, 'legacy.log'))
+                file_handler.setFormatter(formatters['plan_activation'])
+                return [stream('verbose'), stream('plan_activation'), file_handler]
+
+            def current_handlers():
+                file_handler = QueuedFileHandler(os.path.join(tmp, 'current.log'))
+                file_handler.setFormatter(formatters['plan_activation'])
+                file_handler.addFilter(RedactingFilter())
+                return [stream('plan_activation', redact=True), file_handler]
+
+            modes = [
+                ('logging disabled (baseline)', [], None),
+                ('legacy: 3 sync handlers, DEBUG', legacy_handlers(), logging.DEBUG),
+                ('current: queued file + redaction, DEBUG', current_handlers(), logging.DEBUG),
+                ('current: queued file + redaction, INFO', current_handlers(), logging.INFO),
+                ('current: level WARNING', current_handlers(), logging.WARNING),
+            ]
+
+            self.stdout.write(f'Activation path, {iterations} iterations per workload and mode\n')
+            baselines = {}
+            try:
+                for label, handlers, level in modes:
+                    for lg in loggers:
+                        lg.handlers = handlers
+                        lg.propagate = False
+                        lg.disabled = level is None
+                        lg.setLevel(level or logging.CRITICAL)
+
+                    self.stdout.write(self.style.MIGRATE_HEADING(label))
+                    for workload, path in workloads:
+                        path()  # warm up
+                        timings = self._time(path, iterations)
+                        mean = statistics.mean(timings)
+                        baselines.setdefault(workload, mean)
+                        cost = '' if level is None else f', logging cost {mean - baselines[workload]:.3f} ms'
+                        self.stdout.write(f'  {workload}: {self._summary(timings)}{cost}')
+
+                    drain_started = time.perf_counter()
+                    for handler in handlers:
+                        handler.flush()
+                        handler.close()
+                    if handlers:
+                        self.stdout.write(f'  background drain after the run: {(time.perf_counter() - drain_started) * 1000:.1f} ms')
+            finally:
+                for lg, (handlers, level, propagate, disabled) in zip(loggers, saved):
+                    lg.handlers = handlers
+                    lg.setLevel(level)
+                    lg.propagate = propagate
+                    lg.disabled = disabled
+
+    def _time(self, func, iterations):
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def _summary(self, timings):
+        timings = sorted(timings)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        return f'mean {statistics.mean(timings):.3f} ms, p50 {statistics.median(timings):.3f} ms, p95 {p95:.3f} ms'
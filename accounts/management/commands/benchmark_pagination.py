@@ -0,0 +1,99 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+from accounts.models import User
+from api.views import DataRecordViewSet
+from gpscontrol4u.models import DataRecord, Form
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark GET /api/records/ at increasing depths with page numbers and with the '
+        'keyset cursor; the synthetic user and records are rolled back afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--records',
+            type=int,
+            default=25000,
+            help='Synthetic records for the benchmark user (default: 25000)'
+        )
+        parser.add_argument(
+            '--pages',
+            default='1,10,100,1000',
+            help='Comma-separated page numbers to time (default: 1,10,100,1000)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20,
+            help='Requests per page and mode (default: 20)'
+        )
+
+    def handle(self, *args, **options):
+        pages = sorted(int(page) for page in options['pages'].split(','))
+        try:
+            with transaction.atomic():
+                self._benchmark(options['records'], pages, options['iterations'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _benchmark(self, record_count, pages, iterations):
+        user = User.objects.create(email='pagination-benchmark@example.com', username='pagination-benchmark')
+        form = Form.objects.create(user=user, form_name='Pagination benchmark', form_structure={'fields': []})
+        DataRecord.objects.bulk_create(
+            (DataRecord(user=user, form=form, data_content={'n': n}) for n in range(record_count)),
+            batch_size=1000,
+        )
+
+        view = DataRecordViewSet.as_view({'get': 'list'})
+        factory = APIRequestFactory()
+
+        def get(params):
+            request = factory.get('/api/records/', params)
+            force_authenticate(request, user=user)
+            response = view(request)
+            response.render()
+            return response
+
+        # Cursor of each timed page, found by following `next` links
+        cursors = {}
+        cursor = ''
+        for page in range(1, pages[-1] + 1):
+            if page in pages:
+                cursors[page] = cursor
+            next_link = get({'cursor': cursor}).data['next']
+            if next_link is None:
+                break
+            cursor = next_link.split('cursor=')[1].split('&')[0]
+
+        self.stdout.write(f'{record_count} records, page size 20, {iterations} requests per cell\n')
+        self.stdout.write(f"{'page':>6}  {'page number':>24}  {'keyset cursor':>24}")
+        for page in pages:
+            if page not in cursors:
+                self.stdout.write(f'{page:>6}  beyond the last page')
+                continue
+            by_number = self._time(lambda: get({'page': page}), iterations)
+            by_cursor = self._time(lambda: get({'cursor': cursors[page]}), iterations)
+            self.stdout.write(f'{page:>6}  {by_number:>24}  {by_cursor:>24}')
+
+    def _time(self, func, iterations):
+        func()  # warm up
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return f'{statistics.median(timings):.2f} ms, {len(queries)} queries'
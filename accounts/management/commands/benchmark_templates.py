@@ -0,0 +1,115 @@
+import copy
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template.backends.django import DjangoTemplates
+from django.template.loader import get_template
+from django.test import RequestFactory, override_settings
+from django.utils import translation
+from accounts.models import User
+from accounts.views import dashboard_context, pricing_context
+from plan_catalogue import PlanIndex
+
+
+def synthetic_plans(count):
+    """Plan dicts shaped like ExternalAPIService.fetch_plans() output"""
+    plans = [{
+        'id': 1, 'name': 'Plan Gratuito', 'description': 'Formularios predefinidos', 'price': 0,
+        'is_free': True, 'billing_cycle': 'Anual', 'admin_users_quantity': 1, 'subscribed_users_quantity': 1,
+    }]
+    for plan_id in range(2, count + 1):
+        plans.append({
+            'id': plan_id, 'name': f'Licencia {plan_id}', 'description': f'Licencia con {plan_id * 5} usuarios',
+            'price': 600 * plan_id, 'is_free': False, 'billing_cycle': 'Anual',
+            'admin_users_quantity': 1, 'subscribed_users_quantity': plan_id * 5,
+        })
+    return plans
+
+
+class Command(BaseCommand):
+    help = 'Benchmark template rendering of dashboard.html and pricing.html without and with template caching'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user-id',
+            type=int,
+            help='User whose pages are rendered (default: the user with the most plan purchases)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=50,
+            help='Renders per page and mode (default: 50)'
+        )
+        parser.add_argument(
+            '--plans',
+            type=int,
+            default=6,
+            help='Number of synthetic plans in the catalogue (default: 6)'
+        )
+
+    def handle(self, *args, **options):
+        from django.db.models import Count
+
+        if options['user_id']:
+            user = User.objects.filter(pk=options['user_id']).first()
+        else:
+            user = User.objects.annotate(purchase_count=Count('plan_purchases')).order_by('-purchase_count').first()
+        if user is None:
+            raise CommandError('No user to render the pages for')
+
+        plan_index = PlanIndex(synthetic_plans(options['plans']))
+        request = RequestFactory().get('/')
+        request.user = user
+        pages = [
+            ('dashboard.html', dashboard_context(user, plan_index)),
+            ('pricing.html', pricing_context(user, plan_index)),
+        ]
+
+        # Before: templates parsed on every render, no fragment cache
+        uncached_config = copy.deepcopy(settings.TEMPLATES[0])
+        uncached_config.pop('BACKEND')
+        uncached_config['NAME'] = 'benchmark_uncached'
+        uncached_config['APP_DIRS'] = False
+        uncached_config['OPTIONS']['loaders'] = [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]
+        uncached_engine = DjangoTemplates(uncached_config)
+        no_fragment_cache = dict(settings.CACHES, template_fragments={
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        })
+
+        iterations = options['iterations']
+        self.stdout.write(f'Rendering as {user.email}, {len(plan_index)} plans, {iterations} iterations\n')
+
+        with translation.override(user.language or settings.LANGUAGE_CODE):
+            for name, context in pages:
+                with override_settings(CACHES=no_fragment_cache):
+                    before = self._time(lambda: uncached_engine.get_template(name).render(context, request), iterations)
+
+                # After: compiled template from the cached loader, warm fragments
+                get_template(name).render(context, request)
+                after = self._time(lambda: get_template(name).render(context, request), iterations)
+
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                self.stdout.write(f'  before (re-parse, no fragments): {self._summary(before)}')
+                self.stdout.write(f'  after  (cached loader + fragments): {self._summary(after)}')
+                self.stdout.write(self.style.SUCCESS(
+                    f'  speedup: {statistics.mean(before) / statistics.mean(after):.1f}x'
+                ))
+
+    def _time(self, render, iterations):
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            render()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def _summary(self, timings):
+        timings = sorted(timings)
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        return f'mean {statistics.mean(timings):.2f} ms, p50 {statistics.median(timings):.2f} ms, p95 {p95:.2f} ms'
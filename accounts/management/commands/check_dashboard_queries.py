@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from accounts.dashboard import DashboardSnapshot
+from accounts.models import User
+
+
+class Command(BaseCommand):
+    help = 'Load the dashboard snapshot for users and fail if it exceeds its query budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user-id',
+            type=int,
+            action='append',
+            help='User to check (repeatable; default: the users with the most plan purchases)'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=5,
+            help='Number of users checked when --user-id is not given (default: 5)'
+        )
+
+    def handle(self, *args, **options):
+        if options['user_id']:
+            users = User.objects.filter(pk__in=options['user_id'])
+        else:
+            users = User.objects.annotate(purchase_count=Count('plan_purchases')).order_by('-purchase_count')[:options['limit']]
+        users = list(users)
+        if not users:
+            raise CommandError('No users to check')
+
+        budget = DashboardSnapshot.QUERY_BUDGET
+        over_budget = []
+        for user in users:
+            with CaptureQueriesContext(connection) as queries:
+                snapshot = DashboardSnapshot.load(user)
+            count = len(queries)
+            summary = (f'{user.email}: {count} queries '
+                       f'({len(snapshot.purchases)} purchases, {len(snapshot.recent_records)} records)')
+            if count > budget:
+                self.stdout.write(self.style.ERROR(f'  FAIL  {summary}'))
+                for query in queries.captured_queries:
+                    self.stdout.write(f'        {query["sql"]}')
+                over_budget.append(user.email)
+            else:
+                self.stdout.write(self.style.SUCCESS(f'  OK    {summary}'))
+
+        if over_budget:
+            raise CommandError(f'Dashboard exceeds its budget of {budget} queries for: {", ".join(over_budget)}')
+
+        self.stdout.write(self.style.SUCCESS(f'Dashboard stays within {budget} queries'))
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from accounts.models import User
+from accounts.rfc_validator import RFCValidatorService, AVAILABLE, EXISTS, normalize_rfc
+from circuit_breaker import CircuitOpenError, UpstreamUnavailable, circuit_breakers
+from http_client import AsyncRateLimiter, close_async_client
+
+
+class Checkpoint:
+    """
+    Highest position below which every RFC has been written
+
+    Results complete out of order; the checkpoint only advances over a
+    contiguous run of finished positions, so resuming from it never skips
+    an RFC (a few after it may be checked twice).
+    """
+
+    def __init__(self, path, position=None):
+        self.path = path
+        self.position = position
+        self._issued = deque()
+        self._done = set()
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                return cls(path, json.load(f)['position'])
+        except (OSError, ValueError, KeyError):
+            return cls(path)
+
+    def issue(self, position):
+        self._issued.append(position)
+
+    def complete(self, position):
+        self._done.add(position)
+        while self._issued and self._issued[0] in self._done:
+            self._done.discard(self._issued[0])
+            self.position = self._issued.popleft()
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'position': self.position, 'saved_at': timezone.now().isoformat()}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Command(BaseCommand):
+    help = (
+        'Check RFC/TINs against /store/client/subscription with bounded concurrency and '
+        'write one NDJSON result per RFC, resumable from a checkpoint'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            help='Read RFCs from this file, one per line ("-" for stdin) instead of User.rfc_tin'
+        )
+        parser.add_argument(
+            '--output',
+            default='rfc_check.ndjson',
+            help='NDJSON results file (default: rfc_check.ndjson)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Checkpoint file (default: <output>.checkpoint)'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and overwrite the output'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=8,
+            help='RFCs checked at the same time (default: 8)'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=20,
+            help='Maximum lookups per second, 0 for no limit (default: 20)'
+        )
+        parser.add_argument(
+            '--retries',
+            type=int,
+            default=3,
+            help='Retries per RFC on transport errors or an open circuit (default: 3)'
+        )
+        parser.add_argument(
+            '--checkpoint-every',
+            type=int,
+            default=200,
+            help='Save the checkpoint every N results (default: 200)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Users read from the database per query (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        if options['file'] and options['file'] != '-' and not os.path.exists(options['file']):
+            raise CommandError(f"File not found: {options['file']}")
+
+        checkpoint_path = options['checkpoint'] or f"{options['output']}.checkpoint"
+        if options['restart'] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if checkpoint.position is not None:
+            self.stdout.write(f'Resuming after position {checkpoint.position}')
+
+        # This process only runs lookups: let the bulkhead match the pool
+        circuit_breakers.get('client_lookup').resize(options['concurrency'])
+
+        mode = 'a' if checkpoint.position is not None else 'w'
+        started = time.monotonic()
+        with open(options['output'], mode) as output:
+            counts = asyncio.run(self._run(options, checkpoint, output))
+        elapsed = time.monotonic() - started
+
+        total = sum(counts.values())
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {total} RFCs in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.1f}/s): '
+            + ', '.join(f'{status} {count}' for status, count in sorted(counts.items()))
+        ))
+        self.stdout.write(f"Results: {options['output']}, checkpoint: {checkpoint_path}")
+
+    async def _run(self, options, checkpoint, output):
+        concurrency = options['concurrency']
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        limiter = AsyncRateLimiter(options['rate'])
+        validator = RFCValidatorService()
+        counts = Counter()
+
+        async def produce():
+            async for item in self._source(options, checkpoint.position):
+                checkpoint.issue(item['position'])
+                await queue.put(item)
+            for _ in range(concurrency):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                record = await self._check(validator, limiter, item, options['retries'])
+                output.write(json.dumps(record) + '\n')
+                counts[record['status']] += 1
+                checkpoint.complete(item['position'])
+                if sum(counts.values()) % options['checkpoint_every'] == 0:
+                    output.flush()
+                    checkpoint.save()
+                    self.stdout.write(f"  {sum(counts.values())} checked, checkpoint at {checkpoint.position}")
+
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(concurrency)))
+        finally:
+            await close_async_client()
+        output.flush()
+        if checkpoint.position is not None:
+            checkpoint.save()
+        return counts
+
+    async def _source(self, options, after):
+        """Yield {'position', 'rfc', 'user_id', ...} after the checkpoint position"""
+        if options['file']:
+            stream = sys.stdin if options['file'] == '-' else open(options['file'])
+            try:
+                for line_number, line in enumerate(stream, start=1):
+                    rfc = normalize_rfc(line)
+                    if rfc and (after is None or line_number > after):
+                        yield {'position': line_number, 'rfc': rfc, 'user_id': None}
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+            return
+
+        # Keyset pages by pk so the database is never scanned from the start again
+        last_pk = after or 0
+        while True:
+            page = await sync_to_async(list)(
+                User.objects.filter(pk__gt=last_pk)
+                .exclude(rfc_tin__isnull=True).exclude(rfc_tin='')
+                .order_by('pk')
+                .values_list('pk', 'rfc_tin', 'external_api_registered')[:options['batch_size']]
+            )
+            if not page:
+                return
+            for pk, rfc, registered in page:
+                yield {'position': pk, 'rfc': normalize_rfc(rfc), 'user_id': pk, 'registered_locally': registered}
+            last_pk = page[-1][0]
+
+    async def _check(self, validator, limiter, item, retries):
+        record = dict(item)
+        for attempt in range(retries + 1):
+            await limiter.wait()
+            try:
+                status = await validator.alookup_status(item['rfc'])
+            except CircuitOpenError as e:
+                error = str(e)
+                # Wait for the half-open probe window instead of burning retries
+                await asyncio.sleep(circuit_breakers.get('client_lookup').reset_timeout)
+            except (UpstreamUnavailable, httpx.HTTPError) as e:
+                error = f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"
+                await asyncio.sleep(min(2 ** attempt, 30))
+            else:
+                if status in (EXISTS, AVAILABLE):
+                    await sync_to_async(RFCValidatorService.remember)(item['rfc'], status)
+                    record.update(status=status, checked_at=timezone.now().isoformat())
+                    return record
+                error = 'Unexpected response from /store/client/subscription'
+                break
+
+        record.update(status='error', error=error, checked_at=timezone.now().isoformat())
+        return record
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+from payments.models import WebhookEvent
+from accounts.tasks import process_mercado_pago_webhook
+
+
+class Command(BaseCommand):
+    help = 'Re-enqueue pending or stuck payment webhook events (recovery for broker or worker outages)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=600,
+            help='Only pick up pending events not touched for this many seconds (default: 600)'
+        )
+        parser.add_argument(
+            '--stale-minutes',
+            type=int,
+            default=15,
+            help='Reset events stuck in processing for this many minutes (default: 15)'
+        )
+        parser.add_argument(
+            '--sync',
+            action='store_true',
+            help='Process events in this process instead of sending them to the Celery broker'
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        
+        # Events whose worker died mid-run go back to the queue
+        reset = WebhookEvent.objects.filter(
+            status='processing',
+            updated_at__lt=now - timedelta(minutes=options['stale_minutes'])
+        ).update(status='pending')
+        if reset:
+            self.stdout.write(self.style.WARNING(f'Reset {reset} events stuck in processing'))
+        
+        pending_ids = list(
+            WebhookEvent.objects.filter(
+                status='pending',
+                updated_at__lt=now - timedelta(seconds=options['min_age'])
+            ).order_by('created_at').values_list('pk', flat=True)
+        )
+        
+        for event_id in pending_ids:
+            if options['sync']:
+                process_mercado_pago_webhook.apply(args=[event_id])
+            else:
+                process_mercado_pago_webhook.delay(event_id)
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'{"Processed" if options["sync"] else "Enqueued"} {len(pending_ids)} pending webhook events')
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_user_phone_verified'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='email_verification_token',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
@@ -78,7 +78,7 @@ class User(AbstractUser):
     
     # Email verification fields
     email_verified = models.BooleanField(default=False)
-    email_verification_token = models.CharField(max_length=100, blank=True)
+    email_verification_token = models.CharField(max_length=100, blank=True, db_index=True)
     email_verification_sent_at = models.DateTimeField(null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
@@ -1,64 +1,152 @@
+import re
+from collections import Counter
+
 import requests
 from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
 from django.utils.translation import gettext_lazy as _
+from external_api_auth import token_manager
+from circuit_breaker import FAILURE_STATUSES
+from http_client import get_session
+from instrumentation import traced_service
+
+# One entry per RFC looked up: kept out of the default cache (see CACHES)
+cache = ConnectionProxy(caches, 'user_data')
+
+# Lookup outcomes worth caching; errors are never cached
+EXISTS = 'exists'
+AVAILABLE = 'available'
+
+
+def normalize_rfc(rfc_tin):
+    """Upper-case RFC/TIN without spaces or dashes, as used for cache keys"""
+    return re.sub(r'[\s-]', '', rfc_tin or '').upper()
 
+
+@traced_service('RFCValidatorService')
 class RFCValidatorService:
-    """Service to validate RFC/TIN against external API"""
+    """
+    Service to validate RFC/TIN against external API
+
+    Lookup results are cached per normalized RFC in the shared cache, so a
+    re-submitted form does not call the API again: an RFC that exists stays
+    taken for RFC_VALIDATION_EXISTS_TTL, an available one is re-checked
+    after the shorter RFC_VALIDATION_AVAILABLE_TTL.
+    """
+
+    CACHE_KEY = 'rfc_validation:{rfc}'
+    stats = Counter()
+
     def __init__(self):
         self.base_url = getattr(settings, 'EXTERNAL_API_BASE_URL', 'https://api2ego.elisasoftware.com.mx')
         self.username = getattr(settings, 'EXTERNAL_API_USERNAME', 'AdmGPScontrol4u')
         self.password = getattr(settings, 'EXTERNAL_API_PASSWORD', 'GPSc0ntr0l4u*')
         self.store = getattr(settings, 'EXTERNAL_API_STORE', 'GPScontrol4U')
         self.token = None
-        self.session = requests.Session()
+        self.session = get_session()
 
     def authenticate(self):
-        url = f"{self.base_url}/login"
-        params = {
-            'username': self.username,
-            'password': self.password
-        }
-        headers = {'accept': 'application/json'}
-        response = self.session.post(url, params=params, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('code') == 200 and 'data' in data:
-                self.token = data['data'].get('token')
-                return True
-        return False
+        self.token = token_manager.get_token()
+        return bool(self.token)
+
+    @classmethod
+    def cached_status(cls, rfc_tin):
+        """EXISTS, AVAILABLE or None when the RFC has no cached lookup"""
+        return cache.get(cls.CACHE_KEY.format(rfc=normalize_rfc(rfc_tin)))
+
+    @classmethod
+    def remember(cls, rfc_tin, status):
+        ttl = (getattr(settings, 'RFC_VALIDATION_EXISTS_TTL', 24 * 60 * 60) if status == EXISTS
+               else getattr(settings, 'RFC_VALIDATION_AVAILABLE_TTL', 5 * 60))
+        cache.set(cls.CACHE_KEY.format(rfc=normalize_rfc(rfc_tin)), status, ttl)
+
+    @classmethod
+    def mark_registered(cls, rfc_tin):
+        """Replace any cached lookup once the RFC has been registered by us"""
+        cls.remember(rfc_tin, EXISTS)
+
+    @classmethod
+    def invalidate(cls, rfc_tin):
+        cache.delete(cls.CACHE_KEY.format(rfc=normalize_rfc(rfc_tin)))
+
+    def _result(self, status):
+        if status == EXISTS:
+            return False, _('El RFC/TIN ya existe en el sistema')
+        return True, None
 
     def validate_rfc(self, rfc_tin):
+        status = self.cached_status(rfc_tin)
+        if status is not None:
+            self.stats['hit'] += 1
+            return self._result(status)
+        self.stats['miss'] += 1
+
+        status = self._lookup(rfc_tin)
+        if status in (EXISTS, AVAILABLE):
+            self.remember(rfc_tin, status)
+            return self._result(status)
+        return False, status
+
+    def _lookup(self, rfc_tin):
+        """EXISTS, AVAILABLE or the error message to show"""
         if not self.token:
             if not self.authenticate():
-                return False, _('No se pudo autenticar con la API externa')
+                return _('No se pudo autenticar con la API externa')
 
         url = f"{self.base_url}/store/client/subscription"
         params = {
             'rfc': rfc_tin,
             'store': self.store
         }
-        headers = {
-            'accept': 'application/json',
-            'Authorization': self.token
-        }
-        response = self.session.get(url, params=params, headers=headers, timeout=10)
+        headers = {'accept': 'application/json'}
+        try:
+            response = token_manager.request('GET', url, session=self.session, params=params, headers=headers, timeout=10)
+        except requests.exceptions.RequestException:
+            # Includes an open circuit on the client lookup endpoints: fail fast
+            return _('No se pudo validar el RFC/TIN en este momento, intente más tarde')
         #print(f"Response: {response.status_code} - {response.text}")
 
+        status = self._classify(response)
+        if status is not None:
+            return status
+
+        # Fallback → unexpected error
+        return _('No se pudo validar el RFC/TIN en este momento, intente más tarde')
+
+    async def alookup_status(self, rfc_tin):
+        """
+        Uncached async lookup for bulk checks: EXISTS, AVAILABLE or None for
+        an unexpected response. Transport errors (including an open circuit)
+        and 5xx failures are raised so the caller can retry them.
+        """
+        url = f"{self.base_url}/store/client/subscription"
+        params = {
+            'rfc': normalize_rfc(rfc_tin),
+            'store': self.store
+        }
+        headers = {'accept': 'application/json'}
+        response = await token_manager.arequest('GET', url, params=params, headers=headers, timeout=10)
+        if response.status_code in FAILURE_STATUSES:
+            response.raise_for_status()
+        return self._classify(response)
+
+    def _classify(self, response):
+        """EXISTS or AVAILABLE for a /store/client/subscription response (requests or httpx), None otherwise"""
         if response.status_code == 200:
             data = response.json()
             # If code 200 and data is empty → RFC already exists → deny
             if data.get('code') == 200 and data.get('data') == []:
-                return False, _('El RFC/TIN ya existe en el sistema')
+                return EXISTS
             
             # If code 200 and data has subscriptions → RFC already exists → deny
             if data.get('code') == 200 and isinstance(data.get('data'), list) and len(data.get('data', [])) > 0:
-                return False, _('El RFC/TIN ya existe en el sistema')
+                return EXISTS
 
         if response.status_code == 503:
             data = response.json()
             # If code 503 and message matches "no corresponde..." → RFC does not exist → allow
             if data.get('code') == 503 and "no corresponde" in data.get('message', ''):
-                return True, None
+                return AVAILABLE
 
-        # Fallback → unexpected error
-        return False, _('No se pudo validar el RFC/TIN en este momento, intente más tarde')
\ No newline at end of file
+        return None
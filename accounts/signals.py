@@ -0,0 +1,47 @@
+"""
+Dashboard snapshot invalidation
+
+Any change to data shown on a user's dashboard bumps the version of that
+user's cached DashboardSnapshot. The bump waits for the transaction to
+commit: bumped earlier, a visit in between would cache a snapshot of the
+old rows under the new version.
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from gpscontrol4u.models import Form, DataRecord
+from payments.models import Subscription, Payment, PlanPurchase
+from payments.signals import plan_purchases_expired
+from .dashboard import DashboardSnapshot
+
+
+@receiver([post_save, post_delete], sender=PlanPurchase)
+@receiver([post_save, post_delete], sender=Payment)
+@receiver([post_save, post_delete], sender=Subscription)
+@receiver([post_save, post_delete], sender=DataRecord)
+def invalidate_user_dashboard(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: DashboardSnapshot.invalidate(user_id))
+
+
+@receiver([post_save, post_delete], sender=Form)
+def invalidate_form_dashboards(sender, instance, **kwargs):
+    # Predefined forms appear on every user's dashboard
+    if instance.is_predefined:
+        transaction.on_commit(DashboardSnapshot.invalidate_all)
+    else:
+        user_id = instance.user_id
+        transaction.on_commit(lambda: DashboardSnapshot.invalidate(user_id))
+
+
+@receiver(plan_purchases_expired)
+def invalidate_expired_dashboards(sender, user_ids, **kwargs):
+    user_ids = list(user_ids)
+
+    def invalidate():
+        for user_id in user_ids:
+            DashboardSnapshot.invalidate(user_id)
+
+    transaction.on_commit(invalidate)
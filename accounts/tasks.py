@@ -0,0 +1,256 @@
+"""
+Background tasks for Mercado Pago payment processing
+
+The webhook view only persists a WebhookEvent and enqueues
+process_mercado_pago_webhook; the Mercado Pago lookup, plan activation
+and retries happen here, off the request thread.
+"""
+
+import logging
+import traceback
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from payment_reference import InvalidReference, decode_reference
+from payments.models import Payment, PaymentEvent, Subscription, SubscriptionDiscrepancy, WebhookEvent
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentLookupError(Exception):
+    """Mercado Pago did not return the payment details"""
+
+
+class ActivationInProgress(Exception):
+    """Another worker holds the payment's activation claim"""
+
+
+def enqueue_webhook_event(event):
+    """
+    Hand a persisted webhook event to the worker
+    If the broker is unreachable the event stays pending and is picked up
+    by the process_webhook_events command.
+    """
+    try:
+        process_mercado_pago_webhook.delay(event.pk)
+    except Exception as e:
+        logger.error(f"🔔 [MP_WEBHOOK] Could not enqueue event {event.pk}, left pending: {e}")
+
+
+@shared_task(bind=True, max_retries=getattr(settings, 'MP_WEBHOOK_MAX_RETRIES', 5))
+def process_mercado_pago_webhook(self, event_id):
+    """Process one Mercado Pago payment notification"""
+    # Claim the event so concurrent deliveries of the same task do nothing
+    claimed = WebhookEvent.objects.filter(pk=event_id, status='pending').update(
+        status='processing',
+        attempts=F('attempts') + 1,
+        updated_at=timezone.now(),
+    )
+    if not claimed:
+        logger.info(f"🔔 [MP_WEBHOOK] Event {event_id} is not pending, skipping")
+        return 'skipped'
+
+    event = WebhookEvent.objects.get(pk=event_id)
+    is_last_attempt = self.request.retries >= self.max_retries
+
+    try:
+        status, result, error = handle_mercado_pago_payment(event.payment_id, allow_fallback=is_last_attempt)
+    except (PaymentLookupError, ActivationInProgress) as e:
+        retry_delay = getattr(settings, 'MP_WEBHOOK_RETRY_DELAY', 10) * 2 ** self.request.retries
+        logger.warning(f"🔔 [MP_WEBHOOK] Attempt {self.request.retries + 1}: {e}, retrying in {retry_delay}s")
+        WebhookEvent.objects.filter(pk=event_id).update(
+            status='pending',
+            last_error=str(e),
+            updated_at=timezone.now(),
+        )
+        raise self.retry(exc=e, countdown=retry_delay)
+    except Exception as e:
+        logger.error(f"🔔 [MP_WEBHOOK] Critical error processing payment {event.payment_id}: {e}")
+        logger.error(f"🔔 [MP_WEBHOOK] Traceback: {traceback.format_exc()}")
+        status, result, error = 'failed', 'error', str(e)
+
+    WebhookEvent.objects.filter(pk=event_id).update(
+        status=status,
+        result=result,
+        last_error=error or '',
+        processed_at=timezone.now(),
+        updated_at=timezone.now(),
+    )
+    return result
+
+
+def handle_mercado_pago_payment(payment_id, allow_fallback=False):
+    """
+    Look up a payment in Mercado Pago and activate the purchased plan
+
+    Returns:
+        tuple: (event status, result code, error message or None)
+    Raises:
+        PaymentLookupError: if Mercado Pago did not return the payment and
+        allow_fallback is False (the caller retries later)
+        ActivationInProgress: if another worker is activating the payment
+        and allow_fallback is False (the caller retries later)
+    """
+    # Imported here because the views module enqueues these tasks
+    from .views import activate_plan_for_user, mp_sdk
+
+    logger.info(f"🔔 [MP_WEBHOOK] Processing payment ID: {payment_id}")
+
+    # Check if this payment was already activated (unique ledger index lookup)
+    if PaymentEvent.is_completed('mercado_pago', payment_id, 'activation'):
+        logger.info(f"🔔 [MP_WEBHOOK] Payment {payment_id} already processed, skipping")
+        return 'processed', 'already_processed', None
+
+    payment_data = None
+    lookup_error = None
+    try:
+        payment_response = mp_sdk.payment().get(payment_id)
+        if payment_response["status"] == 200:
+            payment_data = payment_response["response"]
+        else:
+            lookup_error = f"Failed to get payment details: {payment_response}"
+    except Exception as api_error:
+        lookup_error = f"API error: {api_error}"
+
+    if not payment_data:
+        if not allow_fallback:
+            raise PaymentLookupError(lookup_error)
+        logger.error(f"🔔 [MP_WEBHOOK] Failed to get payment details after all retries: {lookup_error}")
+        return _fallback_activation(payment_id, activate_plan_for_user)
+
+    external_reference = payment_data.get('external_reference')
+
+    logger.info(f"🔔 [MP_WEBHOOK] Payment data retrieved successfully")
+    logger.info(f"🔔 [MP_WEBHOOK] Status: {payment_data.get('status')}")
+    logger.info(f"🔔 [MP_WEBHOOK] External reference: {external_reference}")
+
+    # Checkouts opened by create_mercado_pago_preference are one indexed lookup
+    pending_payment = Payment.pending_for_reference(external_reference)
+    if pending_payment:
+        user = pending_payment.user
+        plan_id = pending_payment.external_plan_id
+    else:
+        # Legacy references (or checkouts opened before references were stored)
+        try:
+            reference = decode_reference(external_reference)
+        except InvalidReference as e:
+            logger.warning(f"🔔 [MP_WEBHOOK] Invalid or missing external reference: {e}")
+            return 'processed', 'invalid_reference', None
+
+        plan_id = reference.plan_id
+        try:
+            user = User.objects.get(id=reference.user_id)
+        except User.DoesNotExist as e:
+            logger.error(f"🔔 [MP_WEBHOOK] Could not find user from reference {external_reference}: {e}")
+            return 'failed', 'user_not_found', str(e)
+
+    logger.info(f"🔔 [MP_WEBHOOK] Found user: {user.email} (ID: {user.id}) for plan: {plan_id}")
+
+    if not (payment_data['status'] == 'approved' and payment_data['status_detail'] == 'accredited'):
+        logger.info(f"🔔 [MP_WEBHOOK] Payment not approved yet (status: {payment_data['status']}, detail: {payment_data.get('status_detail')})")
+        return 'waiting', f"not_approved:{payment_data['status']}", None
+
+    # Activate plan for user with correct plan ID
+    logger.info(f"🔔 [MP_WEBHOOK] Payment approved, activating plan {plan_id} for user {user.email}")
+    success, error_msg = activate_plan_for_user(user, payment_id, external_reference, plan_id)
+    logger.info(f"🔔 [MP_WEBHOOK] Plan activation result: {success}")
+
+    if success is None:
+        # Check again later whether the other worker completed it
+        if not allow_fallback:
+            raise ActivationInProgress(error_msg)
+        return 'waiting', 'activation_in_progress', None
+
+    if success:
+        # A re-opened notification that now succeeds closes its manual review entry
+        SubscriptionDiscrepancy.objects.filter(
+            kind='activation_failed', key=str(payment_id), status='open'
+        ).update(status='resolved', resolved_at=timezone.now())
+        return 'processed', 'plan_activated', None
+
+    # Could be due to corrupted RFC, API issues, etc.
+    logger.error(f"🔔 [MP_WEBHOOK] Plan activation failed for user {user.email} - payment was successful but external API activation failed")
+    logger.error(f"🔔 [MP_WEBHOOK] This requires MANUAL REVIEW - Payment ID: {payment_id}, User: {user.email}, Plan: {plan_id}")
+    _record_activation_failure(user, payment_id, plan_id, external_reference, error_msg)
+    return 'failed', 'payment_received_activation_failed', error_msg
+
+
+def _record_activation_failure(user, payment_id, plan_id, external_reference, error_msg):
+    """Keep a paid-but-not-activated payment in the discrepancy table for manual review"""
+    try:
+        SubscriptionDiscrepancy.record(
+            user,
+            'activation_failed',
+            key=payment_id,
+            local_value=f"plan {plan_id}",
+            details={'external_reference': external_reference, 'error': error_msg or ''},
+        )
+    except Exception as e:
+        logger.error(f"🔔 [MP_WEBHOOK] Could not record activation failure of payment {payment_id}: {e}")
+
+
+def _fallback_activation(payment_id, activate_plan_for_user):
+    """
+    Activate a plan without Mercado Pago verification
+    This helps when payments succeed but the MP API is unavailable
+    """
+    logger.info(f"🔔 [MP_WEBHOOK] Attempting fallback processing without payment verification")
+
+    plan_id = "2"  # Default fallback
+
+    # Look for recent users who might have made this payment
+    user = User.objects.filter(
+        created_at__gte=timezone.now() - timedelta(hours=24),
+        role='free'
+    ).order_by('-created_at').first()
+
+    if not user:
+        logger.error(f"🔔 [MP_WEBHOOK] Fallback: no recent user found for payment {payment_id} - requires MANUAL REVIEW")
+        return 'failed', 'unverified_no_user', 'Payment could not be verified and no candidate user was found'
+
+    logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent user {user.email} who might have made this payment")
+
+    # Try to find the most recent payment record for this user to get the correct plan ID
+    recent_payment = Payment.objects.filter(
+        user=user,
+        created_at__gte=timezone.now() - timedelta(hours=1)
+    ).order_by('-created_at').first()
+
+    if recent_payment and recent_payment.external_plan_id:
+        plan_id = recent_payment.external_plan_id
+        logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent payment with plan ID {plan_id}")
+    elif recent_payment and recent_payment.subscription and recent_payment.subscription.external_plan_id:
+        plan_id = str(recent_payment.subscription.external_plan_id)
+        logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent payment with plan ID {plan_id}")
+    else:
+        recent_sub = Subscription.objects.filter(
+            user=user,
+            created_at__gte=timezone.now() - timedelta(hours=1)
+        ).order_by('-created_at').first()
+        if recent_sub and recent_sub.external_plan_id:
+            plan_id = str(recent_sub.external_plan_id)
+            logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent subscription with plan ID {plan_id}")
+
+    # Log this as a fallback activation for manual review
+    logger.warning(f"🔔 [MP_WEBHOOK] FALLBACK ACTIVATION: Payment {payment_id} could not be verified with MP API, but activating plan {plan_id} for recent user {user.email}")
+
+    # Generate external reference with the determined plan ID (marked for manual review)
+    external_reference = f"plan_subscription_{plan_id}_{user.id}_fallback"
+
+    success, error_msg = activate_plan_for_user(user, payment_id, external_reference, plan_id)
+
+    if success is None:
+        return 'waiting', 'activation_in_progress', None
+
+    if success:
+        logger.info(f"🔔 [MP_WEBHOOK] Fallback activation successful for {user.email} with plan {plan_id}")
+        return 'processed', 'fallback_activated', None
+
+    logger.error(f"🔔 [MP_WEBHOOK] MANUAL REVIEW NEEDED - Payment ID: {payment_id}, User: {user.email}, Plan: {plan_id}")
+    _record_activation_failure(user, payment_id, plan_id, external_reference, error_msg)
+    return 'failed', 'fallback_payment_received_activation_failed', error_msg
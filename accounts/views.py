@@ -10,10 +10,13 @@ from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.contrib.sites.shortcuts import get_current_site
 from django.conf import settings
+from django.db import transaction
 from .models import User
 from .forms import UserRegistrationForm, UserLoginForm, RFCTINForm, PhoneVerificationForm, PhoneCodeVerificationForm
 from gpscontrol4u.models import Form, DataRecord
-from payments.models import Subscription, PricingPlan, Payment, PlanPurchase
+from payments.models import Subscription, PricingPlan, Payment, PlanPurchase, PaymentEvent, WebhookEvent
+from .dashboard import DashboardSnapshot
+from .tasks import enqueue_webhook_event
 import json
 import logging
 import traceback
@@ -26,11 +29,12 @@ from django.views.decorators.http import require_GET
 
 import sys
 import os
-import time
 
 # Add project root to path for external API service
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from external_api_service import external_api
+from plan_catalogue import plan_category as get_plan_category
+from payment_reference import encode_reference, plan_id_from_reference
 from subscription_service import SubscriptionService
 
 # Add Mercado Pago imports
@@ -40,8 +44,11 @@ from django.utils import timezone
 from datetime import timedelta
 import logging
 
-# Initialize Mercado Pago SDK
-mp_sdk = mercadopago.SDK(settings.MERCADO_PAGO_ACCESS_TOKEN)
+from http_client import MercadoPagoHttpClient
+from log_utils import lazy_json, log_fields
+
+# Initialize Mercado Pago SDK on a pooled, keep-alive transport
+mp_sdk = mercadopago.SDK(settings.MERCADO_PAGO_ACCESS_TOKEN, http_client=MercadoPagoHttpClient())
 
 
 class HomeView(TemplateView):
@@ -267,35 +274,31 @@ def logout_view(request):
 @login_required
 def dashboard_view(request):
     """User dashboard with purchase history and plan tracking"""
+    # Get external API plans (indexed, pre-sorted by price)
+    context = dashboard_context(request.user, external_api.get_plan_index())
+    if not context['external_plans']:
+        messages.warning(request, _('Unable to load current plans from server. Please try again later.'))
+    
+    return render(request, 'dashboard.html', context)
+
+
+def dashboard_context(user, plan_index):
+    """Template context of dashboard.html for a user and a PlanIndex (or None)"""
     logger = logging.getLogger(__name__)
-    user = request.user
     
-    # Get user's subscription (for backward compatibility)
-    try:
-        subscription = Subscription.objects.get(user=user)
-    except Subscription.DoesNotExist:
-        subscription = None
+    # Subscription, purchases, forms, records and totals, cached until they change
+    snapshot = DashboardSnapshot.get(user)
+    has_active_purchases = snapshot.has_active_purchases
     
-    # Get user's plan purchases (new system)
-    user_purchases = PlanPurchase.get_user_purchase_history(user)
-    active_purchases = PlanPurchase.get_user_active_purchases(user)
-    active_plan_ids = PlanPurchase.get_user_active_plan_ids(user)
-    
-    # Get external API plans
-    external_plans = external_api.get_available_plans()
-    if not external_plans:
-        external_plans = []
-        messages.warning(request, _('Unable to load current plans from server. Please try again later.'))
-    else:
-        # Sort plans by price (free first, then ascending by price)
-        external_plans = sorted(external_plans, key=lambda x: float(x.get('price', 0)))
+    # Plans pre-sorted by price (free first)
+    external_plans = plan_index.plans_sorted_by_price() if plan_index else []
     
     # Check if user needs to select a plan
     show_plan_selection = (
         user.rfc_tin and 
         user.external_api_registered and 
         user.can_access_plans and
-        not active_purchases.exists()  # No active purchases
+        not has_active_purchases  # No active purchases
     )
     
     # Show plan information if user has active purchases
@@ -303,105 +306,45 @@ def dashboard_view(request):
         user.rfc_tin and 
         user.external_api_registered and
         user.can_access_plans and
-        active_purchases.exists() and
+        has_active_purchases and
         external_plans
     )
     
-    # Get user's forms (only if they have an active plan)
-    if active_purchases.exists():
-        user_forms = Form.objects.filter(user=user, is_active=True)
-        recent_records = DataRecord.objects.filter(user=user)[:10]
-    else:
-        user_forms = Form.objects.none()
-        recent_records = DataRecord.objects.none()
-        
-    predefined_forms = Form.objects.filter(is_predefined=True, is_active=True)
-    
-    # Prepare purchased plans data with enhanced information
-    user_purchased_plans = set()
-    purchase_details = {}
-    
-    for purchase in user_purchases:
-        plan_id = purchase.external_plan_id
-        user_purchased_plans.add(plan_id)
-        user_purchased_plans.add(int(plan_id) if plan_id.isdigit() else plan_id)
-        
-        # Store detailed purchase information
-        purchase_details[plan_id] = {
-            'purchase': purchase,
-            'is_active': purchase.is_active(),
-            'is_expired': purchase.is_expired(),
-            'days_until_expiration': purchase.days_until_expiration(),
-            'purchase_date': purchase.purchase_date,
-            'activation_date': purchase.activation_date,
-            'expiration_date': purchase.expiration_date,
-            'amount': purchase.amount,
-            'currency': purchase.currency,
-            'status': purchase.status,
-            'plan_category': purchase.plan_category,
-        }
-    
-    # Add current subscription plan for backward compatibility
-    if subscription and subscription.external_plan_id:
-        user_purchased_plans.add(subscription.external_plan_id)
-        try:
-            user_purchased_plans.add(int(subscription.external_plan_id))
-        except (ValueError, TypeError):
-            pass
+    user_purchased_plans = snapshot.purchased_plan_ids
     
     # Debug logging
     logger.info(f"🎯 [DASHBOARD] User {user.email} purchased plans: {user_purchased_plans}")
-    logger.info(f"🎯 [DASHBOARD] Active purchases: {len(active_purchases)}")
-    
-    # Ensure all plan IDs are properly represented
-    normalized_purchased_plans = set()
-    for plan_id in user_purchased_plans:
-        normalized_purchased_plans.add(plan_id)
-        try:
-            # Add both string and integer versions
-            if isinstance(plan_id, str) and plan_id.isdigit():
-                normalized_purchased_plans.add(int(plan_id))
-            normalized_purchased_plans.add(str(plan_id))
-        except (ValueError, TypeError):
-            pass
-    
-    user_purchased_plans = normalized_purchased_plans
-    logger.info(f"🎯 [DASHBOARD] Normalized purchased plans: {user_purchased_plans}")
-    
-    # Calculate total spent
-    total_spent = sum(purchase.amount for purchase in user_purchases)
-    
-    # Calculate user totals from all active purchases using model properties
-    total_admin_users = sum(purchase.admin_users_quantity for purchase in active_purchases)
-    total_subscribed_users = sum(purchase.subscribed_users_quantity for purchase in active_purchases)
-    total_users = total_admin_users + total_subscribed_users
+    logger.info(f"🎯 [DASHBOARD] Active purchases: {len(snapshot.active_purchases)}")
     
     context = {
         'user': user,
-        'subscription': subscription,  # For backward compatibility
-        'user_forms': user_forms,
-        'predefined_forms': predefined_forms,
-        'recent_records': recent_records,
-        'total_forms': user_forms.count(),
-        'total_records': recent_records.count() if active_purchases.exists() else 0,
+        'subscription': snapshot.subscription,  # For backward compatibility
+        'user_forms': snapshot.user_forms,
+        'predefined_forms': snapshot.predefined_forms,
+        'recent_records': snapshot.recent_records,
+        'total_forms': len(snapshot.user_forms),
+        'total_records': len(snapshot.recent_records),
         'show_plan_selection': show_plan_selection,
         'show_plan_info': show_plan_info,
         'external_plans': external_plans,
         'user_purchased_plans': user_purchased_plans,
         # New purchase-related context
-        'user_purchases': user_purchases,
-        'active_purchases': active_purchases,
-        'active_plan_ids': active_plan_ids,
-        'purchase_details': purchase_details,
-        'has_free_plan': PlanPurchase.user_has_free_plan(user),
-        'total_spent': total_spent,
+        'user_purchases': snapshot.purchases,
+        'active_purchases': snapshot.active_purchases,
+        'active_plan_ids': snapshot.active_plan_ids,
+        'purchase_details': snapshot.purchase_details,
+        'has_free_plan': snapshot.has_free_plan,
+        'total_spent': snapshot.total_spent,
         # User totals
-        'total_users': total_users,
-        'total_admin_users': total_admin_users,
-        'total_subscribed_users': total_subscribed_users,
+        'total_users': snapshot.total_users,
+        'total_admin_users': snapshot.total_admin_users,
+        'total_subscribed_users': snapshot.total_subscribed_users,
+        # Template fragment cache keys
+        'plan_catalogue_version': plan_index.version if plan_index else None,
+        'dashboard_version': snapshot.version,
     }
     
-    return render(request, 'dashboard.html', context)
+    return context
 
 
 @login_required
@@ -434,15 +377,22 @@ def profile_view(request):
 
 def pricing_view(request):
     """Pricing page with purchase history support"""
-    # Get external API plans
-    external_plans = external_api.get_available_plans()
+    # Get external API plans (indexed, pre-sorted by price)
+    context = pricing_context(request.user, external_api.get_plan_index())
+    if not context['external_plans']:
+        messages.warning(request, _('Unable to load current plans from server. Please try again later.'))
+    
+    return render(request, 'pricing.html', context)
+
+
+def pricing_context(user, plan_index):
+    """Template context of pricing.html for a user (possibly anonymous) and a PlanIndex (or None)"""
+    # Plans pre-sorted by price (free first), local pricing plans as fallback
+    external_plans = plan_index.plans_sorted_by_price() if plan_index else []
     if not external_plans:
         plans = PricingPlan.objects.filter(is_active=True).order_by('amount')
-        messages.warning(request, _('Unable to load current plans from server. Please try again later.'))
     else:
         plans = []
-        # Sort plans by price (free first, then ascending by price)
-        external_plans = sorted(external_plans, key=lambda x: float(x.get('price', 0)))
     
     # Check user's setup status and purchase history
     user_has_rfc_tin = False
@@ -452,23 +402,16 @@ def pricing_view(request):
     user_purchased_plans = set()
     active_plan_ids = []
     
-    if request.user.is_authenticated:
-        user_has_rfc_tin = bool(request.user.rfc_tin)
-        user_api_registered = request.user.external_api_registered
-        has_free_plan = PlanPurchase.user_has_free_plan(request.user)
-        user_purchased_plans = set()
-        active_plan_ids = PlanPurchase.get_user_active_plan_ids(request.user)
-        
-        # Get all purchased plans for display logic
-        for purchase in PlanPurchase.get_user_purchase_history(request.user):
-            plan_id = purchase.external_plan_id
-            user_purchased_plans.add(plan_id)
-            user_purchased_plans.add(int(plan_id) if plan_id.isdigit() else plan_id)
+    if user.is_authenticated:
+        user_has_rfc_tin = bool(user.rfc_tin)
+        user_api_registered = user.external_api_registered
         
-        try:
-            current_subscription = Subscription.objects.get(user=request.user)
-        except Subscription.DoesNotExist:
-            current_subscription = None
+        # Same cached snapshot as the dashboard
+        snapshot = DashboardSnapshot.get(user)
+        has_free_plan = snapshot.has_free_plan
+        user_purchased_plans = snapshot.purchased_plan_ids
+        active_plan_ids = snapshot.active_plan_ids
+        current_subscription = snapshot.subscription
     
     context = {
         'plans': plans,
@@ -481,9 +424,10 @@ def pricing_view(request):
         'has_free_plan': has_free_plan,
         'user_purchased_plans': user_purchased_plans,
         'active_plan_ids': active_plan_ids,
+        'plan_catalogue_version': plan_index.version if plan_index else None,
     }
     
-    return render(request, 'pricing.html', context)
+    return context
 
 
 def set_language(request):
@@ -706,8 +650,6 @@ def setup_account_view(request):
     return render(request, 'accounts/setup_account.html', context)
 
 
-@login_required
-@require_http_methods(["POST"])
 @login_required
 @require_http_methods(["POST"])
 def activate_plan(request):
@@ -720,25 +662,12 @@ def activate_plan(request):
         plan_type = data.get('plan_type')
         external_plan_id = data.get('external_plan_id', 1)  # Default to plan 1 (free)
         
-        logger.info(f"🎯 [ACTIVATE_PLAN] Plan activation started")
-        logger.info(f"🎯 [ACTIVATE_PLAN] User: {request.user.email}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] Plan Type: {plan_type}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] External Plan ID: {external_plan_id}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] Request data: {json.dumps(data, indent=2)}")
-        
-        # Get available plans from external API to validate the plan
-        from external_api_service import ExternalAPIService
-        external_api = ExternalAPIService()
-        available_plans = external_api.get_available_plans()
+        log_fields(logger, logging.INFO, "🎯 [ACTIVATE_PLAN] Plan activation started",
+                   user=request.user.email, plan_type=plan_type, external_plan_id=external_plan_id)
+        logger.debug("🎯 [ACTIVATE_PLAN] Request data: %s", lazy_json(data, indent=2))
         
-        # Check if the requested plan exists
-        requested_plan = None
-        if available_plans:
-            for plan in available_plans:
-                # Convert both to string for comparison to handle type mismatches
-                if str(plan.get('id')) == str(external_plan_id):
-                    requested_plan = plan
-                    break
+        # Check the requested plan exists in the external API catalogue
+        requested_plan = external_api.get_plan(external_plan_id)
         
         if not requested_plan:
             logger.error(f"🎯 [ACTIVATE_PLAN] Invalid plan ID: {external_plan_id}")
@@ -884,18 +813,7 @@ def create_mercado_pago_preference(request):
             })
         
         # Get plan details from external API
-        from external_api_service import ExternalAPIService
-        external_api = ExternalAPIService()
-        external_plans = external_api.get_available_plans()
-        
-        # Find the selected plan
-        selected_plan = None
-        if external_plans:
-            for plan in external_plans:
-                # Convert both to string for comparison to handle type mismatches
-                if str(plan.get('id')) == str(plan_id):
-                    selected_plan = plan
-                    break
+        selected_plan = external_api.get_plan(plan_id)
         
         # Fallback plan details if plan not found
         if not selected_plan:
@@ -913,8 +831,8 @@ def create_mercado_pago_preference(request):
         
         logger.info(f"🎯 [MP_PREFERENCE] Selected plan: {plan_name} - ${plan_price} USD")
         
-        # Generate unique external reference with the correct plan ID
-        external_reference = f"plan_subscription_{plan_id}_{user.id}_{timezone.now().strftime('%Y%m%d_%H%M%S')}"
+        # Generate unique signed external reference with the correct plan ID
+        external_reference = encode_reference(plan_id, user.id)
         
         # Always use HTTPS for the configured domain since we're behind Cloudflare
         domain = getattr(settings, 'DOMAIN', 'mp.armaddia.lat')
@@ -986,18 +904,31 @@ def create_mercado_pago_preference(request):
             "expiration_date_to": (timezone.now() + timedelta(hours=24)).isoformat()
         }
         
-        logger.info(f"🎯 [MP_PREFERENCE] Creating preference with data: {json.dumps(preference_data, indent=2)}")
+        logger.debug("🎯 [MP_PREFERENCE] Creating preference with data: %s", lazy_json(preference_data, indent=2))
         
         # Create preference
         preference_response = mp_sdk.preference().create(preference_data)
         
         if preference_response["status"] == 201:
             preference = preference_response["response"]
-            logger.info(f"🎯 [MP_PREFERENCE] Preference created successfully: {preference['id']}")
-            logger.info(f"🎯 [MP_PREFERENCE] Available URLs:")
-            logger.info(f"🎯 [MP_PREFERENCE]   init_point: {preference.get('init_point', 'N/A')}")
-            logger.info(f"🎯 [MP_PREFERENCE]   sandbox_init_point: {preference.get('sandbox_init_point', 'N/A')}")
-            logger.info(f"🎯 [MP_PREFERENCE]   SANDBOX setting: {settings.MERCADO_PAGO_SANDBOX}")
+            log_fields(logger, logging.INFO, "🎯 [MP_PREFERENCE] Preference created",
+                       preference_id=preference['id'], init_point=preference.get('init_point', 'N/A'),
+                       sandbox_init_point=preference.get('sandbox_init_point', 'N/A'),
+                       sandbox=settings.MERCADO_PAGO_SANDBOX)
+            
+            # Record the checkout so the webhook resolves user and plan by reference
+            Payment.objects.create(
+                user=user,
+                payment_provider='mercado_pago',
+                payment_type='subscription',
+                amount=plan_price,
+                currency='MXN',
+                status='pending',
+                external_reference=external_reference,
+                external_plan_id=str(plan_id),
+                description=f'{plan_name} - Plan ID {plan_id}',
+                metadata={'preference_id': preference['id']}
+            )
             
             # Store preference info in session for later validation
             request.session['mp_preference_id'] = preference['id']
@@ -1032,7 +963,7 @@ def create_mercado_pago_preference(request):
                 'preference_id': preference['id']
             })
         else:
-            logger.error(f"🎯 [MP_PREFERENCE] Failed to create preference: {preference_response}")
+            logger.error("🎯 [MP_PREFERENCE] Failed to create preference: %s", lazy_json(preference_response))
             return JsonResponse({
                 'success': False,
                 'message': 'Failed to create payment preference'
@@ -1067,6 +998,9 @@ def payment_success(request):
     
     # Verify payment with Mercado Pago API
     if payment_id:
+        # Extract plan ID from external reference
+        plan_id = plan_id_from_reference(external_reference)
+        
         try:
             payment_response = mp_sdk.payment().get(payment_id)
             
@@ -1074,34 +1008,13 @@ def payment_success(request):
                 payment_data = payment_response["response"]
                 
                 if payment_data['status'] == 'approved' and payment_data['status_detail'] == 'accredited':
-                    # Extract plan ID from external reference
-                    plan_id = 2  # Default fallback
-                    if external_reference and (external_reference.startswith('premium_subscription_') or external_reference.startswith('plan_subscription_')):
-                        try:
-                            ref_parts = external_reference.split('_')
-                            
-                            # Check if this is new format by looking for reasonable plan_id and user_id
-                            if len(ref_parts) >= 5:
-                                potential_plan_id = ref_parts[2]
-                                potential_user_id = ref_parts[3]
-                                
-                                # If both are numeric and plan_id is reasonable (1-10), it's likely new format
-                                if (potential_plan_id.isdigit() and potential_user_id.isdigit() and 
-                                    1 <= int(potential_plan_id) <= 10):
-                                    plan_id = int(potential_plan_id)
-                                else:
-                                    # Fallback to default
-                                    plan_id = 2
-                            elif len(ref_parts) >= 3:  # Old format without plan_id
-                                plan_id = 2  # Default for old references
-                        except (ValueError, IndexError):
-                            plan_id = 2  # Fallback on error
-                    
                     # Payment is approved, activate plan
                     success, error_msg = activate_plan_for_user(request.user, payment_id, external_reference, plan_id)
                     
                     if success:
                         messages.success(request, _('Payment successful! Your plan has been activated.'))
+                    elif success is None:
+                        messages.info(request, _('Payment received! Your plan is being activated and will be available in a moment.'))
                     else:
                         messages.error(request, _('Payment received but there was an error activating your plan. Please contact support.'))
                 else:
@@ -1111,29 +1024,6 @@ def payment_success(request):
                 # This often happens with sandbox payments that become unavailable quickly
                 logger.warning(f"🎯 [MP_SUCCESS] Could not verify payment {payment_id}, but processing as successful due to success callback")
                 
-                # Extract plan ID from external reference since we can't verify through API
-                plan_id = 2  # Default fallback
-                if external_reference and (external_reference.startswith('premium_subscription_') or external_reference.startswith('plan_subscription_')):
-                    try:
-                        ref_parts = external_reference.split('_')
-                        
-                        # Check if this is new format by looking for reasonable plan_id and user_id
-                        if len(ref_parts) >= 5:
-                            potential_plan_id = ref_parts[2]
-                            potential_user_id = ref_parts[3]
-                            
-                            # If both are numeric and plan_id is reasonable (1-10), it's likely new format
-                            if (potential_plan_id.isdigit() and potential_user_id.isdigit() and 
-                                1 <= int(potential_plan_id) <= 10):
-                                plan_id = int(potential_plan_id)
-                            else:
-                                # Fallback to default
-                                plan_id = 2
-                        elif len(ref_parts) >= 3:  # Old format without plan_id
-                            plan_id = 2  # Default for old references
-                    except (ValueError, IndexError):
-                        plan_id = 2  # Fallback on error
-                
                 logger.info(f"🎯 [MP_SUCCESS] Extracted plan ID {plan_id} from external reference, proceeding with activation")
                 
                 # Activate plan even though we couldn't verify payment details
@@ -1141,6 +1031,8 @@ def payment_success(request):
                 
                 if success:
                     messages.success(request, _('Payment successful! Your plan has been activated.'))
+                elif success is None:
+                    messages.info(request, _('Payment received! Your plan is being activated and will be available in a moment.'))
                 else:
                     messages.error(request, _('Payment received but there was an error activating your plan. Please contact support.'))
                 
@@ -1150,29 +1042,6 @@ def payment_success(request):
             # Even if verification fails, try to activate plan since we're on success callback
             logger.warning(f"🎯 [MP_SUCCESS] Payment verification failed with error, but attempting activation due to success callback")
             
-            # Extract plan ID from external reference
-            plan_id = 2  # Default fallback
-            if external_reference and (external_reference.startswith('premium_subscription_') or external_reference.startswith('plan_subscription_')):
-                try:
-                    ref_parts = external_reference.split('_')
-                    
-                    # Check if this is new format by looking for reasonable plan_id and user_id
-                    if len(ref_parts) >= 5:
-                        potential_plan_id = ref_parts[2]
-                        potential_user_id = ref_parts[3]
-                        
-                        # If both are numeric and plan_id is reasonable (1-10), it's likely new format
-                        if (potential_plan_id.isdigit() and potential_user_id.isdigit() and 
-                            1 <= int(potential_plan_id) <= 10):
-                            plan_id = int(potential_plan_id)
-                        else:
-                            # Fallback to default
-                            plan_id = 2
-                    elif len(ref_parts) >= 3:  # Old format without plan_id
-                        plan_id = 2  # Default for old references
-                except (ValueError, IndexError):
-                    plan_id = 2  # Fallback on error
-            
             logger.info(f"🎯 [MP_SUCCESS] Attempting fallback activation with plan ID {plan_id}")
             
             # Try to activate plan as fallback
@@ -1180,6 +1049,8 @@ def payment_success(request):
             
             if success:
                 messages.success(request, _('Payment successful! Your plan has been activated.'))
+            elif success is None:
+                messages.info(request, _('Payment received! Your plan is being activated and will be available in a moment.'))
             else:
                 messages.warning(request, _('Payment received but please contact support to ensure your plan is activated.'))
     
@@ -1203,209 +1074,47 @@ def payment_pending(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def mercado_pago_webhook(request):
-    """Handle Mercado Pago webhook notifications with improved error handling"""
+    """
+    Handle Mercado Pago webhook notifications
+    The notification is validated and persisted, then processed by a
+    background worker (accounts.tasks) so Mercado Pago gets an immediate 200.
+    """
     import logging
     logger = logging.getLogger(__name__)
     
     try:
         data = json.loads(request.body.decode('utf-8'))
-        logger.info(f"🔔 [MP_WEBHOOK] Received webhook: {json.dumps(data, indent=2)}")
-        
-        # Validate webhook data
-        if data.get('type') == 'payment':
-            payment_id = data.get('data', {}).get('id')
-            
-            if payment_id:
-                logger.info(f"🔔 [MP_WEBHOOK] Processing payment ID: {payment_id}")
-                
-                # Check if this payment was already processed
-                existing_payment = Payment.objects.filter(mercado_pago_payment_id=payment_id).first()
-                if existing_payment:
-                    logger.info(f"🔔 [MP_WEBHOOK] Payment {payment_id} already processed, skipping")
-                    return JsonResponse({'status': 'already_processed'})
-                
-                # Try to get payment details from Mercado Pago with retry logic
-                payment_data = None
-                max_retries = 3
-                retry_delay = 2  # seconds
-                
-                for attempt in range(max_retries):
-                    try:
-                        payment_response = mp_sdk.payment().get(payment_id)
-                        
-                        if payment_response["status"] == 200:
-                            payment_data = payment_response["response"]
-                            logger.info(f"🔔 [MP_WEBHOOK] Payment data retrieved successfully on attempt {attempt + 1}")
-                            break
-                        else:
-                            logger.warning(f"🔔 [MP_WEBHOOK] Attempt {attempt + 1}: Failed to get payment details: {payment_response}")
-                            if attempt < max_retries - 1:
-                                time.sleep(retry_delay)
-                                retry_delay *= 2  # Exponential backoff
-                    except Exception as api_error:
-                        logger.warning(f"🔔 [MP_WEBHOOK] Attempt {attempt + 1}: API error: {api_error}")
-                        if attempt < max_retries - 1:
-                            time.sleep(retry_delay)
-                            retry_delay *= 2
-                
-                if payment_data:
-                    external_reference = payment_data.get('external_reference')
-                    
-                    logger.info(f"🔔 [MP_WEBHOOK] Payment data retrieved successfully")
-                    logger.info(f"🔔 [MP_WEBHOOK] Status: {payment_data.get('status')}")
-                    logger.info(f"🔔 [MP_WEBHOOK] External reference: {external_reference}")
-                    
-                    # Find user by external reference
-                    if external_reference and (external_reference.startswith('premium_subscription_') or external_reference.startswith('plan_subscription_')):
-                        try:
-                            # New format: plan_subscription_{plan_id}_{user_id}_{timestamp}
-                            # Legacy format: premium_subscription_{plan_id}_{user_id}_{timestamp}
-                            # Old format: premium_subscription_{user_id}_{timestamp}
-                            ref_parts = external_reference.split('_')
-                            
-                            # Check if this is new format by looking for reasonable plan_id and user_id
-                            if len(ref_parts) >= 5:
-                                potential_plan_id = ref_parts[2]
-                                potential_user_id = ref_parts[3]
-                                
-                                # If both are numeric and plan_id is reasonable (1-10), it's likely new format
-                                if (potential_plan_id.isdigit() and potential_user_id.isdigit() and 
-                                    1 <= int(potential_plan_id) <= 10):
-                                    plan_id = potential_plan_id
-                                    user_id = potential_user_id
-                                    logger.info(f"🔔 [MP_WEBHOOK] New format - Plan ID: {plan_id}, User ID: {user_id}")
-                                else:
-                                    # Fallback to old format interpretation
-                                    user_id = ref_parts[2]
-                                    plan_id = "2"  # Default to plan 2 for old references
-                                    logger.info(f"🔔 [MP_WEBHOOK] Old format (5+ parts) - User ID: {user_id}, Default Plan ID: {plan_id}")
-                            elif len(ref_parts) >= 3:  # Old format without plan_id
-                                user_id = ref_parts[2]
-                                plan_id = "2"  # Default to plan 2 for old references
-                                logger.info(f"🔔 [MP_WEBHOOK] Old format - User ID: {user_id}, Default Plan ID: {plan_id}")
-                            else:
-                                raise ValueError("Invalid external reference format")
-                            
-                            user = User.objects.get(id=user_id)
-                            
-                            logger.info(f"🔔 [MP_WEBHOOK] Found user: {user.email} (ID: {user.id}) for plan: {plan_id}")
-                            
-                            if payment_data['status'] == 'approved' and payment_data['status_detail'] == 'accredited':
-                                # Activate plan for user with correct plan ID
-                                logger.info(f"🔔 [MP_WEBHOOK] Payment approved, activating plan {plan_id} for user {user.email}")
-                                success, error_msg = activate_plan_for_user(user, payment_id, external_reference, plan_id)
-                                logger.info(f"🔔 [MP_WEBHOOK] Plan activation result: {success}")
-                                logger.info(f"🔔 [MP_WEBHOOK] Error message: {error_msg}")
-                                
-                                if success:
-                                    return JsonResponse({'status': 'plan_activated'})
-                                else:
-                                    # Log activation failure but don't return 500 to prevent MP retries
-                                    # This could be due to corrupted RFC, API issues, etc.
-                                    logger.error(f"🔔 [MP_WEBHOOK] Plan activation failed for user {user.email} - payment was successful but external API activation failed")
-                                    logger.error(f"🔔 [MP_WEBHOOK] This requires MANUAL REVIEW - Payment ID: {payment_id}, User: {user.email}, Plan: {plan_id}")
-                                    
-                                    # Return success to MP to prevent retries, but flag for manual review
-                                    return JsonResponse({
-                                        'status': 'payment_received_activation_failed',
-                                        'message': 'Payment processed but activation failed - requires manual review',
-                                        'payment_id': payment_id,
-                                        'user_id': user.id,
-                                        'plan_id': plan_id
-                                    })
-                            else:
-                                logger.info(f"🔔 [MP_WEBHOOK] Payment not approved yet (status: {payment_data['status']}, detail: {payment_data.get('status_detail')})")
-                            
-                        except (User.DoesNotExist, IndexError, ValueError) as e:
-                            logger.error(f"🔔 [MP_WEBHOOK] Could not find user from reference {external_reference}: {e}")
-                            return JsonResponse({'status': 'user_not_found'}, status=400)
-                    else:
-                        logger.warning(f"🔔 [MP_WEBHOOK] Invalid or missing external reference: {external_reference}")
-                        
-                else:
-                    logger.error(f"🔔 [MP_WEBHOOK] Failed to get payment details after {max_retries} attempts")
-                    
-                    # FALLBACK: Try to process webhook even if MP API fails
-                    # This helps when payments succeed but MP API is temporarily unavailable
-                    logger.info(f"🔔 [MP_WEBHOOK] Attempting fallback processing without payment verification")
-                    
-                    # Try to extract user from webhook data or recent preferences
-                    # This is a workaround for API issues
-                    user = None
-                    plan_id = "2"  # Default fallback
-                    
-                    # Look for recent users who might have made this payment
-                    recent_users = User.objects.filter(
-                        created_at__gte=timezone.now() - timedelta(hours=24),
-                        role='free'
-                    ).order_by('-created_at')
-                    
-                    if recent_users.exists():
-                        user = recent_users.first()
-                        logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent user {user.email} who might have made this payment")
-                        
-                        # Try to find the most recent payment record for this user to get the correct plan ID
-                        recent_payment = Payment.objects.filter(
-                            user=user,
-                            created_at__gte=timezone.now() - timedelta(hours=1)
-                        ).order_by('-created_at').first()
-                        
-                        # Payment model doesn't have external_plan_id, so we need to get it from subscription
-                        if recent_payment and recent_payment.subscription and recent_payment.subscription.external_plan_id:
-                            plan_id = str(recent_payment.subscription.external_plan_id)
-                            logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent payment with plan ID {plan_id}")
-                        else:
-                            # Try to extract plan ID from query parameters or recent preferences
-                            # This is a last resort to get the correct plan ID
-                            try:
-                                # Look for recent external references that might contain the plan ID
-                                recent_subscriptions = Subscription.objects.filter(
-                                    user=user,
-                                    created_at__gte=timezone.now() - timedelta(hours=1)
-                                ).order_by('-created_at')
-                                
-                                if recent_subscriptions.exists():
-                                    recent_sub = recent_subscriptions.first()
-                                    if recent_sub.external_plan_id:
-                                        plan_id = str(recent_sub.external_plan_id)
-                                        logger.info(f"🔔 [MP_WEBHOOK] Fallback: Found recent subscription with plan ID {plan_id}")
-                            except:
-                                pass
-                        
-                        # Log this as a fallback activation for manual review
-                        logger.warning(f"🔔 [MP_WEBHOOK] FALLBACK ACTIVATION: Payment {payment_id} could not be verified with MP API, but activating plan {plan_id} for recent user {user.email}")
-                        
-                        # Generate external reference with the determined plan ID
-                        external_reference = f"plan_subscription_{plan_id}_{user.id}_fallback"
-                        
-                        # Activate plan with the determined plan ID
-                        success, error_msg = activate_plan_for_user(user, payment_id, external_reference, plan_id)
-                        logger.info(f"🔔 [MP_WEBHOOK] Fallback activation error message: {error_msg}")
-                        
-                        if success:
-                            logger.info(f"🔔 [MP_WEBHOOK] Fallback activation successful for {user.email} with plan {plan_id}")
-                            return JsonResponse({'status': 'fallback_activated'})
-                        else:
-                            # Log fallback failure but don't return 500 to prevent MP retries
-                            logger.error(f"🔔 [MP_WEBHOOK] Fallback activation failed for {user.email} - requires MANUAL REVIEW")
-                            logger.error(f"🔔 [MP_WEBHOOK] MANUAL REVIEW NEEDED - Payment ID: {payment_id}, User: {user.email}, Plan: {plan_id}")
-                            
-                            # Return success to MP to prevent retries, but flag for manual review
-                            return JsonResponse({
-                                'status': 'fallback_payment_received_activation_failed',
-                                'message': 'Fallback payment processed but activation failed - requires manual review',
-                                'payment_id': payment_id,
-                                'user_id': user.id,
-                                'plan_id': plan_id
-                            })
-        
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        logger.error(f"🔔 [MP_WEBHOOK] Invalid webhook body: {e}")
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+    
+    if not isinstance(data, dict) or data.get('type') != 'payment':
         return JsonResponse({'status': 'ok'})
-        
-    except Exception as e:
-        logger.error(f"🔔 [MP_WEBHOOK] Critical error processing webhook: {e}")
-        import traceback
-        logger.error(f"🔔 [MP_WEBHOOK] Traceback: {traceback.format_exc()}")
-        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    payment_id = (data.get('data') or {}).get('id')
+    if not payment_id:
+        return JsonResponse({'status': 'ok'})
+    
+    logger.info(f"🔔 [MP_WEBHOOK] Received notification for payment ID: {payment_id}")
+    
+    # The unique (provider, payment_id) index makes repeated notifications
+    # idempotent: the first delivery is a single insert, repeats hit the index
+    event = WebhookEvent.claim('mercado_pago', payment_id, 'payment', data)
+    
+    if event is None:
+        # Mercado Pago notifies again when a payment changes state, so only
+        # events still waiting for approval (or failed) are processed again
+        reopened = WebhookEvent.objects.filter(
+            provider='mercado_pago', payment_id=str(payment_id),
+            status__in=WebhookEvent.REOPENABLE_STATUSES
+        ).update(status='pending', payload=data, updated_at=timezone.now())
+        if not reopened:
+            logger.info(f"🔔 [MP_WEBHOOK] Payment {payment_id} already received, skipping")
+            return JsonResponse({'status': 'already_processed'})
+        event = WebhookEvent.objects.get(provider='mercado_pago', payment_id=str(payment_id))
+    
+    enqueue_webhook_event(event)
+    return JsonResponse({'status': 'queued'})
 
 
 @login_required
@@ -1454,54 +1163,64 @@ def get_credentials(request):
 
 
 def activate_plan_for_user(user, payment_id, external_reference, plan_id=1):
+    """
+    Activate any plan for a user after successful payment or for free plans
+    A Mercado Pago payment activates a plan only once: the webhook worker and
+    the success callback both claim the payment in the PaymentEvent ledger
+    and only the one holding the claim performs the activation.
+    
+    Returns:
+        tuple: (success, error_message), where success is None while another
+        worker is still activating the payment
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    if not payment_id:
+        return _activate_plan_for_user(user, payment_id, external_reference, plan_id)
+    
+    if not PaymentEvent.claim('mercado_pago', payment_id, 'activation', user=user,
+                              metadata={'external_reference': external_reference, 'plan_id': str(plan_id)}):
+        if PaymentEvent.is_completed('mercado_pago', payment_id, 'activation'):
+            logger.info(f"🎯 [ACTIVATE_PLAN] Payment {payment_id} already activated, skipping")
+            return True, None
+        logger.info(f"🎯 [ACTIVATE_PLAN] Payment {payment_id} is being activated by another worker")
+        return None, "Plan activation in progress"
+    
+    success, error_msg = _activate_plan_for_user(user, payment_id, external_reference, plan_id)
+    if not success:
+        # Let a later webhook retry or manual review activate it
+        PaymentEvent.release('mercado_pago', payment_id, 'activation')
+    return success, error_msg
+
+
+def _activate_plan_for_user(user, payment_id, external_reference, plan_id=1):
     """Activate any plan for a user after successful payment or for free plans using PlanPurchase model"""
     import logging
     logger = logging.getLogger(__name__)
     
     try:
-        logger.info(f"🎯 [ACTIVATE_PLAN] Activating plan for user: {user.email}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] Payment ID: {payment_id}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] External Reference: {external_reference}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] Plan ID: {plan_id}")
+        log_fields(logger, logging.INFO, "🎯 [ACTIVATE_PLAN] Activating plan",
+                   user=user.email, payment_id=payment_id, external_reference=external_reference, plan_id=plan_id)
         
         # Get plan details from external API
-        from external_api_service import ExternalAPIService
-        external_api = ExternalAPIService()
-        external_plans = external_api.get_available_plans()
-        
-        # Find the plan details
-        selected_plan = None
-        if external_plans:
-            for plan in external_plans:
-                if str(plan.get('id')) == str(plan_id):
-                    selected_plan = plan
-                    break
+        selected_plan = external_api.get_plan(plan_id)
         
         if not selected_plan:
             logger.error(f"🎯 [ACTIVATE_PLAN] Plan {plan_id} not found in external API")
-            return False
+            return False, f"Plan {plan_id} not found"
         
         plan_name = selected_plan.get('name', f'Plan {plan_id}')
         plan_price = float(selected_plan.get('price', 0))
         is_free_plan = plan_price == 0
         
-        logger.info(f"🎯 [ACTIVATE_PLAN] Plan details:")
-        logger.info(f"🎯 [ACTIVATE_PLAN]   Name: {plan_name}")
-        logger.info(f"🎯 [ACTIVATE_PLAN]   Price: {plan_price}")
-        logger.info(f"🎯 [ACTIVATE_PLAN]   Is Free: {is_free_plan}")
+        log_fields(logger, logging.INFO, "🎯 [ACTIVATE_PLAN] Plan details",
+                   name=plan_name, price=plan_price, is_free=is_free_plan)
         
         # Check free plan restriction - only allow one free plan per user
         if is_free_plan and PlanPurchase.user_has_free_plan(user):
             logger.warning(f"🎯 [ACTIVATE_PLAN] User {user.email} already has a free plan")
-            return False
-        
-        # Determine plan category based on plan characteristics
-        if is_free_plan:
-            plan_category = 'free'
-        elif 'team' in plan_name.lower() or 'equipo' in plan_name.lower():
-            plan_category = 'team'
-        else:
-            plan_category = 'license'
+            return False, "User already has a free plan"
         
         # Initialize subscription service for external API
         subscription_service = SubscriptionService()
@@ -1509,9 +1228,8 @@ def activate_plan_for_user(user, payment_id, external_reference, plan_id=1):
         # Determine if this should be a new client based on external API registration status
         # If user has no credentials stored, treat as new client to register them first
         is_new_client = not bool(user.external_api_password)
-        logger.info(f"🎯 [ACTIVATE_PLAN] Is new client: {is_new_client}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] User external_api_registered: {user.external_api_registered}")
-        logger.info(f"🎯 [ACTIVATE_PLAN] User has existing password: {bool(user.external_api_password)}")
+        log_fields(logger, logging.INFO, "🎯 [ACTIVATE_PLAN] Creating external subscription",
+                   is_new_client=is_new_client, external_api_registered=user.external_api_registered)
         
         # Create subscription via external API using the specified plan ID
         success, api_data, error_message = subscription_service.create_subscription(
@@ -1521,112 +1239,144 @@ def activate_plan_for_user(user, payment_id, external_reference, plan_id=1):
         )
         
         if success:
-            # Update user model
-            if is_free_plan:
-                user.role = 'free'
-            else:
-                if selected_plan.get('is_premium', False):
-                    user.role = 'premium'
-                else:
-                    user.role = 'paid'
-            
-            # Always update credentials if they come from API (first time or updates)
-            if not user.external_api_registered:
-                # First time registration - save all credentials
-                user.external_api_username = api_data['username']
-                user.external_api_password = api_data['password']
-                user.external_client_id = api_data['client_id']
-                user.external_user_id = api_data['user_id']
-                user.external_licenses = api_data['licenses']
-                user.external_api_registered = True
-            else:
-                # Subsequent purchases - only update licenses (keep original credentials)
-                user.external_licenses = api_data['licenses']
-            user.save()
-            
-            # Create payment record if there's an actual payment
-            payment_record = None
-            if payment_id or not is_free_plan:
-                payment_record = Payment.objects.create(
-                    user=user,
-                    payment_provider='mercado_pago' if payment_id else 'internal',
-                    payment_type='subscription',
-                    amount=plan_price,
-                    currency='USD',
-                    status='completed',
-                    mercado_pago_payment_id=payment_id if payment_id else None,
-                    description=f'{plan_name} - Plan ID {plan_id}',
-                    metadata={
-                        'external_reference': external_reference,
-                        'api_data': api_data,
-                        'plan_id': plan_id,
-                        'is_free_plan': is_free_plan
-                    }
-                )
-            
-            # Create PlanPurchase record
-            plan_purchase = PlanPurchase.objects.create(
-                user=user,
-                external_plan_id=str(plan_id),
-                plan_name=plan_name,
-                plan_category=plan_category,
-                amount=plan_price,
-                currency='USD',
-                status='active',
-                activation_date=timezone.now(),
-                payment=payment_record,
-                external_metadata=selected_plan
-            )
-            
-            # Set expiration for all plans (1 year)
-            # According to external API, both free and paid plans are annual
-            plan_purchase.expiration_date = timezone.now() + timedelta(days=365)
-            plan_purchase.save(update_fields=['expiration_date'])
-            
-            # Maintain backward compatibility - update/create subscription record
-            subscription, created = Subscription.objects.get_or_create(
-                user=user,
-                defaults={
-                    'plan_type': 'free' if is_free_plan else f'plan_{plan_id}',
-                    'status': 'active',
-                    'currency': 'USD',
-                    'amount': plan_price,
-                    'start_date': timezone.now(),
-                    'end_date': timezone.now() + timedelta(days=365),  # All plans expire after 1 year
-                    'external_plan_id': str(plan_id)
-                }
-            )
-            
-            if not created:
-                subscription.plan_type = 'free' if is_free_plan else f'plan_{plan_id}'
-                subscription.status = 'active'
-                subscription.amount = plan_price
-                subscription.start_date = timezone.now()
-                subscription.end_date = timezone.now() + timedelta(days=365)  # All plans expire after 1 year
-                subscription.external_plan_id = str(plan_id)
-                subscription.save()
-            
+            # The ledger is completed together with the local records it vouches for
+            with transaction.atomic():
+                _record_plan_activation(user, payment_id, external_reference, plan_id, selected_plan, api_data)
+                if payment_id:
+                    PaymentEvent.complete('mercado_pago', payment_id, 'activation')
             logger.info(f"🎯 [ACTIVATE_PLAN] Successfully activated {plan_name} for user: {user.email}")
             return True, None
             
         else:
-            logger.error(f"🎯 [ACTIVATE_PLAN] Failed to create external API subscription")
-            logger.error(f"🎯 [ACTIVATE_PLAN] error_message type: {type(error_message)}")
-            logger.error(f"🎯 [ACTIVATE_PLAN] error_message value: '{error_message}'")
-            logger.error(f"🎯 [ACTIVATE_PLAN] User: {user.email}, RFC: {user.rfc_tin}, Plan ID: {plan_id}")
-            logger.error(f"🎯 [ACTIVATE_PLAN] Is new client: {is_new_client}")
-            
-            # Return the actual API error message to the user
-            user_message = error_message if error_message else "Failed to activate plan"
-            logger.error(f"🎯 [ACTIVATE_PLAN] Returning API error message: '{user_message}'")
-            return False, user_message
+            return _activation_failed(user, plan_id, is_new_client, error_message)
             
     except Exception as e:
-        logger.error(f"🎯 [ACTIVATE_PLAN] Error activating plan: {e}")
-        logger.error(f"🎯 [ACTIVATE_PLAN] User: {user.email}, Plan ID: {plan_id}")
-        import traceback
-        logger.error(f"🎯 [ACTIVATE_PLAN] Traceback: {traceback.format_exc()}")
-        return False, f"Error activating plan: {str(e)}"
+        return _activation_error(user, plan_id, e)
+
+
+def _activation_failed(user, plan_id, is_new_client, error_message):
+    """Log a refused external subscription and return the (False, message) result"""
+    logger = logging.getLogger(__name__)
+    
+    # Return the actual API error message to the user
+    user_message = error_message if error_message else "Failed to activate plan"
+    log_fields(logger, logging.ERROR, "🎯 [ACTIVATE_PLAN] Failed to create external API subscription",
+               user=user.email, rfc=user.rfc_tin, plan_id=plan_id, is_new_client=is_new_client,
+               error=user_message)
+    return False, user_message
+
+
+def _activation_error(user, plan_id, e):
+    """Log an unexpected activation error and return the (False, message) result"""
+    logger = logging.getLogger(__name__)
+    
+    log_fields(logger, logging.ERROR, "🎯 [ACTIVATE_PLAN] Error activating plan",
+               user=user.email, plan_id=plan_id, error=str(e))
+    logger.error("🎯 [ACTIVATE_PLAN] Traceback: %s", traceback.format_exc())
+    return False, f"Error activating plan: {str(e)}"
+
+
+def _record_plan_activation(user, payment_id, external_reference, plan_id, selected_plan, api_data):
+    """Save the user, payment, PlanPurchase and Subscription once the external subscription exists"""
+    plan_name = selected_plan.get('name', f'Plan {plan_id}')
+    plan_price = float(selected_plan.get('price', 0))
+    is_free_plan = plan_price == 0
+    plan_category = get_plan_category(selected_plan)
+    
+    # Update user model
+    if is_free_plan:
+        user.role = 'free'
+    else:
+        if selected_plan.get('is_premium', False):
+            user.role = 'premium'
+        else:
+            user.role = 'paid'
+
+    # Always update credentials if they come from API (first time or updates)
+    if not user.external_api_registered:
+        # First time registration - save all credentials
+        user.external_api_username = api_data['username']
+        user.external_api_password = api_data['password']
+        user.external_client_id = api_data['client_id']
+        user.external_user_id = api_data['user_id']
+        user.external_licenses = api_data['licenses']
+        user.external_api_registered = True
+    else:
+        # Subsequent purchases - only update licenses (keep original credentials)
+        user.external_licenses = api_data['licenses']
+    user.save()
+
+    # Create payment record if there's an actual payment, completing
+    # the pending checkout opened for this reference when there is one
+    payment_record = None
+    if payment_id or not is_free_plan:
+        payment_fields = {
+            'payment_provider': 'mercado_pago' if payment_id else 'internal',
+            'payment_type': 'subscription',
+            'amount': plan_price,
+            'currency': 'USD',
+            'status': 'completed',
+            'mercado_pago_payment_id': payment_id if payment_id else None,
+            'external_reference': external_reference,
+            'external_plan_id': str(plan_id),
+            'description': f'{plan_name} - Plan ID {plan_id}',
+            'metadata': {
+                'external_reference': external_reference,
+                'api_data': api_data,
+                'plan_id': plan_id,
+                'is_free_plan': is_free_plan
+            }
+        }
+        payment_record = Payment.pending_for_reference(external_reference)
+        if payment_record and payment_record.user_id == user.id:
+            payment_fields['metadata'] = {**payment_record.metadata, **payment_fields['metadata']}
+            for field, value in payment_fields.items():
+                setattr(payment_record, field, value)
+            payment_record.save()
+        else:
+            payment_record = Payment.objects.create(user=user, **payment_fields)
+
+    # Create PlanPurchase record
+    plan_purchase = PlanPurchase.objects.create(
+        user=user,
+        external_plan_id=str(plan_id),
+        plan_name=plan_name,
+        plan_category=plan_category,
+        amount=plan_price,
+        currency='USD',
+        status='active',
+        activation_date=timezone.now(),
+        payment=payment_record,
+        external_metadata=selected_plan
+    )
+
+    # Set expiration for all plans (1 year)
+    # According to external API, both free and paid plans are annual
+    plan_purchase.expiration_date = timezone.now() + timedelta(days=365)
+    plan_purchase.save(update_fields=['expiration_date'])
+
+    # Maintain backward compatibility - update/create subscription record
+    subscription, created = Subscription.objects.get_or_create(
+        user=user,
+        defaults={
+            'plan_type': 'free' if is_free_plan else f'plan_{plan_id}',
+            'status': 'active',
+            'currency': 'USD',
+            'amount': plan_price,
+            'start_date': timezone.now(),
+            'end_date': timezone.now() + timedelta(days=365),  # All plans expire after 1 year
+            'external_plan_id': str(plan_id)
+        }
+    )
+
+    if not created:
+        subscription.plan_type = 'free' if is_free_plan else f'plan_{plan_id}'
+        subscription.status = 'active'
+        subscription.amount = plan_price
+        subscription.start_date = timezone.now()
+        subscription.end_date = timezone.now() + timedelta(days=365)  # All plans expire after 1 year
+        subscription.external_plan_id = str(plan_id)
+        subscription.save()
 
 
 @csrf_exempt
@@ -1648,18 +1398,7 @@ def get_plan_details(request):
             })
         
         # Get plan details from external API
-        from external_api_service import ExternalAPIService
-        external_api = ExternalAPIService()
-        external_plans = external_api.get_available_plans()
-        
-        # Find the plan details
-        selected_plan = None
-        if external_plans:
-            for plan in external_plans:
-                # Convert both to string for comparison to handle type mismatches
-                if str(plan.get('id')) == str(plan_id):
-                    selected_plan = plan
-                    break
+        selected_plan = external_api.get_plan(plan_id)
         
         if not selected_plan:
             return JsonResponse({
@@ -0,0 +1,231 @@
+"""
+Streaming DataRecord export (NDJSON or CSV, optionally gzipped)
+
+Rows are read in keyset batches of DATA_EXPORT_CHUNK_SIZE ordered by
+(submitted_at, id), and each batch is written to the response before the
+next one is read, so memory does not grow with the number of rows. Django
+has no server-side cursors on MySQL (.iterator() would load the whole
+result set there); a keyset batch is one bounded query on every backend.
+
+CSV columns are the fixed record columns, then the field names of the
+exported forms' form_structure; data_content keys that no form declares
+go to a JSON `extra` column.
+"""
+
+import csv
+import datetime
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.renderers import JSONRenderer
+
+from gpscontrol4u.models import DataRecord, Form
+from payments.models import PricingPlan, Subscription
+
+RECORD_FIELDS = ('id', 'form_id', 'data_content', 'language', 'latitude', 'longitude', 'submitted_at', 'updated_at')
+CSV_COLUMNS = ['id', 'form_id', 'form_name', 'language', 'latitude', 'longitude', 'submitted_at', 'updated_at']
+
+
+def can_export(user):
+    """True if the user's active subscription maps to a pricing plan with export_enabled"""
+    subscription = Subscription.objects.filter(user=user, status='active').values('plan_type', 'currency').first()
+    if subscription is None:
+        return False
+    return PricingPlan.objects.filter(
+        plan_type=subscription['plan_type'], currency=subscription['currency'],
+        is_active=True, export_enabled=True,
+    ).exists()
+
+
+def parse_bound(value, end=False):
+    """
+    datetime for a since/until query parameter (ISO date or datetime)
+
+    A date means the start of that day, or for `end` the start of the next
+    one, so ?until=2025-01-31 includes the 31st. Raises ValueError.
+    """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        if end:
+            day += datetime.timedelta(days=1)
+        moment = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class AnyMediaTypeRenderer(JSONRenderer):
+    """
+    Lets clients ask for text/csv or application/x-ndjson without a 406
+
+    The export returns a StreamingHttpResponse, which is not rendered; only
+    error responses go through this renderer, as JSON.
+    """
+    media_type = '*/*'
+
+
+def form_fields(form_structure):
+    """Field names declared by a form_structure ({"fields": [{"name": ...}, ...]})"""
+    if isinstance(form_structure, str):
+        try:
+            form_structure = json.loads(form_structure)
+        except ValueError:
+            return []
+    fields = form_structure.get('fields', []) if isinstance(form_structure, dict) else []
+    return [field['name'] for field in fields if isinstance(field, dict) and field.get('name')]
+
+
+def iter_records(queryset, chunk_size=None):
+    """
+    Yield lists of record dicts, oldest first, one keyset batch at a time
+
+    Each batch is `WHERE (submitted_at, id) > last row ORDER BY submitted_at,
+    id LIMIT chunk_size`, served by the (user, submitted_at) index.
+    """
+    chunk_size = chunk_size or getattr(settings, 'DATA_EXPORT_CHUNK_SIZE', 2000)
+    queryset = queryset.order_by('submitted_at', 'id').values(*RECORD_FIELDS)
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(
+                Q(submitted_at__gt=last['submitted_at'])
+                | Q(submitted_at=last['submitted_at'], id__gt=last['id'])
+            )
+        batch = list(page[:chunk_size])
+        if not batch:
+            return
+        yield batch
+        if len(batch) < chunk_size:
+            return
+        last = batch[-1]
+
+
+class RecordExport:
+    """
+    Export of one user's records, filtered by forms and a submitted_at range
+
+    Iterate `ndjson()` or `csv()` for the encoded chunks (bytes, one per
+    batch); `gzip(chunks)` compresses them on the fly.
+    """
+
+    def __init__(self, user, form_ids=None, since=None, until=None):
+        queryset = DataRecord.objects.filter(user=user)
+        if form_ids:
+            queryset = queryset.filter(form_id__in=form_ids)
+        if since is not None:
+            queryset = queryset.filter(submitted_at__gte=since)
+        if until is not None:
+            queryset = queryset.filter(submitted_at__lt=until)
+        self.queryset = queryset
+
+        # Only forms the exported records use (never another user's form
+        # passed in ?form=); they are few, unlike the records
+        exported_forms = queryset.order_by().values('form_id').distinct()
+        self.forms = {
+            form['id']: form
+            for form in Form.objects.filter(id__in=exported_forms).order_by('id').values('id', 'form_name', 'form_structure')
+        }
+
+    def _form_name(self, form_id):
+        form = self.forms.get(form_id)
+        return form['form_name'] if form else ''
+
+    def ndjson(self):
+        for batch in iter_records(self.queryset):
+            lines = []
+            for record in batch:
+                lines.append(json.dumps({
+                    'id': record['id'],
+                    'form_id': record['form_id'],
+                    'form_name': self._form_name(record['form_id']),
+                    'language': record['language'],
+                    'latitude': record['latitude'],
+                    'longitude': record['longitude'],
+                    'submitted_at': record['submitted_at'],
+                    'updated_at': record['updated_at'],
+                    'data_content': record['data_content'],
+                }, cls=DjangoJSONEncoder, ensure_ascii=False))
+            yield ('\n'.join(lines) + '\n').encode()
+
+    def columns(self):
+        fields = []
+        seen = set(CSV_COLUMNS) | {'extra'}
+        for form in self.forms.values():
+            for name in form_fields(form['form_structure']):
+                if name not in seen:
+                    seen.add(name)
+                    fields.append(name)
+        return CSV_COLUMNS + fields + ['extra']
+
+    def csv(self):
+        columns = self.columns()
+        data_columns = columns[len(CSV_COLUMNS):-1]
+        buffer = _LineBuffer()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.take().encode()
+
+        for batch in iter_records(self.queryset):
+            for record in batch:
+                values = _flat_values(record['data_content'])
+                row = [
+                    record['id'], record['form_id'], self._form_name(record['form_id']), record['language'],
+                    record['latitude'], record['longitude'],
+                    record['submitted_at'].isoformat(), record['updated_at'].isoformat(),
+                ]
+                row.extend(_cell(values.pop(name, '')) for name in data_columns)
+                row.append(json.dumps(values, default=str, ensure_ascii=False) if values else '')
+                writer.writerow(row)
+            yield buffer.take().encode()
+
+
+def _flat_values(data_content):
+    """data_content as {field: value}; answers nested under "responses" are lifted to the top level"""
+    if not isinstance(data_content, dict):
+        return {'data_content': data_content} if data_content not in (None, '') else {}
+    values = dict(data_content)
+    responses = values.get('responses')
+    if isinstance(responses, dict):
+        del values['responses']
+        values = {**responses, **values}
+    return values
+
+
+def _cell(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    return value
+
+
+class _LineBuffer:
+    """File-like sink for csv.writer that hands back what was written since the last take()"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, value):
+        self.parts.append(value)
+
+    def take(self):
+        text = ''.join(self.parts)
+        self.parts = []
+        return text
+
+
+def gzip(chunks, level=6):
+    """Compress an iterable of bytes into a gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,115 @@
+"""
+Bulk DataRecord ingestion
+
+A batch of submissions is validated with a single serializer instance (no
+queries), the referenced forms are loaded in one query and access is
+checked once per distinct form; each data_content is checked against its
+form's compiled schema (gpscontrol4u/schema.py). The valid records are
+then inserted with bulk_create in chunks of DATA_RECORD_BULK_CHUNK_SIZE,
+together with their delta-sync change log rows.
+
+Every item carries a client_key, unique per user. An item whose key was
+already stored (a retried upload) is not inserted again; its result has
+the stored record's id. Databases that return no ids from bulk inserts
+(MySQL) get them read back by key.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from accounts.dashboard import DashboardSnapshot
+from gpscontrol4u.models import DataRecord, Form, SyncChange
+from gpscontrol4u.schema import validate_data_content
+from .serializers import DataRecordBulkItemSerializer
+
+
+def _error(index, errors):
+    return {'index': index, 'status': 'error', 'errors': errors}
+
+
+def ingest_records(user, items, _retry_attempted=False):
+    """
+    Create DataRecords for `user` from a list of submissions
+
+    Returns one result per item, in order:
+    {'index': i, 'status': 'created', 'id': pk} or
+    {'index': i, 'status': 'error', 'errors': {...}}.
+    """
+    serializer = DataRecordBulkItemSerializer()
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = _error(index, {'non_field_errors': ['Expected a JSON object']})
+            continue
+        try:
+            valid.append((index, serializer.run_validation(item)))
+        except ValidationError as e:
+            results[index] = _error(index, e.detail)
+
+    # Keys stored by an earlier upload, and keys repeated within this one
+    stored = dict(DataRecord.objects.filter(
+        user=user, client_key__in=[data['client_key'] for _index, data in valid]
+    ).values_list('client_key', 'id'))
+    seen = set()
+    unstored = []
+    for index, data in valid:
+        key = data['client_key']
+        if key in stored:
+            results[index] = {'index': index, 'status': 'created', 'id': stored[key]}
+        elif key in seen:
+            results[index] = _error(index, {'client_key': ['Duplicate key in this upload.']})
+        else:
+            seen.add(key)
+            unstored.append((index, data))
+    valid = unstored
+
+    forms = Form.objects.in_bulk({data['form'] for _index, data in valid})
+    access = {form_id: form.can_user_access(user) for form_id, form in forms.items()}
+
+    pending = []
+    for index, data in valid:
+        form_id = data.pop('form')
+        form = forms.get(form_id)
+        if form is None:
+            results[index] = _error(index, {'form': [f'Invalid pk "{form_id}" - object does not exist.']})
+        elif not access[form_id]:
+            results[index] = _error(index, {'form': ["You don't have access to this form"]})
+        else:
+            errors = validate_data_content(form, data['data_content'])
+            if errors:
+                results[index] = _error(index, {'data_content': errors})
+            else:
+                pending.append((index, DataRecord(user=user, form=form, **data)))
+
+    if pending:
+        chunk_size = getattr(settings, 'DATA_RECORD_BULK_CHUNK_SIZE', 100)
+        records = [record for _index, record in pending]
+        try:
+            with transaction.atomic():
+                DataRecord.objects.bulk_create(records, batch_size=chunk_size)
+                if not connection.features.can_return_rows_from_bulk_insert:
+                    # MySQL returns no ids from bulk inserts: read them back by key
+                    ids = dict(DataRecord.objects.filter(
+                        user=user, client_key__in=[record.client_key for record in records]
+                    ).values_list('client_key', 'id'))
+                    for record in records:
+                        record.pk = ids[record.client_key]
+                # bulk_create sends no post_save: log the delta-sync changes here
+                SyncChange.objects.bulk_create(
+                    [SyncChange(user=user, kind='record', object_id=record.pk) for record in records],
+                    batch_size=chunk_size,
+                )
+        except IntegrityError:
+            if _retry_attempted:
+                raise
+            # A concurrent upload stored some of these keys first; the second
+            # pass reports those as stored and inserts the rest
+            return ingest_records(user, items, _retry_attempted=True)
+        # ... and invalidate the dashboard the signal would have invalidated
+        DashboardSnapshot.invalidate(user.pk)
+
+    for index, record in pending:
+        results[index] = {'index': index, 'status': 'created', 'id': record.pk}
+    return results
@@ -0,0 +1,35 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Newline-delimited JSON (one document per line), parsed to a list
+
+    Lines are decoded one at a time and parsing stops after
+    DATA_RECORD_BULK_MAX_ITEMS + 1 documents, so an oversized upload is not
+    held in memory before it is rejected.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return []
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        limit = getattr(settings, 'DATA_RECORD_BULK_MAX_ITEMS', 500)
+        items = []
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line.decode(encoding)))
+            except ValueError as exc:
+                raise ParseError(f'Line {number}: invalid JSON ({exc})')
+            if len(items) > limit:
+                break
+        return items
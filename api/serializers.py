@@ -2,6 +2,7 @@ from rest_framework import serializers
 from django.contrib.auth import authenticate
 from accounts.models import User, UserProfile
 from gpscontrol4u.models import Form, DataRecord, FormTemplate
+from gpscontrol4u.schema import validate_data_content
 from payments.models import Subscription, Payment, PricingPlan
 
 
@@ -94,14 +95,38 @@ class DataRecordSerializer(serializers.ModelSerializer):
     class Meta:
         model = DataRecord
         fields = ('id', 'form', 'form_name', 'data_content', 'language', 
-                 'latitude', 'longitude', 'submitted_at', 'updated_at')
-        read_only_fields = ('id', 'submitted_at', 'updated_at')
+                 'latitude', 'longitude', 'client_key', 'submitted_at', 'updated_at')
+        read_only_fields = ('id', 'client_key', 'submitted_at', 'updated_at')
+    
+    def validate(self, attrs):
+        # Check data_content against the form whenever either of them changes
+        if 'data_content' in attrs or 'form' in attrs:
+            form = attrs.get('form') or self.instance.form
+            request = self.context.get('request')
+            if request and not form.can_user_access(request.user):
+                # Refused before validate_data_content, which would describe the form's fields
+                raise serializers.ValidationError({'form': ["You don't have access to this form"]})
+            data_content = attrs['data_content'] if 'data_content' in attrs else self.instance.data_content
+            errors = validate_data_content(form, data_content)
+            if errors:
+                raise serializers.ValidationError({'data_content': errors})
+        return attrs
     
     def create(self, validated_data):
         validated_data['user'] = self.context['request'].user
         return super().create(validated_data)
 
 
+class DataRecordBulkItemSerializer(serializers.ModelSerializer):
+    """One record of a bulk upload; forms are resolved for the whole batch by api.ingest"""
+    form = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = DataRecord
+        fields = ('client_key', 'form', 'data_content', 'language', 'latitude', 'longitude')
+        extra_kwargs = {'client_key': {'required': True, 'allow_null': False, 'allow_blank': False}}
+
+
 class FormTemplateSerializer(serializers.ModelSerializer):
     can_user_access = serializers.SerializerMethodField()
     
@@ -1,8 +1,16 @@
+import secrets
+
+import metrics_export
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
 from django.urls import path
+from django.views.decorators.http import require_GET
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
+from .views import DataRecordViewSet, PaymentHistoryView, sync_changes
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def health_check(request):
@@ -13,9 +21,41 @@ def health_check(request):
         'version': '1.0.0'
     })
 
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus metrics, summed over all worker processes (see metrics_export.py)
+
+    Requires METRICS_TOKEN as a bearer token; without a configured token
+    the endpoint is only open with DEBUG.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden('METRICS_TOKEN is not configured')
+    elif not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    body = metrics_export.render(metrics_export.collect(), metrics_export.database_gauges())
+    return HttpResponse(body, content_type=metrics_export.CONTENT_TYPE)
+
 app_name = 'api'
 
+# Only the record routes the API clients use: the paginated list, bulk upload
+# and export. Single records are not editable over the API.
+record_list = DataRecordViewSet.as_view({'get': 'list'}, basename='datarecord', detail=False)
+record_bulk = DataRecordViewSet.as_view(
+    {'post': 'bulk'}, basename='datarecord', detail=False, **DataRecordViewSet.bulk.kwargs)
+record_export = DataRecordViewSet.as_view(
+    {'get': 'export'}, basename='datarecord', detail=False, **DataRecordViewSet.export.kwargs)
+
 urlpatterns = [
     # Basic health check
     path('health/', health_check, name='health'),
+    path('metrics/', metrics, name='metrics'),
+    path('payments/', PaymentHistoryView.as_view(), name='payment_history'),
+    path('sync/', sync_changes, name='sync'),
+    path('records/', record_list, name='datarecord-list'),
+    path('records/bulk/', record_bulk, name='datarecord-bulk'),
+    path('records/export/', record_export, name='datarecord-export'),
 ]
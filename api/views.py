@@ -1,6 +1,11 @@
 from django.shortcuts import render
-from rest_framework import generics, permissions, status, viewsets
-from rest_framework.decorators import api_view, permission_classes
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import exceptions, generics, permissions, status, viewsets
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.db.models import Q
@@ -14,6 +19,11 @@ from .serializers import (
 from accounts.models import User, UserProfile
 from gpscontrol4u.models import Form, DataRecord, FormTemplate
 from payments.models import Subscription, Payment, PricingPlan
+from .export import AnyMediaTypeRenderer, RecordExport, can_export, gzip, parse_bound
+from .ingest import ingest_records
+from .pagination import DataRecordPagination, PaymentPagination
+from .parsers import NDJSONParser
+from .sync import changes_since, parse_token
 
 
 class UserRegistrationView(generics.CreateAPIView):
@@ -98,7 +108,7 @@ class FormViewSet(viewsets.ModelViewSet):
         # Check if user can create forms
         if self.request.user.role == 'free':
             # Free users cannot create custom forms
-            raise permissions.PermissionDenied("Upgrade to Premium to create custom forms")
+            raise exceptions.PermissionDenied("Upgrade to Premium to create custom forms")
         
         serializer.save(user=self.request.user)
 
@@ -107,18 +117,109 @@ class DataRecordViewSet(viewsets.ModelViewSet):
     """CRUD operations for data records"""
     serializer_class = DataRecordSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = DataRecordPagination
     
     def get_queryset(self):
-        return DataRecord.objects.filter(user=self.request.user)
+        return DataRecord.objects.filter(user=self.request.user).select_related('form')
     
     def perform_create(self, serializer):
         # Check if user can access the form
         form = serializer.validated_data['form']
         if not form.can_user_access(self.request.user):
-            raise permissions.PermissionDenied("You don't have access to this form")
+            raise exceptions.PermissionDenied("You don't have access to this form")
         
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        # Moving a record to another form needs access to that form too
+        form = serializer.validated_data.get('form')
+        if form is not None and not form.can_user_access(self.request.user):
+            raise exceptions.PermissionDenied("You don't have access to this form")
+
+        serializer.save()
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk(self, request):
+        """
+        Create up to DATA_RECORD_BULK_MAX_ITEMS records from a JSON array or
+        an NDJSON body (Content-Type: application/x-ndjson)
+
+        Valid items are stored even if others fail; the response has one
+        result per item. 201 when all were created, 207 when some were,
+        400 when none were. Each item needs a client_key, unique per user:
+        re-sending a stored key returns the stored record's id instead of
+        a second copy, so a failed upload can be retried as a whole.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return Response({'error': 'Expected a JSON array or NDJSON body'}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = getattr(settings, 'DATA_RECORD_BULK_MAX_ITEMS', 500)
+        if not items:
+            return Response({'error': 'No records in the request'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > max_items:
+            return Response({'error': f'At most {max_items} records per request'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = ingest_records(request.user, items)
+        created = sum(1 for result in results if result['status'] == 'created')
+        if created == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'created': created,
+            'failed': len(results) - created,
+            'results': results,
+        }, status=response_status)
+
+    @action(detail=False, methods=['get'], renderer_classes=[JSONRenderer, AnyMediaTypeRenderer])
+    def export(self, request):
+        """
+        Stream the user's records as NDJSON (default) or CSV (?output=csv)
+
+        Filters: ?form=<id> (repeatable), ?since= and ?until= (ISO date or
+        datetime, on submitted_at). Compressed when the client sends
+        Accept-Encoding: gzip, or as a .gz download with ?gzip=1.
+        Requires a pricing plan with export_enabled.
+        """
+        if not can_export(request.user):
+            raise exceptions.PermissionDenied("Your plan does not include data export")
+
+        output = request.query_params.get('output', 'ndjson')
+        if output not in ('ndjson', 'csv'):
+            return Response({'error': 'output must be ndjson or csv'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            form_ids = [int(value) for value in request.query_params.getlist('form')]
+            since = parse_bound(request.query_params['since']) if request.query_params.get('since') else None
+            until = parse_bound(request.query_params['until'], end=True) if request.query_params.get('until') else None
+        except ValueError:
+            return Response(
+                {'error': 'form must be an id; since and until must be ISO dates or datetimes'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        export = RecordExport(request.user, form_ids=form_ids, since=since, until=until)
+        if output == 'csv':
+            chunks, content_type = export.csv(), 'text/csv; charset=utf-8'
+        else:
+            chunks, content_type = export.ndjson(), 'application/x-ndjson'
+        filename = f"records-{timezone.now():%Y%m%d}.{output}"
+
+        as_file = request.query_params.get('gzip') in ('1', 'true')
+        encode = as_file or 'gzip' in request.headers.get('Accept-Encoding', '')
+        if encode:
+            chunks = gzip(chunks)
+        if as_file:
+            content_type, filename = 'application/gzip', f'{filename}.gz'
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        if encode and not as_file:
+            response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
 
 class FormTemplateViewSet(viewsets.ReadOnlyModelViewSet):
     """Read-only access to form templates"""
@@ -153,6 +254,7 @@ class PaymentHistoryView(generics.ListAPIView):
     """Get user's payment history"""
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = PaymentPagination
     
     def get_queryset(self):
         return Payment.objects.filter(user=self.request.user)
@@ -199,6 +301,22 @@ def link_ios_app(request):
     return Response({'message': 'iOS app linked successfully'})
 
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def sync_changes(request):
+    """
+    Forms, templates and records changed since ?token= (see api/sync.py)
+
+    Without a token every visible object is returned. Keep the returned
+    token for the next call, and call again right away while has_more is true.
+    """
+    try:
+        token = parse_token(request.query_params.get('token'))
+    except ValueError:
+        return Response({'error': 'Invalid sync token'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(changes_since(request, token))
+
+
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
 def health_check(request):
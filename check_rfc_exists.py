@@ -3,13 +3,22 @@
 Check if a specific RFC exists in the external API
 """
 
+import os
+import sys
 import requests
 import json
+import django
 
-BASE_URL = "https://api2ego.elisasoftware.com"
-USERNAME = "AdmGPScontrol4u"
-PASSWORD = "GPSc0ntr0l4u*"
-STORE = "GPScontrol4U"
+# Setup Django so the shared token manager can be used
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'marketplace_backend.settings')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+django.setup()
+
+from django.conf import settings
+from external_api_auth import token_manager
+
+BASE_URL = settings.EXTERNAL_API_BASE_URL
+STORE = settings.EXTERNAL_API_STORE
 
 # The RFC that was failing
 TEST_RFC = "GEOR660529FD2"
@@ -20,21 +29,11 @@ print(f"{'='*80}\n")
 
 # Step 1: Authenticate
 print(f"[1] Authenticating...")
-url = f"{BASE_URL}/login"
-params = {'username': USERNAME, 'password': PASSWORD}
-headers = {'accept': 'application/json'}
-
-response = requests.post(url, params=params, headers=headers, timeout=10)
-if response.status_code == 200:
-    data = response.json()
-    if data.get('code') == 200:
-        token = data['data'].get('token')
-        print(f"✅ Authentication OK\n")
-    else:
-        print(f"❌ Authentication failed")
-        exit(1)
+token = token_manager.get_token()
+if token:
+    print(f"✅ Authentication OK\n")
 else:
-    print(f"❌ Authentication request failed")
+    print(f"❌ Authentication failed")
     exit(1)
 
 # Step 2: Check if RFC exists using licenses endpoint
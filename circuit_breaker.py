@@ -0,0 +1,305 @@
+"""
+Circuit breakers and bulkheads for the ElisaSoftware API
+
+Calls to api2ego are grouped by endpoint family (login, plans, subscription,
+client lookup, phone). Each family has:
+- a circuit breaker: when the failure rate over the last calls crosses the
+  threshold the circuit opens and calls fail immediately; after the reset
+  timeout one probe call is let through (half-open), which closes the
+  circuit on success or re-opens it on failure
+- a bulkhead: at most N calls of the family in flight per process, so a slow
+  endpoint cannot take every worker thread with it
+
+Transport errors, timeouts, 5xx responses other than 503 (which api2ego uses
+for business errors) and calls slower than the slow-call threshold count as
+failures. An opened circuit is published in the Django cache so every worker
+fails fast together. Rejections raise UpstreamUnavailable, a requests
+ConnectionError, so existing `except RequestException` handlers apply.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# (family, path prefix) on EXTERNAL_API_BASE_URL, first match wins
+ENDPOINT_FAMILIES = (
+    ('login', '/login'),
+    ('plans', '/store/plans'),
+    ('subscription', '/store/subscription'),
+    ('client_lookup', '/store/client'),
+    ('phone', '/phone'),
+)
+
+FAILURE_STATUSES = {500, 502, 504}
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """The call was not attempted because the endpoint family is failing or saturated"""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """The circuit of the endpoint family is open"""
+
+
+class BulkheadFullError(UpstreamUnavailable):
+    """Too many calls of the endpoint family are already in flight"""
+
+
+class _Call:
+    """Outcome of one guarded call, filled in by the caller"""
+
+    def __init__(self):
+        self.failed = False
+
+    def check(self, status_code):
+        if status_code in FAILURE_STATUSES:
+            self.failed = True
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker with a concurrency bulkhead for one endpoint family"""
+
+    SHARED_KEY = 'circuit_open:{name}'
+    SHARED_CHECK_INTERVAL = 1  # seconds between reads of the shared open state
+
+    def __init__(self, name, max_concurrent):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._outcomes = deque()
+        self._state = CLOSED
+        self._opened_until = 0
+        self._probe_in_flight = False
+        self._shared_checked_at = 0
+        self._bulkhead = threading.BoundedSemaphore(max_concurrent)
+
+    def resize(self, max_concurrent):
+        """Change the bulkhead size; only call while no call of the family is in flight"""
+        self.max_concurrent = max_concurrent
+        self._bulkhead = threading.BoundedSemaphore(max_concurrent)
+
+    @property
+    def failure_rate_threshold(self):
+        return getattr(settings, 'CIRCUIT_BREAKER_FAILURE_RATE', 0.5)
+
+    @property
+    def minimum_calls(self):
+        return getattr(settings, 'CIRCUIT_BREAKER_MINIMUM_CALLS', 5)
+
+    @property
+    def window_size(self):
+        return getattr(settings, 'CIRCUIT_BREAKER_WINDOW_SIZE', 20)
+
+    @property
+    def reset_timeout(self):
+        return getattr(settings, 'CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
+
+    @property
+    def slow_call_seconds(self):
+        return getattr(settings, 'CIRCUIT_BREAKER_SLOW_CALL_SECONDS', 10)
+
+    @property
+    def bulkhead_wait(self):
+        return getattr(settings, 'EXTERNAL_API_BULKHEAD_WAIT', 0.5)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.time())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now >= self._opened_until:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def _adopt_shared_state(self, now):
+        """Open the circuit if another worker opened it"""
+        if now - self._shared_checked_at < self.SHARED_CHECK_INTERVAL:
+            return
+        self._shared_checked_at = now
+        opened_until = cache.get(self.SHARED_KEY.format(name=self.name))
+        if opened_until and opened_until > now:
+            with self._lock:
+                if self._state == CLOSED:
+                    self._open(opened_until)
+
+    def _reserve(self):
+        """Let a call through or raise CircuitOpenError"""
+        now = time.time()
+        self._adopt_shared_state(now)
+        with self._lock:
+            state = self._current_state(now)
+            if state == OPEN or (state == HALF_OPEN and self._probe_in_flight):
+                self.stats['rejected'] += 1
+                raise CircuitOpenError(
+                    f"Circuit '{self.name}' is open, retrying in {max(self._opened_until - now, 0):.0f}s"
+                )
+            if state == HALF_OPEN:
+                self._probe_in_flight = True
+            self.stats['calls'] += 1
+
+    def _cancel_reservation(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _record(self, failed):
+        publish = None
+        with self._lock:
+            if failed:
+                self.stats['failures'] += 1
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if failed:
+                    publish = self._open(time.time() + self.reset_timeout)
+                else:
+                    self._close()
+                    publish = 0
+            elif self._state == CLOSED:
+                self._outcomes.append(failed)
+                while len(self._outcomes) > self.window_size:
+                    self._outcomes.popleft()
+                if (len(self._outcomes) >= self.minimum_calls and
+                        sum(self._outcomes) / len(self._outcomes) >= self.failure_rate_threshold):
+                    publish = self._open(time.time() + self.reset_timeout)
+
+        # Cache I/O outside the lock
+        key = self.SHARED_KEY.format(name=self.name)
+        if publish:
+            cache.set(key, publish, max(int(publish - time.time()), 1))
+        elif publish == 0:
+            cache.delete(key)
+
+    def _open(self, opened_until):
+        logger.warning(f"⚡ [CIRCUIT] '{self.name}' opened until {time.strftime('%H:%M:%S', time.localtime(opened_until))}")
+        self._state = OPEN
+        self._opened_until = opened_until
+        self._outcomes.clear()
+        self.stats['opened'] += 1
+        return opened_until
+
+    def _close(self):
+        logger.info(f"⚡ [CIRCUIT] '{self.name}' closed after a successful probe")
+        self._state = CLOSED
+        self._outcomes.clear()
+
+    def _bulkhead_full(self):
+        self.stats['bulkhead_rejected'] += 1
+        return BulkheadFullError(f"More than {self.max_concurrent} '{self.name}' calls in flight")
+
+    @contextmanager
+    def call(self):
+        """
+        Guard one sync call:
+
+            with breaker.call() as call:
+                response = session.request(...)
+                call.check(response.status_code)
+        """
+        self._reserve()
+        if not self._bulkhead.acquire(timeout=self.bulkhead_wait):
+            self._cancel_reservation()
+            raise self._bulkhead_full()
+
+        outcome = _Call()
+        started = time.monotonic()
+        try:
+            yield outcome
+        except (requests.exceptions.RequestException, httpx.HTTPError):
+            outcome.failed = True
+            raise
+        finally:
+            self._bulkhead.release()
+            self._record(outcome.failed or time.monotonic() - started > self.slow_call_seconds)
+
+    @asynccontextmanager
+    async def acall(self):
+        """Async call(): waiting for a bulkhead slot does not block the event loop"""
+        self._reserve()
+        deadline = time.monotonic() + self.bulkhead_wait
+        while not self._bulkhead.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                self._cancel_reservation()
+                raise self._bulkhead_full()
+            await asyncio.sleep(0.01)
+
+        outcome = _Call()
+        started = time.monotonic()
+        try:
+            yield outcome
+        except (requests.exceptions.RequestException, httpx.HTTPError):
+            outcome.failed = True
+            raise
+        finally:
+            self._bulkhead.release()
+            self._record(outcome.failed or time.monotonic() - started > self.slow_call_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state(time.time())
+            window = list(self._outcomes)
+        return {
+            'state': state,
+            'failure_rate': round(sum(window) / len(window), 3) if window else 0.0,
+            'window_calls': len(window),
+            **self.stats,
+        }
+
+
+class CircuitBreakerRegistry:
+    """One CircuitBreaker per endpoint family, created on first use"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None:
+                    sizes = getattr(settings, 'EXTERNAL_API_BULKHEADS', {})
+                    breaker = self._breakers[name] = CircuitBreaker(name, sizes.get(name, 4))
+        return breaker
+
+    def for_url(self, url):
+        """Breaker of the ElisaSoftware endpoint family `url` belongs to, None for other hosts"""
+        base = urlsplit(getattr(settings, 'EXTERNAL_API_BASE_URL', 'https://api2ego.elisasoftware.com.mx'))
+        target = urlsplit(str(url))
+        if target.hostname != base.hostname:
+            return None
+        path = target.path[len(base.path.rstrip('/')):]
+        for name, prefix in ENDPOINT_FAMILIES:
+            if path.startswith(prefix):
+                return self.get(name)
+        return None
+
+    def snapshot(self):
+        return {name: self.get(name).snapshot() for name, _ in ENDPOINT_FAMILIES}
+
+    def reset(self):
+        with self._lock:
+            for name in self._breakers:
+                cache.delete(CircuitBreaker.SHARED_KEY.format(name=name))
+            self._breakers.clear()
+
+
+# Global instance
+circuit_breakers = CircuitBreakerRegistry()
@@ -0,0 +1,325 @@
+"""
+Shared bearer-token manager for the external ElisaSoftware API
+
+All services that talk to api2ego (plans, subscriptions, RFC validation)
+obtain their token here instead of logging in on their own, from sync code
+(get_token/request) or from async batch jobs run with asyncio.run()
+(aget_token/arequest).
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from http_client import get_async_client, get_session, http_timeout
+from locks import SingleFlightLock
+
+logger = logging.getLogger(__name__)
+
+
+class ExternalAPIAuthError(requests.exceptions.RequestException):
+    """Raised when no bearer token could be obtained from the external API"""
+
+
+def get_token_expiry(token):
+    """
+    Return the `exp` claim (epoch seconds) of a JWT bearer token,
+    or None if the token cannot be decoded
+    """
+    try:
+        payload = token.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class ExternalAPITokenManager:
+    """
+    Process-wide token manager
+
+    The token is kept in memory and in the Django cache so every worker
+    shares the same login. It is refreshed shortly before the JWT `exp`
+    claim, and only one thread/worker performs the login at a time.
+    """
+
+    CACHE_KEY = 'external_api_token'
+    LOCK_KEY = 'external_api_token_lock'
+    LOCK_TIMEOUT = 15  # seconds, longer than the login timeout
+    DEFAULT_TTL = 60 * 60  # used when the token carries no exp claim
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._async_locks = weakref.WeakKeyDictionary()
+        self._token = None
+        self._expires_at = 0
+        self._login_lock = SingleFlightLock(self.LOCK_KEY, self.LOCK_TIMEOUT)
+
+    @property
+    def base_url(self):
+        return getattr(settings, 'EXTERNAL_API_BASE_URL', 'https://api2ego.elisasoftware.com.mx')
+
+    @property
+    def refresh_margin(self):
+        return getattr(settings, 'EXTERNAL_API_TOKEN_REFRESH_MARGIN', 5 * 60)
+
+    def _is_fresh(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
+
+    def _from_cache(self):
+        """Adopt the token published by another worker, if still fresh"""
+        cached = cache.get(self.CACHE_KEY)
+        if cached and self._is_fresh(cached['expires_at']):
+            self._token = cached['token']
+            self._expires_at = cached['expires_at']
+            return self._token
+        return None
+
+    def _login_request(self):
+        """URL, query params and headers of the /login call"""
+        url = f"{self.base_url}/login"
+        params = {
+            'username': getattr(settings, 'EXTERNAL_API_USERNAME', 'AdmGPScontrol4u'),
+            'password': getattr(settings, 'EXTERNAL_API_PASSWORD', 'GPSc0ntr0l4u*'),
+        }
+        headers = {'accept': 'application/json'}
+        return url, params, headers
+
+    def _publish(self, token):
+        """Keep the token in memory and in the cache until it expires"""
+        expires_at = get_token_expiry(token) or time.time() + self.DEFAULT_TTL
+        self._token = token
+        self._expires_at = expires_at
+        timeout = max(int(expires_at - time.time()), 1)
+        cache.set(self.CACHE_KEY, {'token': token, 'expires_at': expires_at}, timeout)
+        logger.info(f"🔐 [AUTH] Authentication successful, token valid for {timeout}s")
+
+    def _token_from_response(self, response):
+        """Bearer token of a /login response (requests or httpx), or None"""
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('code') == 200 and 'data' in data:
+                token = data['data'].get('token')
+                if token:
+                    return token
+
+        logger.error(f"🔐 [AUTH] Authentication failed: {response.status_code}")
+        return None
+
+    def _login(self):
+        """Perform the actual /login call and publish the token"""
+        url, params, headers = self._login_request()
+
+        try:
+            response = get_session().post(url, params=params, headers=headers, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"🔐 [AUTH] Authentication request error: {e}")
+            return None
+
+        token = self._token_from_response(response)
+        if token:
+            self._publish(token)
+        return token
+
+    def get_token(self):
+        """
+        Return a valid bearer token (already prefixed with "Bearer "),
+        logging in only when no fresh token is available
+        Returns None if authentication failed
+        """
+        if self._token and self._is_fresh(self._expires_at):
+            return self._token
+        token = self._from_cache()
+        if token:
+            return token
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._token and self._is_fresh(self._expires_at):
+                return self._token
+            token = self._from_cache()
+            if token:
+                return token
+
+            # Cross-worker single flight: only the lock holder logs in
+            holds_lock = self._login_lock.acquire()
+            if not holds_lock:
+                deadline = time.time() + self.LOCK_TIMEOUT
+                while time.time() < deadline:
+                    time.sleep(0.1)
+                    token = self._from_cache()
+                    if token:
+                        return token
+                    if not self._login_lock.locked():
+                        break  # the other worker gave up (e.g. login circuit open)
+                else:
+                    logger.warning("🔐 [AUTH] Timed out waiting for another worker to log in")
+
+            try:
+                token = self._login()
+            finally:
+                if holds_lock:
+                    self._login_lock.release()
+
+            if token:
+                return token
+
+            # Keep using a token that is about to expire rather than failing outright
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            return None
+
+    def invalidate(self, token=None):
+        """Drop the current token (only if it is `token`, when given)"""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0
+            cached = cache.get(self.CACHE_KEY)
+            if cached and (token is None or cached['token'] == token):
+                cache.delete(self.CACHE_KEY)
+
+    def request(self, method, url, session=None, **kwargs):
+        """
+        Perform an authenticated request against the external API
+
+        The Authorization header is added automatically. A 401 response
+        invalidates the token and the request is retried once with a new one.
+        Raises ExternalAPIAuthError if no token can be obtained.
+        """
+        http = session or get_session()
+        headers = dict(kwargs.pop('headers', None) or {})
+
+        for attempt in range(2):
+            token = self.get_token()
+            if not token:
+                raise ExternalAPIAuthError("Failed to authenticate with external API")
+
+            headers['Authorization'] = token  # Token already includes "Bearer "
+            response = http.request(method, url, headers=headers, **kwargs)
+
+            if response.status_code != 401 or attempt:
+                return response
+
+            logger.warning(f"🔐 [AUTH] 401 from {url}, refreshing token and retrying once")
+            self.invalidate(token)
+
+        return response
+
+    def _async_lock(self):
+        """asyncio.Lock of the running event loop"""
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = self._async_locks[loop] = asyncio.Lock()
+        return lock
+
+    async def _alogin(self):
+        """Async /login call on the event loop's client"""
+        url, params, headers = self._login_request()
+
+        try:
+            response = await get_async_client().post(url, params=params, headers=headers, timeout=http_timeout(10))
+        except (httpx.HTTPError, requests.exceptions.RequestException) as e:
+            logger.error(f"🔐 [AUTH] Authentication request error: {e}")
+            return None
+
+        token = self._token_from_response(response)
+        if token:
+            await sync_to_async(self._publish)(token)
+        return token
+
+    async def _afrom_cache(self):
+        cached = await cache.aget(self.CACHE_KEY)
+        if cached and self._is_fresh(cached['expires_at']):
+            self._token = cached['token']
+            self._expires_at = cached['expires_at']
+            return self._token
+        return None
+
+    async def aget_token(self):
+        """
+        Async get_token(): same single-flight login, but waiting for another
+        worker's login does not block the event loop
+        """
+        if self._token and self._is_fresh(self._expires_at):
+            return self._token
+        token = await self._afrom_cache()
+        if token:
+            return token
+
+        # Coroutines of this loop share one login instead of polling the cache
+        async with self._async_lock():
+            if self._token and self._is_fresh(self._expires_at):
+                return self._token
+            token = await self._afrom_cache()
+            if token:
+                return token
+
+            holds_lock = await self._login_lock.aacquire()
+            if not holds_lock:
+                deadline = time.time() + self.LOCK_TIMEOUT
+                while time.time() < deadline:
+                    await asyncio.sleep(0.1)
+                    token = await self._afrom_cache()
+                    if token:
+                        return token
+                    if not await self._login_lock.alocked():
+                        break  # the other worker gave up (e.g. login circuit open)
+                else:
+                    logger.warning("🔐 [AUTH] Timed out waiting for another worker to log in")
+
+            try:
+                token = await self._alogin()
+            finally:
+                if holds_lock:
+                    await self._login_lock.arelease()
+
+            if token:
+                return token
+
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            return None
+
+    async def ainvalidate(self, token=None):
+        await sync_to_async(self.invalidate)(token)
+
+    async def arequest(self, method, url, client=None, **kwargs):
+        """
+        Async request(): authenticated httpx call with a single retry on 401
+        Raises ExternalAPIAuthError if no token can be obtained.
+        """
+        http = client or get_async_client()
+        headers = dict(kwargs.pop('headers', None) or {})
+        kwargs['timeout'] = http_timeout(kwargs.get('timeout'))
+
+        for attempt in range(2):
+            token = await self.aget_token()
+            if not token:
+                raise ExternalAPIAuthError("Failed to authenticate with external API")
+
+            headers['Authorization'] = token  # Token already includes "Bearer "
+            response = await http.request(method, url, headers=headers, **kwargs)
+
+            if response.status_code != 401 or attempt:
+                return response
+
+            logger.warning(f"🔐 [AUTH] 401 from {url}, refreshing token and retrying once")
+            await self.ainvalidate(token)
+
+        return response
+
+
+# Global instance
+token_manager = ExternalAPITokenManager()
@@ -2,14 +2,17 @@
 External API service for integrating with the DataCollect API
 """
 
-import requests
 import json
 import logging
 from django.conf import settings
-from django.core.cache import cache
+from external_api_auth import token_manager
+from http_client import get_session
+from instrumentation import traced_service
+from plan_catalogue import plan_catalogue
 
 logger = logging.getLogger(__name__)
 
+@traced_service('ExternalAPIService')
 class ExternalAPIService:
     """Service class for interacting with the external DataCollect API"""
     
@@ -19,116 +22,111 @@ class ExternalAPIService:
         self.password = getattr(settings, 'EXTERNAL_API_PASSWORD', 'GPSc0ntr0l4u*')
         self.store = getattr(settings, 'EXTERNAL_API_STORE', 'GPScontrol4U')
         self.token = None
-        self.session = requests.Session()
+        # Shared keep-alive session; never mutate its headers per instance
+        self.session = get_session()
+        self.headers = {
+            'accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
         
         # Debug: Log the credentials being used
         logger.info(f"External API Config - URL: {self.base_url}, Username: {self.username}, Store: {self.store}")
     
     def authenticate(self):
         """
-        Authenticate with the external API and get Bearer token
+        Obtain the shared Bearer token from the token manager
         Returns True if successful, False otherwise
         """
-        try:
-            url = f"{self.base_url}/login"
-            params = {
-                'username': self.username,
-                'password': self.password
-            }
-            
-            headers = {
-                'accept': 'application/json'
-            }
-            
-            response = self.session.post(url, params=params, headers=headers, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                if data.get('code') == 200 and 'data' in data:
-                    self.token = data['data'].get('token')
-                    if self.token:
-                        # Set authorization header for future requests
-                        self.session.headers.update({
-                            'Authorization': self.token,
-                            'accept': 'application/json',
-                            'Content-Type': 'application/json'
-                        })
-                        
-                        logger.info("External API authentication successful")
-                        return True
-                        
-            logger.error(f"External API authentication failed: {response.status_code}")
-            return False
-            
-        except Exception as e:
-            logger.error(f"External API authentication error: {e}")
-            return False
+        self.token = token_manager.get_token()
+        if self.token:
+            return True
+
+        logger.error("External API authentication failed")
+        return False
+    
+    def get_plan_index(self):
+        """
+        Get the indexed plan catalogue, served from the shared plan catalogue
+        cache (stale-while-revalidate, with a disk snapshot fallback)
+        Returns a PlanIndex or None if error
+        """
+        return plan_catalogue.get(self.fetch_plans)
     
     def get_available_plans(self):
         """
-        Get available subscription plans from the external API
+        Get available subscription plans
+        Returns list of plans or None if error
+        """
+        index = self.get_plan_index()
+        return index.plans if index else None
+    
+    def get_plan(self, plan_id):
+        """Get a single plan by id (int or str), None if unknown or unavailable"""
+        index = self.get_plan_index()
+        return index.get_plan(plan_id) if index else None
+    
+    def plans_sorted_by_price(self):
+        """Get plans sorted by price (free first), empty list if unavailable"""
+        index = self.get_plan_index()
+        return index.plans_sorted_by_price() if index else []
+    
+    def free_plan(self):
+        """Get the free plan, None if there is none or plans are unavailable"""
+        index = self.get_plan_index()
+        return index.free_plan() if index else None
+    
+    def fetch_plans(self):
+        """
+        Fetch and process plans from the external API, bypassing the cache
         Returns list of plans or None if error
         """
-        # Check cache first
-        cache_key = 'external_api_plans'
-        cached_plans = cache.get(cache_key)
-        if cached_plans:
-            logger.info("Returning cached external API plans")
-            return cached_plans
-        
-        # Authenticate if not already done
-        if not self.token:
-            if not self.authenticate():
-                return None
-        
         try:
             url = f"{self.base_url}/store/plans"
             params = {
                 'store': self.store
             }
-            response = self.session.get(url, params=params, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                if data.get('code') == 200 and 'data' in data:
-                    plans = data['data']
-                    
-                    # Process plans to make them more usable
-                    processed_plans = []
-                    for plan in plans:
-                        plan_name = plan.get('name', '').lower()
-                        processed_plan = {
-                            'id': plan.get('id'),
-                            'name': plan.get('name', 'Unknown Plan'),
-                            'description': plan.get('description', ''),
-                            'price': float(plan.get('price', 0)),
-                            'billing_cycle': plan.get('billing_cycle', 'Unknown'),
-                            'months': plan.get('months', 12),
-                            'admin_users_quantity': plan.get('admin_users_quantity', 0),
-                            'subscribed_users_quantity': plan.get('subscribed_users_quantity', 0),
-                            'status': plan.get('status', 'Unknown'),
-                            'client': plan.get('client', ''),
-                            'is_free': 'gratuito' in plan_name or 'free' in plan_name,
-                            # Only mark as premium if it's the main team plan, not additional licenses
-                            'is_premium': ('equipo' in plan_name or 'premium' in plan_name or 'anual' in plan_name) and 'licencia' not in plan_name and 'adicional' not in plan_name
-                        }
-                        processed_plans.append(processed_plan)
-                    
-                    # Cache for 30 minutes
-                    cache.set(cache_key, processed_plans, 30 * 60)
-                    
-                    logger.info(f"Retrieved {len(processed_plans)} plans from external API")
-                    return processed_plans
-                    
-            logger.error(f"Failed to get plans from external API: {response.status_code}")
-            return None
+            response = token_manager.request('GET', url, session=self.session, params=params, headers=self.headers, timeout=10)
+            return self._process_plans(response)
             
         except Exception as e:
             logger.error(f"Error getting plans from external API: {e}")
             return None
     
+    def _process_plans(self, response):
+        """Plan list from a /store/plans response, None if error"""
+        if response.status_code == 200:
+            data = response.json()
+            
+            if data.get('code') == 200 and 'data' in data:
+                plans = data['data']
+                
+                # Process plans to make them more usable
+                processed_plans = []
+                for plan in plans:
+                    plan_name = plan.get('name', '').lower()
+                    processed_plan = {
+                        'id': plan.get('id'),
+                        'name': plan.get('name', 'Unknown Plan'),
+                        'description': plan.get('description', ''),
+                        'price': float(plan.get('price', 0)),
+                        'billing_cycle': plan.get('billing_cycle', 'Unknown'),
+                        'months': plan.get('months', 12),
+                        'admin_users_quantity': plan.get('admin_users_quantity', 0),
+                        'subscribed_users_quantity': plan.get('subscribed_users_quantity', 0),
+                        'status': plan.get('status', 'Unknown'),
+                        'client': plan.get('client', ''),
+                        'is_free': 'gratuito' in plan_name or 'free' in plan_name,
+                        # Only mark as premium if it's the main team plan, not additional licenses
+                        'is_premium': ('equipo' in plan_name or 'premium' in plan_name or 'anual' in plan_name) and 'licencia' not in plan_name and 'adicional' not in plan_name
+                    }
+                    processed_plans.append(processed_plan)
+                
+                logger.info(f"Retrieved {len(processed_plans)} plans from external API")
+                return processed_plans
+                
+        logger.error(f"Failed to get plans from external API: {response.status_code}")
+        return None
+    
     def register_user_rfc(self, rfc_tin, user_data):
         """
         Register user RFC/TIN with external API
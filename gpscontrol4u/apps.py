@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class Gpscontrol4uConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gpscontrol4u'
+
+    def ready(self):
+        from . import signals  # noqa: F401
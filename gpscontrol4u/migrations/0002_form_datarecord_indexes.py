@@ -0,0 +1,25 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpscontrol4u', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='datarecord',
+            index=models.Index(fields=['user', '-submitted_at'], name='record_user_submitted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='form',
+            index=models.Index(fields=['is_predefined', 'is_active'], name='form_predefined_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='form',
+            index=models.Index(fields=['user', 'is_active'], name='form_user_active_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.16 on 2026-10-16 23:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_change_log(apps, schema_editor):
+    """One change per existing row, so a first sync (token 0) returns the current data"""
+    Form = apps.get_model('gpscontrol4u', 'Form')
+    FormTemplate = apps.get_model('gpscontrol4u', 'FormTemplate')
+    DataRecord = apps.get_model('gpscontrol4u', 'DataRecord')
+    SyncChange = apps.get_model('gpscontrol4u', 'SyncChange')
+
+    def rows():
+        for pk in FormTemplate.objects.order_by('id').values_list('id', flat=True).iterator():
+            yield SyncChange(user_id=None, kind='template', object_id=pk)
+        for pk, user_id, is_predefined in Form.objects.order_by('id').values_list('id', 'user_id', 'is_predefined').iterator():
+            yield SyncChange(user_id=None if is_predefined else user_id, kind='form', object_id=pk)
+        for pk, user_id in DataRecord.objects.order_by('id').values_list('id', 'user_id').iterator():
+            yield SyncChange(user_id=user_id, kind='record', object_id=pk)
+
+    batch = []
+    for change in rows():
+        batch.append(change)
+        if len(batch) == 1000:
+            SyncChange.objects.bulk_create(batch)
+            batch = []
+    SyncChange.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gpscontrol4u', '0002_form_datarecord_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formtemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.CreateModel(
+            name='SyncChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('form', 'Form'), ('template', 'Form template'), ('record', 'Data record')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='syncchange_user_seq_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_change_log, migrations.RunPython.noop),
+    ]
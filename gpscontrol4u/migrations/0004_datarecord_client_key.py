@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16 on 2026-10-16 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gpscontrol4u', '0003_sync_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datarecord',
+            name='client_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='datarecord',
+            constraint=models.UniqueConstraint(fields=('user', 'client_key'), name='unique_record_client_key'),
+        ),
+    ]
@@ -23,6 +23,11 @@ class Form(models.Model):
     class Meta:
         ordering = ['-created_at']
         unique_together = ['user', 'form_name', 'language']
+        indexes = [
+            # Forms visible to a user: (is_predefined OR user) AND is_active
+            models.Index(fields=['is_predefined', 'is_active'], name='form_predefined_active_idx'),
+            models.Index(fields=['user', 'is_active'], name='form_user_active_idx'),
+        ]
     
     def __str__(self):
         return f"{self.form_name} ({self.language}) - {self.user.email}"
@@ -37,8 +42,8 @@ class Form(models.Model):
         """Check if user can access this form"""
         if self.is_predefined:
             return True  # Predefined forms available to all users
-        if self.user == user:
-            return True  # User's own forms
+        if self.user_id == user.pk:
+            return True  # User's own forms (compared by id: no query for self.user)
         return False
 
 
@@ -56,8 +61,17 @@ class DataRecord(models.Model):
     latitude = models.DecimalField(max_digits=10, decimal_places=8, null=True, blank=True)
     longitude = models.DecimalField(max_digits=11, decimal_places=8, null=True, blank=True)
     
+    # Client-generated key of a bulk-uploaded submission, so a retried upload is not stored twice
+    client_key = models.CharField(max_length=64, null=True, blank=True)
+    
     class Meta:
         ordering = ['-submitted_at']
+        indexes = [
+            models.Index(fields=['user', '-submitted_at'], name='record_user_submitted_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'client_key'], name='unique_record_client_key'),
+        ]
     
     def __str__(self):
         return f"Data for {self.form.form_name} by {self.user.email}"
@@ -88,6 +102,7 @@ class FormTemplate(models.Model):
     is_premium_only = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['category', 'name']
@@ -101,3 +116,76 @@ class FormTemplate(models.Model):
         if not self.is_premium_only:
             return True
         return user.is_premium()
+
+
+class SyncChange(models.Model):
+    """
+    Change log read by the delta-sync API (api/sync.py)
+
+    One row per save or delete of a Form, FormTemplate or DataRecord; the
+    auto-increment id is the change sequence clients resume from. Rows with
+    no user (predefined forms, templates) concern every user.
+    """
+    
+    KIND_CHOICES = [
+        ('form', 'Form'),
+        ('template', 'Form template'),
+        ('record', 'Data record'),
+    ]
+    
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='+')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    deleted = models.BooleanField(default=False)
+    changed_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # Changes of one user (or of everyone: user IS NULL) after a sequence number
+            models.Index(fields=['user', 'id'], name='syncchange_user_seq_idx'),
+        ]
+    
+    def __str__(self):
+        action = 'deleted' if self.deleted else 'changed'
+        return f"#{self.pk} {self.kind} {self.object_id} {action}"
+    
+    @classmethod
+    def record(cls, instance, deleted=False):
+        """Log a change of a Form, FormTemplate or DataRecord instance"""
+        cls.objects.create(deleted=deleted, **cls.target(instance))
+    
+    @classmethod
+    def compact(cls, batch_size=500):
+        """
+        Delete the rows a later row of the same user and object supersedes
+        
+        A sync only sends the latest state of an object, so a client that
+        has not read an older row yet will read the latest one instead.
+        Rows of the same object for different users (a template's shared
+        row and the per-user rows of a role change) are kept apart.
+        Returns the number of rows deleted.
+        """
+        superseded = list(
+            cls.objects.values('user_id', 'kind', 'object_id')
+            .annotate(latest=models.Max('id'), rows=models.Count('id'))
+            .filter(rows__gt=1)
+            .order_by()
+            .values_list('user_id', 'kind', 'object_id', 'latest')
+        )
+        total = 0
+        for start in range(0, len(superseded), batch_size):
+            older = models.Q()
+            for user_id, kind, object_id, latest in superseded[start:start + batch_size]:
+                older |= models.Q(user_id=user_id, kind=kind, object_id=object_id, id__lt=latest)
+            total += cls.objects.filter(older).delete()[0]
+        return total
+    
+    @staticmethod
+    def target(instance):
+        """user, kind and object_id of the log row for an instance"""
+        if isinstance(instance, FormTemplate):
+            return {'user_id': None, 'kind': 'template', 'object_id': instance.pk}
+        if isinstance(instance, Form):
+            return {'user_id': None if instance.is_predefined else instance.user_id, 'kind': 'form', 'object_id': instance.pk}
+        return {'user_id': instance.user_id, 'kind': 'record', 'object_id': instance.pk}
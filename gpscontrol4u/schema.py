@@ -0,0 +1,232 @@
+"""
+Validation of DataRecord.data_content against Form.form_structure
+
+A form_structure ({"fields": [{"type", "name", "required", "options",
+"min", "max"}, ...]}) is compiled once into a FormSchema: one check per
+field, with option sets, bounds and patterns prepared up front, so
+validating a record is a single pass over the fields with no parsing.
+Compiled schemas are kept in a bounded LRU keyed by (form id, updated_at);
+saving a form changes updated_at, so an edited form is never validated
+against its old structure.
+
+Answers are read from data_content["responses"] when present (the iOS app
+format), otherwise from data_content itself. Keys the form does not declare
+are allowed; field types the compiler does not know accept any value.
+"""
+
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.utils.dateparse import parse_date, parse_datetime
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+TEXT_TYPES = {'text', 'textarea', 'tel', 'phone', 'url', 'password', 'hidden'}
+EMPTY = (None, '', [], {})
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _text_check(field):
+    max_length = field.get('max_length', field.get('maxlength'))
+    if not _is_number(max_length):
+        max_length = None
+
+    def check(value):
+        if not isinstance(value, str):
+            return 'Expected text.'
+        if max_length is not None and len(value) > max_length:
+            return f'At most {max_length} characters.'
+    return check
+
+
+def _email_check(field):
+    def check(value):
+        if not isinstance(value, str) or not EMAIL_RE.match(value):
+            return 'Enter a valid email address.'
+    return check
+
+
+def _number_check(field):
+    low = field.get('min') if _is_number(field.get('min')) else None
+    high = field.get('max') if _is_number(field.get('max')) else None
+
+    def check(value):
+        if not _is_number(value):
+            return 'Expected a number.'
+        if low is not None and value < low:
+            return f'Must be at least {low}.'
+        if high is not None and value > high:
+            return f'Must be at most {high}.'
+    return check
+
+
+def _option_values(field):
+    options = field.get('options')
+    if not isinstance(options, list) or not options:
+        return None
+    # Options are plain strings or {"value": ..., "label": ...}
+    values = (option.get('value') if isinstance(option, dict) else option for option in options)
+    return frozenset(value for value in values if not isinstance(value, (dict, list)))
+
+
+def _select_check(field):
+    options = _option_values(field)
+
+    def check(value):
+        if isinstance(value, (dict, list)):
+            return 'Expected a single option.'
+        if options is not None and value not in options:
+            return f'"{value}" is not a valid option.'
+    return check
+
+
+def _checkbox_check(field):
+    options = _option_values(field)
+    if options is None:
+        # A single checkbox
+        def check(value):
+            if not isinstance(value, bool):
+                return 'Expected true or false.'
+        return check
+
+    def check(value):
+        if not isinstance(value, list):
+            return 'Expected a list of options.'
+        invalid = [item for item in value if isinstance(item, (dict, list)) or item not in options]
+        if invalid:
+            return f'Invalid options: {", ".join(map(str, invalid))}.'
+    return check
+
+
+def _date_check(field):
+    def check(value):
+        try:
+            valid = isinstance(value, str) and parse_date(value) is not None
+        except ValueError:
+            valid = False
+        if not valid:
+            return 'Expected a date (YYYY-MM-DD).'
+    return check
+
+
+def _datetime_check(field):
+    def check(value):
+        try:
+            valid = isinstance(value, str) and (parse_datetime(value) or parse_date(value)) is not None
+        except ValueError:
+            valid = False
+        if not valid:
+            return 'Expected an ISO 8601 date and time.'
+    return check
+
+
+def _file_check(field):
+    def check(value):
+        if isinstance(value, str):
+            return None
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            return 'Expected a file reference or a list of them.'
+    return check
+
+
+CHECKS = {
+    'email': _email_check,
+    'number': _number_check,
+    'select': _select_check,
+    'radio': _select_check,
+    'checkbox': _checkbox_check,
+    'date': _date_check,
+    'datetime': _datetime_check,
+    'file': _file_check,
+    **{name: _text_check for name in TEXT_TYPES},
+}
+
+
+class FormSchema:
+    """A form_structure compiled into per-field checks"""
+
+    def __init__(self, form_structure):
+        self.fields = []
+        fields = form_structure.get('fields') if isinstance(form_structure, dict) else None
+        for field in fields if isinstance(fields, list) else []:
+            if not isinstance(field, dict) or not isinstance(field.get('name'), str) or not field['name']:
+                continue
+            factory = CHECKS.get(field.get('type'))
+            check = factory(field) if factory else None
+            self.fields.append((field['name'], bool(field.get('required')), check))
+
+    def __len__(self):
+        return len(self.fields)
+
+    def validate(self, data_content):
+        """{field name: [message]} for every invalid answer; empty when data_content is valid"""
+        if not self.fields:
+            return {}
+        if not isinstance(data_content, dict):
+            return {'non_field_errors': ['Expected a JSON object.']}
+        answers = data_content.get('responses')
+        if not isinstance(answers, dict):
+            answers = data_content
+
+        errors = {}
+        for name, required, check in self.fields:
+            value = answers.get(name)
+            if value in EMPTY:
+                if required:
+                    errors[name] = ['This field is required.']
+                continue
+            if check is not None:
+                message = check(value)
+                if message:
+                    errors[name] = [message]
+        return errors
+
+
+class SchemaCache:
+    """Bounded LRU of compiled FormSchemas keyed by (form id, updated_at)"""
+
+    stats = Counter()
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.schemas = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, form):
+        key = (form.pk, form.updated_at)
+        with self.lock:
+            schema = self.schemas.get(key)
+            if schema is not None:
+                self.schemas.move_to_end(key)
+                self.stats['hit'] += 1
+                return schema
+        self.stats['miss'] += 1
+        try:
+            schema = FormSchema(form.get_form_structure())
+        except ValueError:
+            schema = FormSchema({})  # form_structure is an unparsable string
+        max_size = self.max_size or getattr(settings, 'FORM_SCHEMA_CACHE_SIZE', 512)
+        with self.lock:
+            self.schemas[key] = schema
+            self.schemas.move_to_end(key)
+            while len(self.schemas) > max_size:
+                self.schemas.popitem(last=False)
+        return schema
+
+    def clear(self):
+        with self.lock:
+            self.schemas.clear()
+
+
+schema_cache = SchemaCache()
+
+
+def validate_data_content(form, data_content):
+    """Errors of data_content against the form's compiled schema ({} when valid or disabled)"""
+    if not getattr(settings, 'DATA_RECORD_SCHEMA_VALIDATION', True):
+        return {}
+    return schema_cache.get(form).validate(data_content)
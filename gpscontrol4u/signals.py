@@ -0,0 +1,51 @@
+"""
+Delta-sync change log
+
+Every save or delete of a synced model appends a SyncChange in the same
+transaction. Bulk writes that bypass signals (api/ingest.py) log their rows
+themselves. A user gaining or losing premium access gets a row of their own
+for every premium-only template, so the next sync sends those templates or
+reports them deleted.
+"""
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import DataRecord, Form, FormTemplate, SyncChange
+
+
+@receiver(post_save, sender=Form)
+@receiver(post_save, sender=FormTemplate)
+@receiver(post_save, sender=DataRecord)
+def log_sync_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        SyncChange.record(instance)
+
+
+@receiver(post_delete, sender=Form)
+@receiver(post_delete, sender=FormTemplate)
+@receiver(post_delete, sender=DataRecord)
+def log_sync_deletion(sender, instance, **kwargs):
+    SyncChange.record(instance, deleted=True)
+
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_premium_access(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._was_premium = None
+    if raw or instance.pk is None or (update_fields is not None and 'role' not in update_fields):
+        return
+    role = sender.objects.filter(pk=instance.pk).values_list('role', flat=True).first()
+    if role is not None:
+        instance._was_premium = role == 'premium'
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def log_premium_access_change(sender, instance, created=False, raw=False, **kwargs):
+    was_premium = getattr(instance, '_was_premium', None)
+    if raw or created or was_premium is None or was_premium == instance.is_premium():
+        return
+    SyncChange.objects.bulk_create([
+        SyncChange(user_id=instance.pk, kind='template', object_id=pk)
+        for pk in FormTemplate.objects.filter(is_premium_only=True).values_list('id', flat=True)
+    ])
@@ -0,0 +1,21 @@
+"""
+Periodic tasks for the delta-sync change log
+"""
+
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+from .models import SyncChange
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def compact_sync_changes():
+    """Keep only the latest change log row per user and object (scheduled nightly)"""
+    count = SyncChange.compact(batch_size=getattr(settings, 'SYNC_COMPACT_BATCH_SIZE', 500))
+    if count:
+        logger.info(f"🔄 [SYNC] Compacted {count} superseded change log rows")
+    return count
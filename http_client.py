@@ -0,0 +1,345 @@
+"""
+Shared, pooled HTTP transport for outbound calls
+
+Every call to the ElisaSoftware API and to Mercado Pago goes through one
+keep-alive requests.Session per process, so TCP+TLS handshakes are only
+paid when the pool has no idle connection for the host. Async batch jobs
+use one httpx.AsyncClient per event loop with the same pool sizes and
+timeouts.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+import httpx
+import instrumentation
+import requests
+from circuit_breaker import circuit_breakers
+from django.conf import settings
+from mercadopago.http.http_client import HttpClient as MercadoPagoBaseHttpClient
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from urllib3.util import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionStats:
+    """Thread-safe per-host counters for requests and new connections"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._new_connections = defaultdict(int)
+
+    def record_request(self, host):
+        with self._lock:
+            self._requests[host] += 1
+
+    def record_new_connection(self, host):
+        with self._lock:
+            self._new_connections[host] += 1
+
+    def snapshot(self):
+        """Return {host: {'requests', 'new_connections', 'reused_connections'}}"""
+        with self._lock:
+            return {
+                host: {
+                    'requests': count,
+                    'new_connections': self._new_connections[host],
+                    'reused_connections': max(count - self._new_connections[host], 0),
+                }
+                for host, count in self._requests.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._new_connections.clear()
+
+
+connection_stats = ConnectionStats()
+
+
+class _CountingPoolMixin:
+    """Count every new socket the pool opens and bound the wait for a free one"""
+
+    def _new_conn(self):
+        connection_stats.record_new_connection(self.host)
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'EXTERNAL_HTTP_POOL_TIMEOUT', 10)
+        return super()._get_conn(timeout=timeout)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a bounded (blocking) pool and connection counters"""
+
+    def __init__(self, pool_maxsize, max_retries=0):
+        super().__init__(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            pool_block=True,
+            max_retries=max_retries,
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        connection_stats.record_request(requests.utils.urlparse(request.url).hostname)
+        return super().send(request, **kwargs)
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session that splits a scalar timeout into (connect, read)
+
+    Callers keep passing `timeout=10` as before; the value is used as the
+    read timeout and EXTERNAL_HTTP_CONNECT_TIMEOUT as the connect timeout.
+    Calls to the ElisaSoftware API go through the circuit breaker and
+    bulkhead of their endpoint family. Every call is reported to
+    instrumentation with its duration.
+    """
+
+    def request(self, method, url, **kwargs):
+        timeout = kwargs.get('timeout')
+        if not isinstance(timeout, tuple):
+            kwargs['timeout'] = (
+                getattr(settings, 'EXTERNAL_HTTP_CONNECT_TIMEOUT', 5),
+                timeout if timeout is not None else getattr(settings, 'EXTERNAL_HTTP_READ_TIMEOUT', 30),
+            )
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = self._guarded_send(method, url, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            instrumentation.record_outbound(
+                requests.utils.urlparse(url).hostname, time.perf_counter() - started, failed
+            )
+
+    def _guarded_send(self, method, url, **kwargs):
+        breaker = circuit_breakers.for_url(url)
+        if breaker is None:
+            return self._send(method, url, **kwargs)
+        with breaker.call() as call:
+            response = self._send(method, url, **kwargs)
+            call.check(response.status_code)
+            return response
+
+    def _send(self, method, url, **kwargs):
+        try:
+            return super().request(method, url, **kwargs)
+        except EmptyPoolError as e:
+            raise requests.exceptions.ConnectionError(f"Connection pool exhausted for {url}") from e
+
+
+def build_session():
+    """Create a pooled session with per-host pool sizes from settings"""
+    session = PooledSession()
+    default_size = getattr(settings, 'EXTERNAL_HTTP_POOL_MAXSIZE', 10)
+    session.mount('https://', PooledHTTPAdapter(default_size))
+    session.mount('http://', PooledHTTPAdapter(default_size))
+
+    for host, size in getattr(settings, 'EXTERNAL_HTTP_POOL_SIZES', {}).items():
+        session.mount(f'https://{host}', PooledHTTPAdapter(size))
+
+    return session
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the process-wide pooled session
+
+    The session is created lazily and re-created after a fork so gunicorn
+    workers never share sockets inherited from the master process.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def http_timeout(timeout=None):
+    """
+    httpx.Timeout for an async call, splitting a scalar `timeout` the way
+    PooledSession does: it is the read timeout, the connect and pool
+    timeouts come from settings
+    """
+    if isinstance(timeout, httpx.Timeout):
+        return timeout
+    return httpx.Timeout(
+        timeout if timeout is not None else getattr(settings, 'EXTERNAL_HTTP_READ_TIMEOUT', 30),
+        connect=getattr(settings, 'EXTERNAL_HTTP_CONNECT_TIMEOUT', 5),
+        pool=getattr(settings, 'EXTERNAL_HTTP_POOL_TIMEOUT', 10),
+    )
+
+
+class GuardedAsyncTransport(httpx.AsyncBaseTransport):
+    """httpx transport that runs ElisaSoftware calls through their circuit breaker"""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def handle_async_request(self, request):
+        # Timed up to the response headers; the body is read by the caller
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = await self._guarded_request(request)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            instrumentation.record_outbound(request.url.host, time.perf_counter() - started, failed)
+
+    async def _guarded_request(self, request):
+        breaker = circuit_breakers.for_url(request.url)
+        if breaker is None:
+            return await self._transport.handle_async_request(request)
+        async with breaker.acall() as call:
+            response = await self._transport.handle_async_request(request)
+            call.check(response.status_code)
+            return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+async def _record_async_request(request):
+    connection_stats.record_request(request.url.host)
+
+
+def build_async_client():
+    """Create an httpx.AsyncClient with per-host pool sizes from settings"""
+    default_size = getattr(settings, 'EXTERNAL_HTTP_POOL_MAXSIZE', 10)
+    mounts = {
+        f'https://{host}': GuardedAsyncTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=size)))
+        for host, size in getattr(settings, 'EXTERNAL_HTTP_POOL_SIZES', {}).items()
+    }
+    return httpx.AsyncClient(
+        transport=GuardedAsyncTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=default_size))),
+        timeout=http_timeout(),
+        mounts=mounts,
+        event_hooks={'request': [_record_async_request]},
+    )
+
+
+class AsyncRateLimiter:
+    """Spaces async calls at least 1/rate seconds apart across all tasks of one event loop"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    Return the httpx.AsyncClient of the running event loop
+
+    Connections belong to the loop that opened them, so each loop (the one
+    asyncio.run() starts for a batch command) gets its own client. The
+    coroutine run by asyncio.run() closes it with close_async_client().
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = build_async_client()
+    return client
+
+
+async def close_async_client():
+    """Close the running loop's client and its connections, if one was opened"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class MercadoPagoHttpClient(MercadoPagoBaseHttpClient):
+    """
+    Mercado Pago SDK transport backed by a pooled session
+
+    The SDK's default client opens a new Session (and connection) per call.
+    This keeps its retry policy but reuses connections: there is one
+    session per retry count the SDK asks for (RequestOptions.max_retries,
+    3 unless a caller sets it), so in practice a single one.
+    """
+
+    DEFAULT_RETRIES = 3
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+    def __init__(self):
+        self._sessions = {}
+        self._sessions_pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self, maxretries):
+        session = self._sessions.get(maxretries) if self._sessions_pid == os.getpid() else None
+        if session is None:
+            with self._lock:
+                if self._sessions_pid != os.getpid():
+                    self._sessions = {}
+                    self._sessions_pid = os.getpid()
+                session = self._sessions.get(maxretries)
+                if session is None:
+                    session = PooledSession()
+                    retries = Retry(total=maxretries, status_forcelist=self.RETRY_STATUSES)
+                    size = getattr(settings, 'EXTERNAL_HTTP_POOL_SIZES', {}).get(
+                        'api.mercadopago.com', getattr(settings, 'EXTERNAL_HTTP_POOL_MAXSIZE', 10)
+                    )
+                    session.mount('https://', PooledHTTPAdapter(size, max_retries=retries))
+                    self._sessions[maxretries] = session
+        return session
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        if maxretries is None:
+            maxretries = self.DEFAULT_RETRIES
+        with instrumentation.service_scope('MercadoPagoSDK'):
+            api_result = self._get_session(maxretries).request(method, url, **kwargs)
+        return {
+            "status": api_result.status_code,
+            "response": api_result.json()
+        }
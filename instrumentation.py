@@ -0,0 +1,293 @@
+"""
+Per-request performance instrumentation
+
+PerformanceMiddleware (middleware.py) starts a RequestTimings for each
+request. For the sampled fraction (PERF_SAMPLE_RATE) it is made current,
+and these hooks add to it:
+
+- DB: an execute_wrapper installed on every new database connection
+- templates: the DjangoTemplates backend below times each top-level render
+- outbound calls: http_client reports every ElisaSoftware / Mercado Pago
+  call with the service that made it (see traced_service / service_scope)
+
+Request latency and outbound call latency/errors are also aggregated for
+every request, sampled or not, in the in-process `metrics` registry.
+"""
+
+import functools
+import inspect
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+from django.template.backends.django import Template as BaseTemplate
+
+# Seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Service name for calls made outside a tagged service
+UPSTREAM_SERVICES = {
+    'api.mercadopago.com': 'MercadoPagoSDK',
+}
+
+_current = ContextVar('request_timings', default=None)
+_service = ContextVar('outbound_service', default=None)
+
+
+class Histogram:
+    """Per-bucket (non-cumulative) counts plus sum and count"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe histograms and counters keyed by (name, labels)
+
+    `labels` is a tuple of (key, value) pairs so keys stay hashable and
+    ordered the same way for every observation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        """{'histograms': {(name, labels): dict}, 'counters': {(name, labels): value}}"""
+        with self._lock:
+            return {
+                'histograms': {key: histogram.as_dict() for key, histogram in self._histograms.items()},
+                'counters': dict(self._counters),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+metrics = MetricsRegistry()
+
+
+class RequestTimings:
+    """Time spent by one request, in seconds"""
+
+    __slots__ = ('started', 'sampled', 'db_count', 'db_time', 'template_time', 'outbound')
+
+    def __init__(self, sampled):
+        self.started = time.perf_counter()
+        self.sampled = sampled
+        self.db_count = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        # service -> [calls, seconds, errors]
+        self.outbound = {}
+
+    def server_timing(self, total):
+        """Server-Timing header value (durations in milliseconds)"""
+        parts = [
+            f'total;dur={total * 1000:.1f}',
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.db_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+        ]
+        for service, (calls, seconds, errors) in self.outbound.items():
+            desc = f'{calls} calls' + (f', {errors} errors' if errors else '')
+            parts.append(f'ext-{service};dur={seconds * 1000:.1f};desc="{desc}"')
+        return ', '.join(parts)
+
+
+def current():
+    """RequestTimings of the running (sampled) request, or None"""
+    return _current.get()
+
+
+def start_request():
+    """Begin timing a request; returns (timings, token) for finish_request"""
+    rate = getattr(settings, 'PERF_SAMPLE_RATE', 0.0)
+    timings = RequestTimings(sampled=rate >= 1 or (rate > 0 and random.random() < rate))
+    token = _current.set(timings) if timings.sampled else None
+    return timings, token
+
+
+def finish_request(request, response, timings, token):
+    """Stop timing, record the request in `metrics` and return the total in seconds"""
+    total = time.perf_counter() - timings.started
+    if token is not None:
+        _current.reset(token)
+
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unresolved'
+    metrics.observe('http_request_duration_seconds', (('view', view), ('method', request.method)), total)
+
+    if timings.sampled:
+        labels = (('view', view),)
+        metrics.observe('http_request_db_seconds', labels, timings.db_time)
+        metrics.inc('http_request_db_queries_total', labels, timings.db_count)
+        metrics.observe('http_request_template_seconds', labels, timings.template_time)
+        metrics.inc('http_requests_sampled_total', labels)
+        if response is not None and getattr(settings, 'PERF_SERVER_TIMING', False):
+            response['Server-Timing'] = timings.server_timing(total)
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Outbound calls
+# ---------------------------------------------------------------------------
+
+@contextmanager
+def service_scope(name):
+    """Attribute the outbound calls made inside the block to `name`"""
+    token = _service.set(name)
+    try:
+        yield
+    finally:
+        _service.reset(token)
+
+
+def _with_service(name, func):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = _service.set(name)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _service.reset(token)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _service.set(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _service.reset(token)
+    return wrapper
+
+
+def traced_service(name):
+    """
+    Class decorator: outbound calls made by the public methods of the class
+    are attributed to `name` in Server-Timing and in `metrics`
+    """
+    def decorate(cls):
+        for attr, value in list(vars(cls).items()):
+            if not attr.startswith('_') and inspect.isfunction(value):
+                setattr(cls, attr, _with_service(name, value))
+        return cls
+    return decorate
+
+
+def record_outbound(upstream, seconds, error=False):
+    """Record one outbound HTTP call to host `upstream` (called by http_client)"""
+    upstream = upstream or 'unknown'
+    service = _service.get() or UPSTREAM_SERVICES.get(upstream, upstream)
+    labels = (('service', service), ('upstream', upstream))
+    metrics.observe('outbound_request_duration_seconds', labels, seconds)
+    if error:
+        metrics.inc('outbound_request_errors_total', labels)
+
+    timings = _current.get()
+    if timings is not None:
+        entry = timings.outbound.get(service)
+        if entry is None:
+            entry = timings.outbound[service] = [0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += bool(error)
+
+
+# ---------------------------------------------------------------------------
+# Database and templates
+# ---------------------------------------------------------------------------
+
+def _time_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.db_count += 1
+        timings.db_time += time.perf_counter() - started
+
+
+def _install_query_timer(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(_install_query_timer, dispatch_uid='instrumentation.query_timer')
+
+
+class TimedTemplate(BaseTemplate):
+    def render(self, context=None, request=None):
+        timings = _current.get()
+        if timings is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template_time += time.perf_counter() - started
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """Django template backend that adds top-level render time to the current request"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
@@ -0,0 +1,113 @@
+"""
+Cross-process single-flight locks (API token login, plan catalogue refresh)
+
+On Redis or memcached a lock is a cache key added with a timeout: add() is
+atomic there for every worker of every host. The file cache's add() is a
+check-then-set that several workers can win at once, so on any other
+backend a lock is an exclusive fcntl.flock() on a file in LOCK_DIR, shared
+by the workers of this host. The kernel drops a file lock when its holder
+dies; a hung holder is bounded by the HTTP timeouts of the work it guards.
+"""
+
+import fcntl
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+ATOMIC_ADD_BACKENDS = (
+    'django.core.cache.backends.redis.',
+    'django.core.cache.backends.memcached.',
+)
+
+
+def cache_add_is_atomic():
+    """True if the default cache's add() is atomic across processes"""
+    return settings.CACHES['default']['BACKEND'].startswith(ATOMIC_ADD_BACKENDS)
+
+
+class SingleFlightLock:
+    """
+    Non-blocking cross-process lock
+
+    acquire() returns at once; the holder may release from another thread
+    (e.g. a background refresh). locked() tells waiters whether anyone
+    still holds it.
+    """
+
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout  # seconds a cache lock lives if never released
+        self._file = None
+        self._guard = threading.Lock()
+
+    def _open(self):
+        directory = getattr(settings, 'LOCK_DIR', '')
+        os.makedirs(directory, exist_ok=True)
+        return open(os.path.join(directory, f'{self.name}.lock'), 'a')
+
+    def acquire(self):
+        """True if this call took the lock"""
+        if cache_add_is_atomic():
+            return cache.add(self.name, 1, self.timeout)
+        try:
+            lock_file = self._open()
+        except OSError as e:
+            logger.warning(f"Lock {self.name} unavailable, running without it: {e}")
+            return True
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        with self._guard:
+            self._file = lock_file
+        return True
+
+    def release(self):
+        if cache_add_is_atomic():
+            cache.delete(self.name)
+            return
+        with self._guard:
+            lock_file, self._file = self._file, None
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def locked(self):
+        """True while some thread or worker holds the lock"""
+        if cache_add_is_atomic():
+            return bool(cache.get(self.name))
+        try:
+            lock_file = self._open()
+        except OSError:
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            lock_file.close()  # also drops the probe lock, if it was taken
+        return False
+
+    # Async variants: the file lock calls never block, only the cache calls await
+
+    async def aacquire(self):
+        if cache_add_is_atomic():
+            return await cache.aadd(self.name, 1, self.timeout)
+        return self.acquire()
+
+    async def arelease(self):
+        if cache_add_is_atomic():
+            await cache.adelete(self.name)
+        else:
+            self.release()
+
+    async def alocked(self):
+        if cache_add_is_atomic():
+            return bool(await cache.aget(self.name))
+        return self.locked()
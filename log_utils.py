@@ -0,0 +1,200 @@
+"""
+Logging helpers for hot paths
+
+- lazy_json(obj): a log argument serialized only if a handler formats the record
+- log_fields(logger, level, message, **fields): one structured record
+  ("message key=value ...") instead of one line per value, nothing built
+  when the level is off
+- RedactingFilter: masks passwords, tokens and Authorization headers in
+  structured arguments and rendered messages before any handler writes them
+- QueuedFileHandler: a FileHandler whose writes happen on a QueueListener
+  thread, so request threads only enqueue the record
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+REDACTED = '***'
+
+# Dict keys whose values are never logged
+SENSITIVE_KEYS = re.compile(r'pass(word|wd)?|token|secret|authorization|api_key|access_key', re.IGNORECASE)
+
+# key: value / "key": "value" / key=value in free text, and bearer tokens
+SENSITIVE_TEXT = re.compile(
+    r'''(?P<key>["']?\b\w*(?:password|passwd|token|secret|authorization|api_key)\w*\b["']?\s*[:=]\s*["']?)'''
+    r'''(?P<value>(?:Bearer\s+)?[^\s"',}]+)''',
+    re.IGNORECASE,
+)
+BEARER_TOKEN = re.compile(r'\bBearer\s+[\w\-.~+/=]+', re.IGNORECASE)
+
+# Substring check that lets most messages skip both regular expressions
+SENSITIVE_WORDS = ('pass', 'token', 'secret', 'authoriz', 'api_key', 'bearer')
+
+
+def redact(value):
+    """Copy of a dict/list with sensitive keys masked; other values are returned as they are"""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if isinstance(key, str) and SENSITIVE_KEYS.search(key) and val not in (None, '')
+            else redact(val)
+            for key, val in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def redact_text(text):
+    lowered = text.lower()
+    if not any(word in lowered for word in SENSITIVE_WORDS):
+        return text
+    text = SENSITIVE_TEXT.sub(lambda m: f"{m.group('key')}{REDACTED}", text)
+    return BEARER_TOKEN.sub(f'Bearer {REDACTED}', text)
+
+
+class LazyJSON:
+    """json.dumps(obj) evaluated when the record is formatted, with sensitive keys masked"""
+
+    __slots__ = ('obj', 'indent')
+
+    def __init__(self, obj, indent=None):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self):
+        try:
+            return json.dumps(redact(self.obj), indent=self.indent, default=str, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return repr(self.obj)
+
+
+def lazy_json(obj, indent=None):
+    return LazyJSON(obj, indent)
+
+
+class StructuredMessage:
+    """Record message rendered as "message key=value ..." on first use"""
+
+    __slots__ = ('message', 'fields')
+
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        if not self.fields:
+            return self.message
+        rendered = ' '.join(f'{key}={self._value(value)}' for key, value in self.fields.items())
+        return f'{self.message} {rendered}'
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, (dict, list, tuple)):
+            return json.dumps(value, default=str, ensure_ascii=False)
+        return value
+
+
+def log_fields(logger, level, message, /, **fields):
+    """
+    Log one structured record; fields are also available to formatters and
+    filters as record.fields
+
+        log_fields(logger, logging.INFO, "🚀 [SUBSCRIPTION] Starting", email=user.email, plan_id=plan_id)
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, StructuredMessage(message, fields), extra={'fields': fields}, stacklevel=2)
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Mask sensitive values before the record reaches a handler
+
+    Structured fields are masked by key; the rendered message is then
+    scanned for key: value pairs and bearer tokens, which also covers
+    f-string messages. The record is rendered once and marked, so the
+    other handlers of the same record skip the work.
+    """
+
+    def filter(self, record):
+        if getattr(record, '_redacted', False):
+            return True
+        fields = getattr(record, 'fields', None)
+        if isinstance(fields, dict):
+            record.fields = redact(fields)
+            if isinstance(record.msg, StructuredMessage):
+                record.msg = StructuredMessage(record.msg.message, record.fields)
+        try:
+            message = record.getMessage()
+        except Exception:
+            # Leave malformed records to the handler's own error handling
+            return True
+        record.msg = redact_text(message)
+        record.args = None
+        record._redacted = True
+        return True
+
+
+class QueuedFileHandler(QueueHandler):
+    """
+    FileHandler behind a QueueHandler/QueueListener pair
+
+    Configured like a FileHandler (filename, mode, encoding, delay); the
+    formatter set by dictConfig is applied by the file handler on the
+    listener thread. The listener is (re)started lazily in each process, so
+    forked workers (Celery prefork, gunicorn) get their own thread.
+    """
+
+    def __init__(self, filename, mode='a', encoding=None, delay=False):
+        self.target = logging.FileHandler(filename, mode=mode, encoding=encoding, delay=delay)
+        # queue.Queue rather than SimpleQueue: the listener marks each record
+        # done, which lets flush() wait for the queue to drain
+        super().__init__(queue.Queue())
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        # Formatting happens once, on the listener thread
+        self.target.setFormatter(fmt)
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # After a fork the parent's thread is gone: start over with a new queue
+            self.queue = queue.Queue()
+            self.listener = QueueListener(self.queue, self.target)
+            self.listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._stop_listener, self.listener)
+
+    @staticmethod
+    def _stop_listener(listener):
+        if listener._thread is not None:
+            listener.stop()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        super().enqueue(record)
+
+    def flush(self):
+        """Wait until queued records are written (benchmarks, tests, shutdown)"""
+        if self.listener is not None and self.listener._thread is not None and self._pid == os.getpid():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        # The listener is only stopped here and at exit; flush() leaves it running
+        if self.listener is not None and self._pid == os.getpid():
+            self._stop_listener(self.listener)
+        self.target.flush()
+        self.target.close()
+        super().close()
@@ -0,0 +1,27 @@
+"""
+Celery application for marketplace_backend project.
+
+Start a worker with:
+    celery -A marketplace_backend worker -l info
+
+Set CELERY_TASK_ALWAYS_EAGER=True to run tasks in-process (local runs
+without a broker).
+"""
+
+import os
+
+from celery import Celery
+from celery.signals import task_postrun
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'marketplace_backend.settings')
+
+app = Celery('marketplace_backend')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    """Make outbound call metrics of worker processes visible to /api/metrics/"""
+    import metrics_export
+    metrics_export.flush()
@@ -35,8 +35,10 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 from decouple import config
+from celery.schedules import crontab
 import pymysql
 
 # Use PyMySQL as MySQL driver
@@ -105,6 +107,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'middleware.PerformanceMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -120,12 +123,24 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'marketplace_backend.urls'
 
+# Keep compiled templates in memory independently of DEBUG (the supervisor
+# config runs with DEBUG=True); set TEMPLATE_CACHED_LOADER=False while editing
+# templates without the autoreloader
+TEMPLATE_CACHED_LOADER = config('TEMPLATE_CACHED_LOADER', default=True, cast=bool)
+_TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+if TEMPLATE_CACHED_LOADER:
+    _TEMPLATE_LOADERS = [('django.template.loaders.cached.Loader', _TEMPLATE_LOADERS)]
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that reports render time to instrumentation.py
+        'BACKEND': 'instrumentation.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': _TEMPLATE_LOADERS,
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -241,6 +256,22 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 20,
 }
 
+# Bulk DataRecord upload (POST /api/records/bulk/, see api/ingest.py)
+DATA_RECORD_BULK_MAX_ITEMS = config('DATA_RECORD_BULK_MAX_ITEMS', default=500, cast=int)
+DATA_RECORD_BULK_CHUNK_SIZE = config('DATA_RECORD_BULK_CHUNK_SIZE', default=100, cast=int)  # rows per INSERT
+# Streaming export (GET /api/records/export/, see api/export.py): rows per query
+DATA_EXPORT_CHUNK_SIZE = config('DATA_EXPORT_CHUNK_SIZE', default=2000, cast=int)
+# Delta sync (GET /api/sync/, see api/sync.py): change log rows per response, and
+# how old a change must be before it is sent (covers transactions still committing)
+SYNC_MAX_CHANGES = config('SYNC_MAX_CHANGES', default=1000, cast=int)
+SYNC_SETTLE_SECONDS = config('SYNC_SETTLE_SECONDS', default=5, cast=int)
+# Superseded change log rows deleted per statement by the nightly compaction
+SYNC_COMPACT_BATCH_SIZE = config('SYNC_COMPACT_BATCH_SIZE', default=500, cast=int)
+# data_content checked against Form.form_structure on create/update and bulk upload
+# (gpscontrol4u/schema.py); compiled form schemas kept in memory per process
+DATA_RECORD_SCHEMA_VALIDATION = config('DATA_RECORD_SCHEMA_VALIDATION', default=True, cast=bool)
+FORM_SCHEMA_CACHE_SIZE = config('FORM_SCHEMA_CACHE_SIZE', default=512, cast=int)
+
 # Django Allauth (simplified for now)
 SITE_ID = 1
 LOGIN_REDIRECT_URL = '/dashboard/'
@@ -279,6 +310,40 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# Run tasks in-process instead of sending them to the broker (local runs)
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+CELERY_TASK_ACKS_LATE = True
+
+# Periodic tasks (run with `celery -A marketplace_backend beat`)
+PLAN_EXPIRY_SWEEP_INTERVAL = config('PLAN_EXPIRY_SWEEP_INTERVAL', default=15 * 60, cast=int)  # seconds
+PLAN_EXPIRY_BATCH_SIZE = config('PLAN_EXPIRY_BATCH_SIZE', default=500, cast=int)
+CELERY_BEAT_SCHEDULE = {
+    'expire-plan-purchases': {
+        'task': 'payments.tasks.expire_plan_purchases',
+        'schedule': PLAN_EXPIRY_SWEEP_INTERVAL,
+    },
+    'reconcile-subscriptions': {
+        'task': 'payments.tasks.reconcile_subscriptions',
+        'schedule': crontab(hour=config('RECONCILIATION_HOUR', default=3, cast=int), minute=0),
+    },
+    'compact-sync-changes': {
+        'task': 'gpscontrol4u.tasks.compact_sync_changes',
+        'schedule': crontab(hour=config('SYNC_COMPACT_HOUR', default=4, cast=int), minute=30),
+    },
+}
+
+# Nightly reconciliation with the ElisaSoftware API (see payments/reconciliation.py)
+RECONCILIATION_MAX_USERS = config('RECONCILIATION_MAX_USERS', default=2000, cast=int)  # users per nightly run
+RECONCILIATION_BATCH_SIZE = config('RECONCILIATION_BATCH_SIZE', default=100, cast=int)  # users per cursor step
+RECONCILIATION_CONCURRENCY = config('RECONCILIATION_CONCURRENCY', default=4, cast=int)  # users fetched at once
+RECONCILIATION_RATE = config('RECONCILIATION_RATE', default=5, cast=float)  # API calls per second
+
+# Mercado Pago webhook processing (see accounts/tasks.py)
+MP_WEBHOOK_MAX_RETRIES = config('MP_WEBHOOK_MAX_RETRIES', default=5, cast=int)
+MP_WEBHOOK_RETRY_DELAY = config('MP_WEBHOOK_RETRY_DELAY', default=10, cast=int)  # seconds, doubled per retry
+# Seconds an unfinished payment activation claim blocks others before it can be taken over;
+# longer than an activation's external API calls with their retry
+PAYMENT_EVENT_CLAIM_LEASE = config('PAYMENT_EVENT_CLAIM_LEASE', default=300, cast=int)
 
 # Email Configuration
 EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
@@ -304,18 +369,114 @@ EXTERNAL_API_BASE_URL = config('EXTERNAL_API_BASE_URL', default='https://api2ego
 EXTERNAL_API_USERNAME = config('EXTERNAL_API_USERNAME', default='AdmGPScontrol4u')
 EXTERNAL_API_PASSWORD = config('EXTERNAL_API_PASSWORD', default='GPSc0ntr0l4u*')
 EXTERNAL_API_STORE = config('EXTERNAL_API_STORE', default='GPScontrol4U')
+# Refresh the shared bearer token this many seconds before its JWT exp claim
+EXTERNAL_API_TOKEN_REFRESH_MARGIN = config('EXTERNAL_API_TOKEN_REFRESH_MARGIN', default=300, cast=int)
+
+# Shared outbound HTTP pool (see http_client.py)
+EXTERNAL_HTTP_CONNECT_TIMEOUT = config('EXTERNAL_HTTP_CONNECT_TIMEOUT', default=5, cast=float)
+EXTERNAL_HTTP_READ_TIMEOUT = config('EXTERNAL_HTTP_READ_TIMEOUT', default=30, cast=float)
+EXTERNAL_HTTP_POOL_MAXSIZE = config('EXTERNAL_HTTP_POOL_MAXSIZE', default=10, cast=int)
+EXTERNAL_HTTP_POOL_TIMEOUT = config('EXTERNAL_HTTP_POOL_TIMEOUT', default=10, cast=float)
+EXTERNAL_HTTP_POOL_SIZES = {
+    'api2ego.elisasoftware.com.mx': config('EXTERNAL_API_POOL_SIZE', default=10, cast=int),
+    'api.mercadopago.com': config('MERCADO_PAGO_POOL_SIZE', default=4, cast=int),
+}
+
+# RFC/TIN lookup cache (accounts/rfc_validator.py): taken RFCs rarely become free again
+RFC_VALIDATION_EXISTS_TTL = config('RFC_VALIDATION_EXISTS_TTL', default=24 * 60 * 60, cast=int)
+RFC_VALIDATION_AVAILABLE_TTL = config('RFC_VALIDATION_AVAILABLE_TTL', default=5 * 60, cast=int)
+
+# Circuit breaker and bulkhead per ElisaSoftware endpoint family (see circuit_breaker.py)
+CIRCUIT_BREAKER_FAILURE_RATE = config('CIRCUIT_BREAKER_FAILURE_RATE', default=0.5, cast=float)
+CIRCUIT_BREAKER_MINIMUM_CALLS = config('CIRCUIT_BREAKER_MINIMUM_CALLS', default=5, cast=int)
+CIRCUIT_BREAKER_WINDOW_SIZE = config('CIRCUIT_BREAKER_WINDOW_SIZE', default=20, cast=int)
+CIRCUIT_BREAKER_RESET_TIMEOUT = config('CIRCUIT_BREAKER_RESET_TIMEOUT', default=30, cast=int)  # seconds open before a probe
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = config('CIRCUIT_BREAKER_SLOW_CALL_SECONDS', default=10, cast=float)
+EXTERNAL_API_BULKHEAD_WAIT = config('EXTERNAL_API_BULKHEAD_WAIT', default=0.5, cast=float)  # seconds to wait for a slot
+EXTERNAL_API_BULKHEADS = {  # max in-flight calls per process
+    'login': config('EXTERNAL_API_BULKHEAD_LOGIN', default=2, cast=int),
+    'plans': config('EXTERNAL_API_BULKHEAD_PLANS', default=2, cast=int),
+    'subscription': config('EXTERNAL_API_BULKHEAD_SUBSCRIPTION', default=4, cast=int),
+    'client_lookup': config('EXTERNAL_API_BULKHEAD_CLIENT_LOOKUP', default=4, cast=int),
+    'phone': config('EXTERNAL_API_BULKHEAD_PHONE', default=4, cast=int),
+}
 
 # Cache configuration for external API responses
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-        'TIMEOUT': 300,  # 5 minutes default
-        'OPTIONS': {
-            'MAX_ENTRIES': 1000,
+# Runtime state shared by the workers of this host (file cache, plan snapshot,
+# metrics, locks), kept out of the source tree; /var/tmp survives reboots, unlike /tmp
+RUNTIME_DIR = config(
+    'RUNTIME_DIR',
+    default=os.path.join('/var/tmp' if os.path.isdir('/var/tmp') else tempfile.gettempdir(), 'gpscontrol4u'),
+)
+
+# The default cache must be shared by all gunicorn workers (plan catalogue,
+# API token, circuit breakers): Redis when CACHE_REDIS_URL is set, otherwise
+# a file cache. It only holds those few fixed keys, so it is never culled.
+# Per-user dashboard snapshots and RFC lookups ('user_data') and template
+# fragments ('template_fragments', picked up by {% cache %}) grow with the
+# number of users and plans; they have their own stores and limits, and
+# culling them never drops the token or a catalogue entry.
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
+if CACHE_REDIS_URL:
+    def _cache(prefix):
+        return {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'TIMEOUT': 300,  # 5 minutes default
+            'KEY_PREFIX': prefix,
         }
+    CACHES = {
+        'default': _cache('gpscontrol4u'),
+        'user_data': _cache('gpscontrol4u:user_data'),
+        'template_fragments': _cache('gpscontrol4u:fragments'),
     }
-}
+else:
+    FILE_CACHE_DIR = config('FILE_CACHE_DIR', default=os.path.join(RUNTIME_DIR, 'cache'))
+
+    def _cache(location, max_entries):
+        return {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': location,
+            'TIMEOUT': 300,  # 5 minutes default
+            'OPTIONS': {
+                'MAX_ENTRIES': max_entries,
+            }
+        }
+    CACHES = {
+        'default': _cache(FILE_CACHE_DIR, 1000),
+        'user_data': _cache(os.path.join(FILE_CACHE_DIR, 'user_data'),
+                            config('USER_DATA_CACHE_MAX_ENTRIES', default=10000, cast=int)),
+        'template_fragments': _cache(os.path.join(FILE_CACHE_DIR, 'fragments'),
+                                     config('FRAGMENT_CACHE_MAX_ENTRIES', default=2000, cast=int)),
+    }
+
+# Single-flight lock files (token login, plan refresh) when the cache is not
+# Redis: the file cache's add() is not atomic (see locks.py)
+LOCK_DIR = config('LOCK_DIR', default=os.path.join(RUNTIME_DIR, 'locks'))
+
+# Plan catalogue cache (see plan_catalogue.py)
+PLAN_CACHE_SOFT_TTL = config('PLAN_CACHE_SOFT_TTL', default=5 * 60, cast=int)
+PLAN_CACHE_HARD_TTL = config('PLAN_CACHE_HARD_TTL', default=60 * 60, cast=int)
+PLAN_CACHE_SNAPSHOT_PATH = config('PLAN_CACHE_SNAPSHOT_PATH', default=os.path.join(RUNTIME_DIR, 'plans_snapshot.json'))
+
+# Per-user dashboard snapshot cache (see accounts/dashboard.py); invalidated by
+# signals, the TTL only bounds staleness of day counters and expirations
+DASHBOARD_SNAPSHOT_TTL = config('DASHBOARD_SNAPSHOT_TTL', default=5 * 60, cast=int)
+
+# Request performance instrumentation (see instrumentation.py). Latency of
+# every request and outbound call is aggregated in-process; this fraction of
+# requests also gets the DB / template / outbound breakdown
+PERF_SAMPLE_RATE = config('PERF_SAMPLE_RATE', default=0.05, cast=float)
+# Send the breakdown of sampled requests to the client as a Server-Timing header
+PERF_SERVER_TIMING = config('PERF_SERVER_TIMING', default=DEBUG, cast=bool)
+
+# /api/metrics/ (see metrics_export.py): every process writes its counters to
+# this directory, shared by all gunicorn and Celery workers of the host
+METRICS_MULTIPROC_DIR = config('METRICS_MULTIPROC_DIR', default=os.path.join(RUNTIME_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=5, cast=float)  # seconds
+# Scrapes must send "Authorization: Bearer <token>"; with no token the endpoint
+# answers 403 unless DEBUG is on
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
 
 # Security Settings
 if not DEBUG:
@@ -329,9 +490,18 @@ if not DEBUG:
     CSRF_COOKIE_SECURE = True
 
 # Logging Configuration
+# Level of the plan activation loggers; DEBUG adds full request/response payloads (redacted)
+PLAN_ACTIVATION_LOG_LEVEL = config('PLAN_ACTIVATION_LOG_LEVEL', default='INFO')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        # Masks passwords, tokens and Authorization headers (see log_utils.py)
+        'redact': {
+            '()': 'log_utils.RedactingFilter',
+        },
+    },
     'formatters': {
         'verbose': {
             'format': '{levelname} {asctime} {module} {process:d} {thread:d} {message}',
@@ -350,20 +520,25 @@ LOGGING = {
         'console': {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
+            'filters': ['redact'],
         },
         'plan_activation_console': {
             'class': 'logging.StreamHandler',
             'formatter': 'plan_activation',
+            'filters': ['redact'],
         },
+        # File handlers only enqueue on the calling thread; a listener thread writes
         'file': {
-            'class': 'logging.FileHandler',
+            'class': 'log_utils.QueuedFileHandler',
             'filename': BASE_DIR / 'logs' / 'django.log',
             'formatter': 'verbose',
+            'filters': ['redact'],
         },
         'plan_activation_file': {
-            'class': 'logging.FileHandler',
+            'class': 'log_utils.QueuedFileHandler',
             'filename': BASE_DIR / 'logs' / 'plan_activation.log',
             'formatter': 'plan_activation',
+            'filters': ['redact'],
         },
     },
     'loggers': {
@@ -373,18 +548,40 @@ LOGGING = {
             'propagate': True,
         },
         'accounts.views': {
-            'handlers': ['console', 'plan_activation_console', 'plan_activation_file'],
-            'level': 'DEBUG',
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
+            'propagate': False,
+        },
+        # Webhook processing and fallback activation (Celery)
+        'accounts.tasks': {
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
+            'propagate': False,
+        },
+        # Plan expiry sweep and subscription reconciliation
+        'payments.tasks': {
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
+            'propagate': False,
+        },
+        'payments.reconciliation': {
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
             'propagate': False,
         },
         'subscription_service': {
-            'handlers': ['console', 'plan_activation_console', 'plan_activation_file'],
-            'level': 'DEBUG',
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
             'propagate': False,
         },
         'external_api_service': {
-            'handlers': ['console', 'plan_activation_console', 'plan_activation_file'],
-            'level': 'DEBUG',
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
+            'propagate': False,
+        },
+        'external_api_auth': {
+            'handlers': ['plan_activation_console', 'plan_activation_file'],
+            'level': PLAN_ACTIVATION_LOG_LEVEL,
             'propagate': False,
         },
     },
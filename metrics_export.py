@@ -0,0 +1,292 @@
+"""
+Prometheus metrics aggregated across worker processes
+
+Each process (web worker, Celery worker) keeps its counters in
+memory (instrumentation.metrics plus the plan catalogue, RFC and form schema
+cache counters) and writes them to METRICS_MULTIPROC_DIR/<pid>-<start>.json
+at most every METRICS_FLUSH_INTERVAL seconds and at exit. /api/metrics/ sums
+every file, so any worker can answer the scrape. Files left by processes
+that are gone are folded into archive.json, which keeps the totals
+monotonic across worker restarts without the directory growing.
+
+Queue depths and PlanPurchase counts are read from the database at scrape
+time, so they need no aggregation.
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils import timezone
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = '.lock'
+
+METRIC_HELP = {
+    'http_request_duration_seconds': 'Request latency by view and method',
+    'http_request_db_seconds': 'Database time per sampled request',
+    'http_request_db_queries_total': 'Database queries of sampled requests',
+    'http_request_template_seconds': 'Template render time per sampled request',
+    'http_requests_sampled_total': 'Requests with the DB / template / outbound breakdown',
+    'outbound_request_duration_seconds': 'Outbound HTTP call latency by service and upstream host',
+    'outbound_request_errors_total': 'Outbound HTTP calls that failed or returned a 5xx',
+    'plan_cache_requests_total': 'Plan catalogue lookups by result (hit, stale, miss, snapshot)',
+    'rfc_validation_cache_requests_total': 'RFC/TIN validation cache lookups by result',
+    'form_schema_cache_requests_total': 'Compiled form schema lookups by result (hit, miss)',
+    'webhook_events': 'Webhook events not yet processed, by status',
+    'webhook_oldest_pending_age_seconds': 'Age of the oldest pending webhook event',
+    'plan_purchases': 'Plan purchases by status',
+    'plan_purchase_activations_total': 'Plan purchases that were activated',
+    'plan_purchase_expirations_total': 'Plan purchases that expired',
+}
+
+_process_file = None
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def multiproc_dir():
+    return getattr(settings, 'METRICS_MULTIPROC_DIR', '')
+
+
+def process_snapshot():
+    """This process's counters as a JSON-serializable dict"""
+    from accounts.rfc_validator import RFCValidatorService
+    from gpscontrol4u.schema import SchemaCache
+    from plan_catalogue import plan_catalogue
+
+    snapshot = instrumentation.metrics.snapshot()
+    counters = [[name, list(labels), value] for (name, labels), value in snapshot['counters'].items()]
+    for result, value in plan_catalogue.stats.items():
+        counters.append(['plan_cache_requests_total', [['result', result]], value])
+    for result, value in RFCValidatorService.stats.items():
+        counters.append(['rfc_validation_cache_requests_total', [['result', result]], value])
+    for result, value in SchemaCache.stats.items():
+        counters.append(['form_schema_cache_requests_total', [['result', result]], value])
+    return {
+        'histograms': [[name, list(labels), data] for (name, labels), data in snapshot['histograms'].items()],
+        'counters': counters,
+    }
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def flush(force=False):
+    """Write this process's counters to the shared directory (rate limited unless `force`)"""
+    global _process_file, _last_flush
+    directory = multiproc_dir()
+    if not directory:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+        return
+    with _flush_lock:
+        if not force and now - _last_flush < getattr(settings, 'METRICS_FLUSH_INTERVAL', 5):
+            return
+        _last_flush = now
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if _process_file is None or not _process_file.startswith(f'{os.getpid()}-'):
+                # A new file per process: a reused pid must not overwrite a dead worker's totals
+                _process_file = f'{os.getpid()}-{time.time_ns()}.json'
+                atexit.register(flush, force=True)
+            _write_json(os.path.join(directory, _process_file), process_snapshot())
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {directory}: {e}")
+
+
+def _empty():
+    return {'histograms': [], 'counters': []}
+
+
+def _merge(totals, data):
+    for name, labels, histogram in data.get('histograms', []):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        current = totals['histograms'].get(key)
+        if current is None or current['buckets'] != histogram['buckets']:
+            totals['histograms'][key] = {
+                'buckets': histogram['buckets'],
+                'counts': list(histogram['counts']),
+                'sum': histogram['sum'],
+                'count': histogram['count'],
+            }
+            continue
+        current['counts'] = [a + b for a, b in zip(current['counts'], histogram['counts'])]
+        current['sum'] += histogram['sum']
+        current['count'] += histogram['count']
+    for name, labels, value in data.get('counters', []):
+        key = (name, tuple(tuple(pair) for pair in labels))
+        totals['counters'][key] = totals['counters'].get(key, 0) + value
+
+
+def _to_file_format(totals):
+    return {
+        'histograms': [[name, [list(p) for p in labels], data] for (name, labels), data in totals['histograms'].items()],
+        'counters': [[name, [list(p) for p in labels], value] for (name, labels), value in totals['counters'].items()],
+    }
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return _empty()
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect():
+    """Counters of every process, summed: {'histograms': {(name, labels): dict}, 'counters': {...}}"""
+    totals = {'histograms': {}, 'counters': {}}
+    directory = multiproc_dir()
+    if not directory:
+        _merge(totals, process_snapshot())
+        return totals
+
+    flush(force=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, ARCHIVE_FILE)
+        archive = {'histograms': {}, 'counters': {}}
+        _merge(archive, _read(archive_path))
+        dead = []
+        live = []
+        for name in os.listdir(directory):
+            if not name.endswith('.json') or name == ARCHIVE_FILE:
+                continue
+            try:
+                pid = int(name.split('-', 1)[0])
+            except ValueError:
+                continue
+            path = os.path.join(directory, name)
+            if pid != os.getpid() and not _is_alive(pid):
+                _merge(archive, _read(path))
+                dead.append(path)
+            else:
+                live.append(path)
+        if dead:
+            _write_json(archive_path, _to_file_format(archive))
+            for path in dead:
+                os.unlink(path)
+
+        _merge(totals, _to_file_format(archive))
+        for path in live:
+            _merge(totals, _read(path))
+    return totals
+
+
+def database_gauges():
+    """[(name, type, [(labels, value)])] read from the database at scrape time"""
+    from payments.models import PlanPurchase, WebhookEvent
+
+    unprocessed = (
+        WebhookEvent.objects.exclude(status='processed')
+        .values('status').annotate(count=Count('id'), oldest=Min('created_at'))
+    )
+    webhook_counts = {row['status']: row for row in unprocessed}
+    oldest_pending = webhook_counts.get('pending', {}).get('oldest')
+
+    purchases = PlanPurchase.objects.order_by().values('status').annotate(
+        count=Count('id'), activated=Count('activation_date'),
+    )
+    purchase_counts = {row['status']: row for row in purchases}
+
+    return [
+        ('webhook_events', 'gauge', [
+            ((('status', status),), webhook_counts.get(status, {}).get('count', 0))
+            for status, _label in WebhookEvent.STATUS_CHOICES if status != 'processed'
+        ]),
+        ('webhook_oldest_pending_age_seconds', 'gauge', [
+            ((), (timezone.now() - oldest_pending).total_seconds() if oldest_pending else 0),
+        ]),
+        ('plan_purchases', 'gauge', [
+            ((('status', status),), purchase_counts.get(status, {}).get('count', 0))
+            for status, _label in PlanPurchase.STATUS_CHOICES
+        ]),
+        ('plan_purchase_activations_total', 'counter', [
+            ((), sum(row['activated'] for row in purchase_counts.values())),
+        ]),
+        ('plan_purchase_expirations_total', 'counter', [
+            ((), purchase_counts.get('expired', {}).get('count', 0)),
+        ]),
+    ]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return format(value, 'g') if isinstance(value, float) else str(value)
+
+
+def _header(lines, name, kind):
+    lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def render(totals, gauges=()):
+    """Prometheus text exposition format"""
+    lines = []
+
+    histograms = {}
+    for (name, labels), data in sorted(totals['histograms'].items()):
+        histograms.setdefault(name, []).append((labels, data))
+    for name, series in histograms.items():
+        _header(lines, name, 'histogram')
+        for labels, data in series:
+            cumulative = 0
+            for bound, count in zip(list(data['buckets']) + [math.inf], data['counts']):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', _number(float(bound))),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(float(data['sum']))}")
+            lines.append(f"{name}_count{_labels(labels)} {data['count']}")
+
+    counters = {}
+    for (name, labels), value in sorted(totals['counters'].items()):
+        counters.setdefault(name, []).append((labels, value))
+    for name, series in counters.items():
+        _header(lines, name, 'counter')
+        for labels, value in series:
+            lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+    for name, kind, series in gauges:
+        _header(lines, name, kind)
+        for labels, value in series:
+            lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+    return '\n'.join(lines) + '\n'
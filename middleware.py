@@ -1,3 +1,6 @@
+import instrumentation
+import metrics_export
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.utils import translation
 from django.utils.deprecation import MiddlewareMixin
 
@@ -37,3 +40,44 @@ class ForceSpanishMiddleware(MiddlewareMixin):
         # Set in session if not already set
         if 'django_language' not in request.session:
             request.session['django_language'] = language
+
+
+class PerformanceMiddleware:
+    """
+    Time every request (see instrumentation.py)
+
+    Listed first so the time of the other middleware is included. Works in
+    both sync (WSGI) and async (ASGI) stacks without a thread switch. The
+    counters are periodically written for /api/metrics/ (metrics_export.py).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timings, token = instrumentation.start_request()
+        response = None
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.finish_request(request, response, timings, token)
+            metrics_export.flush()
+        return response
+
+    async def __acall__(self, request):
+        timings, token = instrumentation.start_request()
+        response = None
+        try:
+            response = await self.get_response(request)
+        finally:
+            instrumentation.finish_request(request, response, timings, token)
+            metrics_export.flush()
+        return response
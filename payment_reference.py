@@ -0,0 +1,125 @@
+"""
+Codec for the Mercado Pago external_reference
+
+References issued by create_mercado_pago_preference look like
+``gp1.<plan_id>.<user_id>.<timestamp>.<signature>``: a version tag, the ids,
+the issue time in base 36 and a SECRET_KEY signature, so a reference that was
+tampered with in transit is rejected. References issued before the codec
+existed (``plan_subscription_*`` / ``premium_subscription_*``) still decode.
+"""
+
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.core import signing
+
+logger = logging.getLogger(__name__)
+
+VERSION = 'gp1'
+SEPARATOR = '.'
+SALT = 'payments.external_reference'
+DEFAULT_LEGACY_PLAN_ID = '2'  # Plan assumed for references that carry no plan id
+
+LEGACY_PREFIXES = ('plan_subscription_', 'premium_subscription_')
+
+
+class InvalidReference(ValueError):
+    """The external reference cannot be decoded or its signature does not match"""
+
+
+class PaymentReference:
+    """Decoded external reference"""
+
+    def __init__(self, plan_id, user_id, issued_at=None, version=VERSION, signed=True):
+        self.plan_id = str(plan_id)
+        self.user_id = int(user_id) if user_id is not None else None
+        self.issued_at = issued_at
+        self.version = version
+        self.signed = signed
+
+    def __repr__(self):
+        return f"PaymentReference(version={self.version!r}, plan_id={self.plan_id!r}, user_id={self.user_id!r})"
+
+
+def _signer():
+    return signing.Signer(sep=SEPARATOR, salt=SALT)
+
+
+def _to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if not number:
+            return encoded
+
+
+def encode_reference(plan_id, user_id, issued_at=None):
+    """Build a signed external_reference for a plan purchase"""
+    timestamp = int(issued_at.timestamp() if issued_at else time.time())
+    value = SEPARATOR.join([VERSION, str(plan_id), str(int(user_id)), _to_base36(timestamp)])
+    return _signer().sign(value)
+
+
+def decode_reference(external_reference):
+    """
+    Decode an external_reference in one pass
+
+    Returns:
+        PaymentReference
+    Raises:
+        InvalidReference: for unknown formats or a bad signature
+    """
+    if not external_reference:
+        raise InvalidReference("Empty external reference")
+
+    if external_reference.startswith(VERSION + SEPARATOR):
+        try:
+            value = _signer().unsign(external_reference)
+        except signing.BadSignature as e:
+            raise InvalidReference(f"Bad signature on external reference {external_reference}") from e
+        try:
+            _, plan_id, user_id, timestamp = value.split(SEPARATOR)
+            issued_at = datetime.fromtimestamp(int(timestamp, 36), tz=dt_timezone.utc)
+            return PaymentReference(plan_id, user_id, issued_at)
+        except (ValueError, OverflowError) as e:
+            raise InvalidReference(f"Malformed external reference {external_reference}") from e
+
+    if external_reference.startswith(LEGACY_PREFIXES):
+        return _decode_legacy(external_reference)
+
+    raise InvalidReference(f"Unknown external reference format: {external_reference}")
+
+
+def _decode_legacy(external_reference):
+    """
+    New format: plan_subscription_{plan_id}_{user_id}_{timestamp}
+    Legacy format: premium_subscription_{plan_id}_{user_id}_{timestamp}
+    Old format: premium_subscription_{user_id}_{timestamp}
+    """
+    ref_parts = external_reference.split('_')
+
+    if len(ref_parts) >= 5:
+        potential_plan_id = ref_parts[2]
+        potential_user_id = ref_parts[3]
+        # If both are numeric and plan_id is reasonable (1-10), it's the plan format
+        if (potential_plan_id.isdigit() and potential_user_id.isdigit() and
+                1 <= int(potential_plan_id) <= 10):
+            return PaymentReference(potential_plan_id, potential_user_id, version='legacy', signed=False)
+
+    if len(ref_parts) >= 3 and ref_parts[2].isdigit():
+        # Old format without plan_id (or one whose ids are not both numeric)
+        return PaymentReference(DEFAULT_LEGACY_PLAN_ID, ref_parts[2], version='legacy', signed=False)
+
+    raise InvalidReference(f"Invalid external reference format: {external_reference}")
+
+
+def plan_id_from_reference(external_reference, default=DEFAULT_LEGACY_PLAN_ID):
+    """Plan id carried by the reference, or `default` if it cannot be decoded"""
+    try:
+        return decode_reference(external_reference).plan_id
+    except InvalidReference as e:
+        logger.warning(f"Could not decode external reference: {e}")
+        return str(default)
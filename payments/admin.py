@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Subscription, Payment, PricingPlan
+from django.utils import timezone
+from .models import (
+    Subscription, Payment, PricingPlan, PaymentEvent, WebhookEvent,
+    SubscriptionDiscrepancy, ReconciliationCursor,
+)
 
 
 @admin.register(Subscription)
@@ -23,14 +27,14 @@ class SubscriptionAdmin(admin.ModelAdmin):
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('user', 'amount', 'currency', 'payment_provider', 'payment_type', 'status', 'created_at')
     list_filter = ('payment_provider', 'payment_type', 'status', 'currency', 'created_at')
-    search_fields = ('user__email', 'stripe_payment_intent_id', 'mercado_pago_payment_id', 'description')
+    search_fields = ('user__email', 'stripe_payment_intent_id', 'mercado_pago_payment_id', 'external_reference', 'description')
     raw_id_fields = ('user', 'subscription')
     readonly_fields = ('created_at', 'updated_at')
     
     fieldsets = (
         (None, {'fields': ('user', 'subscription', 'payment_provider', 'payment_type')}),
         ('Payment Details', {'fields': ('amount', 'currency', 'status', 'description')}),
-        ('Provider IDs', {'fields': ('stripe_payment_intent_id', 'mercado_pago_payment_id')}),
+        ('Provider IDs', {'fields': ('stripe_payment_intent_id', 'mercado_pago_payment_id', 'external_reference', 'external_plan_id')}),
         ('Metadata', {'fields': ('metadata',)}),
         ('Timestamps', {'fields': ('created_at', 'updated_at')}),
     )
@@ -49,3 +53,40 @@ class PricingPlanAdmin(admin.ModelAdmin):
         ('Mercado Pago', {'fields': ('mercado_pago_plan_id',)}),
         ('Status', {'fields': ('is_active',)}),
     )
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('provider', 'payment_id', 'event_type', 'status', 'result', 'attempts', 'created_at', 'processed_at')
+    list_filter = ('provider', 'status', 'event_type', 'created_at')
+    search_fields = ('payment_id', 'result', 'last_error')
+    readonly_fields = ('created_at', 'updated_at', 'processed_at')
+
+
+@admin.register(PaymentEvent)
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ('provider', 'provider_payment_id', 'event_type', 'status', 'user', 'created_at', 'claimed_at')
+    list_filter = ('provider', 'event_type', 'status', 'created_at')
+    search_fields = ('provider_payment_id', 'user__email')
+    readonly_fields = ('created_at',)
+
+
+@admin.register(SubscriptionDiscrepancy)
+class SubscriptionDiscrepancyAdmin(admin.ModelAdmin):
+    list_display = ('user', 'kind', 'key', 'status', 'local_value', 'remote_value', 'first_seen_at', 'last_seen_at')
+    list_filter = ('status', 'kind', 'last_seen_at')
+    search_fields = ('user__email', 'user__rfc_tin', 'key')
+    raw_id_fields = ('user',)
+    readonly_fields = ('first_seen_at', 'last_seen_at', 'resolved_at')
+    actions = ['mark_resolved']
+    
+    def mark_resolved(self, request, queryset):
+        count = queryset.filter(status='open').update(status='resolved', resolved_at=timezone.now())
+        self.message_user(request, f'{count} discrepancies marked as resolved.')
+    mark_resolved.short_description = 'Mark selected discrepancies as resolved'
+
+
+@admin.register(ReconciliationCursor)
+class ReconciliationCursorAdmin(admin.ModelAdmin):
+    list_display = ('name', 'position', 'pass_started_at', 'last_pass_completed_at', 'last_run_at')
+    readonly_fields = ('last_run_at', 'last_run_stats')
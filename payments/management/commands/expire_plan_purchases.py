@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments.models import PlanPurchase
+
+
+class Command(BaseCommand):
+    help = 'Mark active plan purchases past their expiration date as expired and sync subscriptions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Purchases expired per UPDATE (default: 500)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many purchases would be expired without changing them'
+        )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = PlanPurchase.objects.filter(status='active', expiration_date__lt=timezone.now()).count()
+            self.stdout.write(self.style.WARNING(f'DRY RUN: Would expire {count} plan purchases'))
+            return
+        
+        count = PlanPurchase.expire_overdue(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Expired {count} plan purchases'))
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from payments.models import ReconciliationCursor, SubscriptionDiscrepancy
+from payments.reconciliation import SubscriptionReconciler
+
+
+class Command(BaseCommand):
+    help = 'Compare local plan purchases and licenses with the external API and record discrepancies'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-users',
+            type=int,
+            help='Stop after this many users; the next run continues from the cursor (default: all)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Users per cursor step (default: RECONCILIATION_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Users fetched from the API at the same time (default: RECONCILIATION_CONCURRENCY)'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='Maximum API calls per second, 0 for no limit (default: RECONCILIATION_RATE)'
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Start a new pass from the first user instead of the saved cursor'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Log the discrepancies without writing them or moving the cursor'
+        )
+
+    def handle(self, *args, **options):
+        reconciler = SubscriptionReconciler(
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
+        stats = reconciler.run(max_users=options['max_users'], restart=options['restart'])
+
+        prefix = 'DRY RUN: ' if options['dry_run'] else ''
+        style = self.style.WARNING if stats['errors'] or stats['aborted'] else self.style.SUCCESS
+        self.stdout.write(style(
+            f"{prefix}Checked {stats['users']} users: {stats['consistent']} consistent, "
+            f"{stats['inconsistent']} with discrepancies, {stats['errors']} errors, {stats['resolved']} resolved"
+        ))
+        if stats['aborted']:
+            self.stdout.write(self.style.WARNING('Stopped early: the external API is unavailable'))
+
+        cursor = ReconciliationCursor.objects.filter(name=SubscriptionReconciler.CURSOR_NAME).first()
+        if cursor:
+            self.stdout.write(f'Cursor at user {cursor.position}, last full pass: {cursor.last_pass_completed_at or "never"}')
+
+        open_counts = (
+            SubscriptionDiscrepancy.objects.filter(status='open')
+            .values('kind').annotate(count=Count('id')).order_by('kind')
+        )
+        for row in open_counts:
+            self.stdout.write(f"  open {row['kind']}: {row['count']}")
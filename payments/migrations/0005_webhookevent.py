@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_subscription_current_plan_purchase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('stripe', 'Stripe'), ('mercado_pago', 'Mercado Pago')], max_length=20)),
+                ('event_type', models.CharField(default='payment', max_length=50)),
+                ('payment_id', models.CharField(help_text='Provider payment ID from the notification', max_length=255)),
+                ('payload', models.JSONField(blank=True, default=dict, help_text='Raw notification body')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('processed', 'Processed'), ('waiting', 'Waiting for payment approval'), ('failed', 'Failed - requires manual review')], default='pending', max_length=15)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('result', models.CharField(blank=True, help_text='Outcome of the last processing run', max_length=100)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='webhook_status_updated_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='webhookevent',
+            constraint=models.UniqueConstraint(fields=('provider', 'payment_id'), name='unique_webhook_event_per_payment'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_activation_events(apps, schema_editor):
+    """Record payments activated before the ledger existed so they are not activated twice"""
+    Payment = apps.get_model('payments', 'Payment')
+    PaymentEvent = apps.get_model('payments', 'PaymentEvent')
+    payments = Payment.objects.filter(mercado_pago_payment_id__isnull=False).exclude(mercado_pago_payment_id='')
+    PaymentEvent.objects.bulk_create(
+        [
+            PaymentEvent(
+                provider='mercado_pago',
+                provider_payment_id=payment.mercado_pago_payment_id,
+                event_type='activation',
+                user_id=payment.user_id,
+            )
+            for payment in payments.only('mercado_pago_payment_id', 'user_id').iterator()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payments', '0005_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='mercado_pago_payment_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_payment_intent_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.CreateModel(
+            name='PaymentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('stripe', 'Stripe'), ('mercado_pago', 'Mercado Pago')], max_length=20)),
+                ('provider_payment_id', models.CharField(max_length=255)),
+                ('event_type', models.CharField(choices=[('activation', 'Plan activation')], max_length=30)),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payment_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='paymentevent',
+            constraint=models.UniqueConstraint(fields=('provider', 'provider_payment_id', 'event_type'), name='unique_payment_event'),
+        ),
+        migrations.RunPython(backfill_activation_events, migrations.RunPython.noop),
+    ]
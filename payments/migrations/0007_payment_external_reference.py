@@ -0,0 +1,42 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:24
+
+from django.db import migrations, models
+
+
+def backfill_external_reference(apps, schema_editor):
+    """Copy the reference and plan id recorded in metadata into the new columns"""
+    Payment = apps.get_model('payments', 'Payment')
+    batch = []
+    for payment in Payment.objects.only('metadata').iterator():
+        metadata = payment.metadata or {}
+        if not metadata.get('external_reference') and metadata.get('plan_id') is None:
+            continue
+        payment.external_reference = metadata.get('external_reference')
+        payment.external_plan_id = str(metadata['plan_id']) if metadata.get('plan_id') is not None else None
+        batch.append(payment)
+        if len(batch) >= 500:
+            Payment.objects.bulk_update(batch, ['external_reference', 'external_plan_id'])
+            batch = []
+    if batch:
+        Payment.objects.bulk_update(batch, ['external_reference', 'external_plan_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_paymentevent_payment_provider_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='external_plan_id',
+            field=models.CharField(blank=True, help_text='ID from external API plan system', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='external_reference',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(backfill_external_reference, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_payment_external_reference'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='planpurchase',
+            index=models.Index(fields=['status', 'expiration_date'], name='purchase_status_expiry_idx'),
+        ),
+    ]
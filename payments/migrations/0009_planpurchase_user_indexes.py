@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_planpurchase_status_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='planpurchase',
+            index=models.Index(fields=['user', 'status', '-purchase_date'], name='purchase_user_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='planpurchase',
+            index=models.Index(fields=['user', 'plan_category'], name='purchase_user_category_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.16 on 2026-10-16 22:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payments', '0009_planpurchase_user_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('position', models.BigIntegerField(default=0, help_text='Last user pk processed in the current pass')),
+                ('pass_started_at', models.DateTimeField(blank=True, null=True)),
+                ('last_pass_completed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_run_at', models.DateTimeField(blank=True, null=True)),
+                ('last_run_stats', models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SubscriptionDiscrepancy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('client_missing_remote', 'Registered locally, client not found remotely'), ('client_id_mismatch', 'Client ID differs'), ('licenses_mismatch', 'License count differs'), ('plan_missing_remote', 'Active local plan without a remote subscription'), ('plan_missing_local', 'Remote subscription without an active local plan'), ('activation_failed', 'Payment received but activation failed')], max_length=30)),
+                ('key', models.CharField(blank=True, default='', help_text='Plan ID or payment ID the discrepancy is about, empty for user-level kinds', max_length=255)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('resolved', 'Resolved')], default='open', max_length=10)),
+                ('local_value', models.CharField(blank=True, max_length=255)),
+                ('remote_value', models.CharField(blank=True, max_length=255)),
+                ('details', models.JSONField(blank=True, default=dict)),
+                ('first_seen_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_seen_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscription_discrepancies', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'subscription discrepancies',
+                'ordering': ['-last_seen_at'],
+                'indexes': [models.Index(fields=['status', 'kind', '-last_seen_at'], name='discrepancy_status_kind_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='subscriptiondiscrepancy',
+            constraint=models.UniqueConstraint(fields=('user', 'kind', 'key'), name='unique_subscription_discrepancy'),
+        ),
+    ]
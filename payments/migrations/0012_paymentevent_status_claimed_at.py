@@ -0,0 +1,32 @@
+# Generated by Django 4.2.16 on 2026-10-16 23:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0011_payment_user_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentevent',
+            name='claimed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        # Rows written before claims had a status were only kept for
+        # activations that succeeded
+        migrations.AddField(
+            model_name='paymentevent',
+            name='status',
+            field=models.CharField(choices=[('claimed', 'Claimed - side effect in progress'), ('completed', 'Completed')], default='completed', max_length=10),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='paymentevent',
+            name='status',
+            field=models.CharField(choices=[('claimed', 'Claimed - side effect in progress'), ('completed', 'Completed')], default='claimed', max_length=10),
+        ),
+    ]
@@ -1,9 +1,11 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
 from decimal import Decimal
 from django.utils import timezone
 from datetime import timedelta
 
+from .signals import plan_purchases_expired
+
 
 class Subscription(models.Model):
     """Track user subscriptions for gpscontrol4u premium features"""
@@ -106,8 +108,12 @@ class Payment(models.Model):
     status = models.CharField(max_length=15, choices=STATUS_CHOICES, default='pending')
     
     # Provider-specific IDs
-    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True)
-    mercado_pago_payment_id = models.CharField(max_length=255, blank=True, null=True)
+    stripe_payment_intent_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    mercado_pago_payment_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    
+    # Decoded checkout reference (see payment_reference.py)
+    external_reference = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    external_plan_id = models.CharField(max_length=255, blank=True, null=True, help_text="ID from external API plan system")
     
     # Metadata
     description = models.TextField(blank=True)
@@ -118,9 +124,22 @@ class Payment(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Payment history of a user, newest first (page numbers and keyset cursor)
+            models.Index(fields=['user', '-created_at'], name='payment_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.email} - {self.amount} {self.currency} ({self.status})"
+    
+    @classmethod
+    def pending_for_reference(cls, external_reference):
+        """The checkout opened with this reference, with its user, or None"""
+        if not external_reference:
+            return None
+        return cls.objects.select_related('user').filter(
+            external_reference=external_reference, status='pending'
+        ).first()
 
 
 class PricingPlan(models.Model):
@@ -217,6 +236,14 @@ class PlanPurchase(models.Model):
                 name='unique_free_plan_per_user'
             )
         ]
+        indexes = [
+            # Expiry sweep: WHERE status='active' AND expiration_date < now
+            models.Index(fields=['status', 'expiration_date'], name='purchase_status_expiry_idx'),
+            # Active purchases / purchase history of a user, newest first
+            models.Index(fields=['user', 'status', '-purchase_date'], name='purchase_user_status_date_idx'),
+            # Free plan check (the partial unique constraint is not enforced on MySQL)
+            models.Index(fields=['user', 'plan_category'], name='purchase_user_category_idx'),
+        ]
     
     @property
     def admin_users_quantity(self):
@@ -237,18 +264,11 @@ class PlanPurchase(models.Model):
         return f"{self.user.email} - {self.plan_name} ({self.status})"
     
     def is_active(self):
-        """Check if the purchase is currently active"""
-        if self.status != 'active':
-            return False
-        
-        # Check expiration for non-free plans
-        if self.expiration_date and timezone.now() > self.expiration_date:
-            # Auto-expire if past expiration date
-            self.status = 'expired'
-            self.save(update_fields=['status', 'updated_at'])
-            return False
-        
-        return True
+        """
+        Check if the purchase is currently active
+        Read only: overdue purchases are marked expired by expire_overdue()
+        """
+        return self.status == 'active' and not self.is_expired()
     
     def is_expired(self):
         """Check if the purchase has expired"""
@@ -284,10 +304,15 @@ class PlanPurchase(models.Model):
         self.status = 'cancelled'
         self.save(update_fields=['status', 'updated_at'])
     
+    @classmethod
+    def unexpired_q(cls, now=None):
+        """Filter for purchases whose expiration date has not passed yet"""
+        return models.Q(expiration_date__isnull=True) | models.Q(expiration_date__gte=now or timezone.now())
+    
     @classmethod
     def get_user_active_purchases(cls, user):
-        """Get all active purchases for a user"""
-        return cls.objects.filter(user=user, status='active').order_by('-purchase_date')
+        """Get all active purchases for a user (overdue ones count as expired even before the sweep)"""
+        return cls.objects.filter(cls.unexpired_q(), user=user, status='active').order_by('-purchase_date')
     
     @classmethod
     def get_user_purchase_history(cls, user):
@@ -304,3 +329,293 @@ class PlanPurchase(models.Model):
         """Get list of active external plan IDs for a user"""
         active_purchases = cls.get_user_active_purchases(user)
         return [purchase.external_plan_id for purchase in active_purchases]
+    
+    @classmethod
+    def expire_overdue(cls, batch_size=500, now=None, max_batches=None):
+        """
+        Mark active purchases past their expiration date as expired
+        
+        Works in batches, each one an indexed UPDATE committed on its own, so
+        an interrupted run simply continues where it stopped on the next run.
+        Subscriptions of users left without an active purchase are set
+        inactive with the end date of their last purchase.
+        Returns the number of purchases expired.
+        """
+        now = now or timezone.now()
+        total = 0
+        batches = 0
+        
+        while max_batches is None or batches < max_batches:
+            with transaction.atomic():
+                batch = list(
+                    cls.objects.filter(status='active', expiration_date__lt=now)
+                    .order_by('expiration_date', 'pk')
+                    .values_list('pk', 'user_id')[:batch_size]
+                )
+                if not batch:
+                    break
+                
+                purchase_ids = [pk for pk, _ in batch]
+                user_ids = {user_id for _, user_id in batch}
+                total += cls.objects.filter(pk__in=purchase_ids, status='active').update(
+                    status='expired', updated_at=now
+                )
+                
+                # Users who still hold another valid purchase keep their subscription
+                still_active = set(
+                    cls.objects.filter(cls.unexpired_q(now), user_id__in=user_ids, status='active')
+                    .values_list('user_id', flat=True)
+                )
+                last_expiration = cls.objects.filter(
+                    user=models.OuterRef('user'), expiration_date__isnull=False
+                ).order_by('-expiration_date').values('expiration_date')[:1]
+                Subscription.objects.filter(
+                    user_id__in=user_ids - still_active, status='active'
+                ).update(
+                    status='inactive',
+                    end_date=models.Subquery(last_expiration),
+                    updated_at=now,
+                )
+            plan_purchases_expired.send(sender=cls, user_ids=user_ids)
+            batches += 1
+        
+        return total
+
+
+class WebhookEvent(models.Model):
+    """Payment provider notification persisted by the webhook and processed by a background worker"""
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('processed', 'Processed'),
+        ('waiting', 'Waiting for payment approval'),
+        ('failed', 'Failed - requires manual review'),
+    ]
+    
+    # Statuses a repeated notification for the same payment may re-open
+    REOPENABLE_STATUSES = ['waiting', 'failed']
+    
+    provider = models.CharField(max_length=20, choices=Payment.PROVIDER_CHOICES)
+    event_type = models.CharField(max_length=50, default='payment')
+    payment_id = models.CharField(max_length=255, help_text="Provider payment ID from the notification")
+    payload = models.JSONField(default=dict, blank=True, help_text="Raw notification body")
+    
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    result = models.CharField(max_length=100, blank=True, help_text="Outcome of the last processing run")
+    last_error = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['provider', 'payment_id'],
+                name='unique_webhook_event_per_payment'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='webhook_status_updated_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_provider_display()} payment {self.payment_id} ({self.status})"
+
+    @classmethod
+    def claim(cls, provider, payment_id, event_type, payload):
+        """Insert a new pending event, or return None if one already exists"""
+        try:
+            with transaction.atomic():
+                return cls.objects.create(
+                    provider=provider,
+                    payment_id=str(payment_id),
+                    event_type=event_type,
+                    payload=payload,
+                )
+        except IntegrityError:
+            return None
+
+
+class PaymentEvent(models.Model):
+    """
+    Idempotency ledger for payment side effects
+    A row is claimed with a single insert on the unique index; whoever inserts
+    it first performs the side effect and marks it completed, everyone else
+    sees it claimed or completed. A claim still open after
+    PAYMENT_EVENT_CLAIM_LEASE (its holder died mid-way) can be taken over.
+    """
+    
+    EVENT_TYPE_CHOICES = [
+        ('activation', 'Plan activation'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('claimed', 'Claimed - side effect in progress'),
+        ('completed', 'Completed'),
+    ]
+    
+    provider = models.CharField(max_length=20, choices=Payment.PROVIDER_CHOICES)
+    provider_payment_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=30, choices=EVENT_TYPE_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='claimed')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='payment_events')
+    metadata = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['provider', 'provider_payment_id', 'event_type'],
+                name='unique_payment_event'
+            )
+        ]
+    
+    def __str__(self):
+        return f"{self.get_provider_display()} {self.provider_payment_id} - {self.event_type} ({self.status})"
+    
+    @classmethod
+    def _lookup(cls, provider, provider_payment_id, event_type):
+        return cls.objects.filter(
+            provider=provider,
+            provider_payment_id=str(provider_payment_id),
+            event_type=event_type,
+        )
+    
+    @classmethod
+    def claim(cls, provider, provider_payment_id, event_type, user=None, metadata=None):
+        """
+        Claim the side effect; True if this call holds the claim
+        False if it is completed, or claimed by someone else within the lease
+        """
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    provider=provider,
+                    provider_payment_id=str(provider_payment_id),
+                    event_type=event_type,
+                    user=user,
+                    metadata=metadata or {},
+                )
+            return True
+        except IntegrityError:
+            pass
+        
+        # Take over an expired claim; the conditional update lets one caller win
+        now = timezone.now()
+        lease = timedelta(seconds=getattr(settings, 'PAYMENT_EVENT_CLAIM_LEASE', 300))
+        return bool(cls._lookup(provider, provider_payment_id, event_type).filter(
+            status='claimed', claimed_at__lt=now - lease
+        ).update(claimed_at=now, user=user, metadata=metadata or {}))
+    
+    @classmethod
+    def complete(cls, provider, provider_payment_id, event_type):
+        """Mark the side effect done; later claims see it completed"""
+        cls._lookup(provider, provider_payment_id, event_type).update(status='completed')
+    
+    @classmethod
+    def release(cls, provider, provider_payment_id, event_type):
+        """Drop a claim whose side effect failed so it can be attempted again"""
+        cls._lookup(provider, provider_payment_id, event_type).filter(status='claimed').delete()
+    
+    @classmethod
+    def is_completed(cls, provider, provider_payment_id, event_type):
+        return cls._lookup(provider, provider_payment_id, event_type).filter(status='completed').exists()
+
+
+class SubscriptionDiscrepancy(models.Model):
+    """
+    A difference between local plan state and the ElisaSoftware API
+    Written by the reconciliation job (payments/reconciliation.py) and by
+    webhook activations that need manual review. One row per user, kind and
+    key: a discrepancy seen again is refreshed, one no longer seen is resolved.
+    """
+    
+    KIND_CHOICES = [
+        ('client_missing_remote', 'Registered locally, client not found remotely'),
+        ('client_id_mismatch', 'Client ID differs'),
+        ('licenses_mismatch', 'License count differs'),
+        ('plan_missing_remote', 'Active local plan without a remote subscription'),
+        ('plan_missing_local', 'Remote subscription without an active local plan'),
+        ('activation_failed', 'Payment received but activation failed'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('resolved', 'Resolved'),
+    ]
+    
+    # Kinds the reconciliation job resolves on its own when they disappear
+    RECONCILED_KINDS = [kind for kind, _ in KIND_CHOICES if kind != 'activation_failed']
+    
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='subscription_discrepancies')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    key = models.CharField(max_length=255, blank=True, default='',
+                           help_text="Plan ID or payment ID the discrepancy is about, empty for user-level kinds")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+    local_value = models.CharField(max_length=255, blank=True)
+    remote_value = models.CharField(max_length=255, blank=True)
+    details = models.JSONField(default=dict, blank=True)
+    
+    first_seen_at = models.DateTimeField(default=timezone.now)
+    last_seen_at = models.DateTimeField(default=timezone.now)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-last_seen_at']
+        verbose_name_plural = 'subscription discrepancies'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'kind', 'key'],
+                name='unique_subscription_discrepancy'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['status', 'kind', '-last_seen_at'], name='discrepancy_status_kind_idx'),
+        ]
+    
+    def __str__(self):
+        key = f" {self.key}" if self.key else ''
+        return f"{self.user.email} - {self.kind}{key} ({self.status})"
+    
+    @classmethod
+    def record(cls, user, kind, key='', local_value='', remote_value='', details=None, now=None):
+        """Open the discrepancy, or refresh it (re-opening it if it was resolved)"""
+        now = now or timezone.now()
+        discrepancy, _ = cls.objects.update_or_create(
+            user=user,
+            kind=kind,
+            key=str(key),
+            defaults={
+                'status': 'open',
+                'local_value': str(local_value)[:255],
+                'remote_value': str(remote_value)[:255],
+                'details': details or {},
+                'last_seen_at': now,
+                'resolved_at': None,
+            },
+        )
+        return discrepancy
+
+
+class ReconciliationCursor(models.Model):
+    """
+    Position of an incremental job that walks the user table in pk order
+    Each run continues after `position`; when it reaches the end the pass is
+    complete and the next run starts over from the first user.
+    """
+    
+    name = models.CharField(max_length=50, unique=True)
+    position = models.BigIntegerField(default=0, help_text="Last user pk processed in the current pass")
+    pass_started_at = models.DateTimeField(null=True, blank=True)
+    last_pass_completed_at = models.DateTimeField(null=True, blank=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    last_run_stats = models.JSONField(default=dict, blank=True)
+    
+    def __str__(self):
+        return f"{self.name} at user {self.position}"
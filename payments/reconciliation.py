@@ -0,0 +1,258 @@
+"""
+Reconciliation between local plan state and the ElisaSoftware API
+
+Users registered with the external API are walked in pk order in batches.
+For each batch the remote subscriptions (/store/client/subscription) and
+client licenses (/store/client/licenses) are fetched concurrently, through
+the shared token and circuit breakers, at a bounded rate. They are then
+compared with the user's active PlanPurchase rows, external_client_id and
+external_licenses. Differences are written to SubscriptionDiscrepancy.
+
+Progress is kept in a ReconciliationCursor committed after every batch, so
+a nightly run with a user budget covers the whole user base over a few
+nights and an interrupted run continues where it stopped.
+"""
+
+import asyncio
+import logging
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from circuit_breaker import UpstreamUnavailable
+from external_api_auth import token_manager
+from http_client import AsyncRateLimiter, close_async_client
+from accounts.models import User
+from .models import PlanPurchase, ReconciliationCursor, SubscriptionDiscrepancy
+
+logger = logging.getLogger(__name__)
+
+# Remote subscription statuses counted as active (entries without a status
+# are active too: the endpoint lists current subscriptions)
+REMOTE_ACTIVE_STATUSES = {'active', 'activa', 'activo', 'vigente', '1', 'true'}
+
+
+class UnexpectedRemoteResponse(Exception):
+    """api2ego answered with something that is neither a result nor 'not found'"""
+
+
+class SubscriptionReconciler:
+    """Compare local plan state with the ElisaSoftware API, one cursor batch at a time"""
+
+    CURSOR_NAME = 'subscriptions'
+
+    def __init__(self, concurrency=None, rate=None, batch_size=None, dry_run=False):
+        self.concurrency = concurrency or getattr(settings, 'RECONCILIATION_CONCURRENCY', 4)
+        self.rate = rate if rate is not None else getattr(settings, 'RECONCILIATION_RATE', 5)
+        self.batch_size = batch_size or getattr(settings, 'RECONCILIATION_BATCH_SIZE', 100)
+        self.dry_run = dry_run
+        self.base_url = settings.EXTERNAL_API_BASE_URL
+        self.store = settings.EXTERNAL_API_STORE
+        self.stats = Counter()
+
+    def run(self, max_users=None, restart=False):
+        """Reconcile up to max_users users after the cursor; returns the run stats"""
+        return asyncio.run(self.arun(max_users=max_users, restart=restart))
+
+    async def arun(self, max_users=None, restart=False):
+        self._limiter = AsyncRateLimiter(self.rate)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        cursor = await sync_to_async(self._load_cursor)(restart)
+        logger.info(f"🔄 [RECONCILE] Starting after user {cursor.position} (budget: {max_users or 'all'} users)")
+
+        try:
+            while max_users is None or self.stats['users'] < max_users:
+                size = self.batch_size if max_users is None else min(self.batch_size, max_users - self.stats['users'])
+                users, local_plans = await sync_to_async(self._next_batch)(cursor.position, size)
+                if not users:
+                    cursor.position = 0
+                    cursor.pass_started_at = None
+                    cursor.last_pass_completed_at = timezone.now()
+                    logger.info(f"🔄 [RECONCILE] Pass over all users completed")
+                    break
+
+                results = await asyncio.gather(*(self._fetch_remote(user) for user in users), return_exceptions=True)
+                unavailable = next((r for r in results if isinstance(r, UpstreamUnavailable)), None)
+                if unavailable:
+                    # The cursor stays before this batch: it is retried on the next run
+                    self.stats['aborted'] += 1
+                    logger.warning(f"🔄 [RECONCILE] API unavailable, stopping at user {cursor.position}: {unavailable}")
+                    break
+
+                await sync_to_async(self._apply)(cursor, users, local_plans, results)
+        finally:
+            await close_async_client()
+
+        if not self.dry_run:
+            cursor.last_run_at = timezone.now()
+            cursor.last_run_stats = dict(self.stats)
+            await sync_to_async(cursor.save)()
+        logger.info(f"🔄 [RECONCILE] Finished at user {cursor.position}: {dict(self.stats)}")
+        return self.stats
+
+    def _load_cursor(self, restart):
+        cursor, _ = ReconciliationCursor.objects.get_or_create(name=self.CURSOR_NAME)
+        if restart:
+            cursor.position = 0
+            cursor.pass_started_at = None
+        if cursor.pass_started_at is None:
+            cursor.pass_started_at = timezone.now()
+        return cursor
+
+    def _next_batch(self, position, size):
+        """Registered users after `position` with their active local plan IDs"""
+        users = list(
+            User.objects.filter(pk__gt=position, external_api_registered=True)
+            .exclude(rfc_tin__isnull=True).exclude(rfc_tin='')
+            .order_by('pk')
+            .only('pk', 'email', 'rfc_tin', 'external_client_id', 'external_licenses')[:size]
+        )
+        local_plans = {user.pk: set() for user in users}
+        for user_id, plan_id in (
+            PlanPurchase.objects.filter(PlanPurchase.unexpired_q(), user_id__in=local_plans, status='active')
+            .values_list('user_id', 'external_plan_id')
+        ):
+            local_plans[user_id].add(str(plan_id))
+        return users, local_plans
+
+    async def _get(self, path, rfc):
+        await self._limiter.wait()
+        return await token_manager.arequest(
+            'GET',
+            f"{self.base_url}{path}",
+            params={'rfc': rfc, 'store': self.store},
+            headers={'accept': 'application/json'},
+            timeout=15,
+        )
+
+    async def _fetch_remote(self, user):
+        """
+        Remote state of one user:
+        {'found', 'client_id', 'licenses', 'plan_ids', 'subscriptions'}
+        where plan_ids is None when the subscription list was not available
+        """
+        async with self._semaphore:
+            subscriptions_response, licenses_response = await asyncio.gather(
+                self._get('/store/client/subscription', user.rfc_tin),
+                self._get('/store/client/licenses', user.rfc_tin),
+            )
+        subscriptions = self._parse(subscriptions_response)
+        client = self._parse(licenses_response)
+
+        remote = {
+            'found': subscriptions is not None or bool(client),
+            'client_id': None,
+            'licenses': None,
+            'plan_ids': None,
+            'subscriptions': subscriptions if isinstance(subscriptions, list) else [],
+        }
+        if isinstance(client, dict):
+            remote['client_id'] = client.get('client_id')
+            remote['licenses'] = client.get('total_licencias')
+        if isinstance(subscriptions, list):
+            remote['plan_ids'] = {
+                str(subscription.get('plan_id')) for subscription in subscriptions
+                if isinstance(subscription, dict) and subscription.get('plan_id') is not None
+                and str(subscription.get('status', 'active')).lower() in REMOTE_ACTIVE_STATUSES
+            }
+        return remote
+
+    def _parse(self, response):
+        """`data` of a successful response, None if the RFC is not known remotely"""
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('code') == 200:
+                return data.get('data')
+        elif response.status_code == 503:
+            data = response.json()
+            # 503 "no corresponde..." is api2ego's "client not found"
+            if "no corresponde" in data.get('message', ''):
+                return None
+        raise UnexpectedRemoteResponse(f"{response.request.url.path}: HTTP {response.status_code} {response.text[:200]}")
+
+    def _compare(self, user, remote, local_plan_ids):
+        """Discrepancies of one user as SubscriptionDiscrepancy.record() kwargs"""
+        if not remote['found']:
+            return [{
+                'kind': 'client_missing_remote',
+                'local_value': user.external_client_id or '',
+                'details': {'rfc': user.rfc_tin},
+            }]
+
+        found = []
+        if (remote['client_id'] is not None and user.external_client_id is not None
+                and str(remote['client_id']) != str(user.external_client_id)):
+            found.append({
+                'kind': 'client_id_mismatch',
+                'local_value': user.external_client_id,
+                'remote_value': remote['client_id'],
+            })
+        if remote['licenses'] is not None and str(remote['licenses']) != str(user.external_licenses):
+            found.append({
+                'kind': 'licenses_mismatch',
+                'local_value': user.external_licenses,
+                'remote_value': remote['licenses'],
+            })
+        if remote['plan_ids'] is not None:
+            for plan_id in sorted(local_plan_ids - remote['plan_ids']):
+                found.append({
+                    'kind': 'plan_missing_remote',
+                    'key': plan_id,
+                    'local_value': 'active',
+                    'details': {'remote_plan_ids': sorted(remote['plan_ids'])},
+                })
+            for plan_id in sorted(remote['plan_ids'] - local_plan_ids):
+                found.append({
+                    'kind': 'plan_missing_local',
+                    'key': plan_id,
+                    'remote_value': 'active',
+                    'details': {
+                        'subscriptions': [s for s in remote['subscriptions'] if str(s.get('plan_id')) == plan_id],
+                    },
+                })
+        return found
+
+    def _apply(self, cursor, users, local_plans, results):
+        """Write the batch's discrepancies, resolve the ones gone, and move the cursor past the batch"""
+        now = timezone.now()
+        checked = {}
+        for user, remote in zip(users, results):
+            self.stats['users'] += 1
+            if isinstance(remote, BaseException):
+                self.stats['errors'] += 1
+                logger.error(f"🔄 [RECONCILE] Could not fetch remote state of {user.email}: {remote}")
+                continue
+            found = self._compare(user, remote, local_plans[user.pk])
+            checked[user.pk] = (user, found)
+            self.stats['consistent' if not found else 'inconsistent'] += 1
+            for discrepancy in found:
+                self.stats[discrepancy['kind']] += 1
+
+        if self.dry_run:
+            for user, found in checked.values():
+                for discrepancy in found:
+                    logger.info(f"🔄 [RECONCILE] DRY RUN {user.email}: {discrepancy}")
+            cursor.position = users[-1].pk
+            return
+
+        with transaction.atomic():
+            still_open = {(user.pk, d['kind'], str(d.get('key', ''))) for user, found in checked.values() for d in found}
+            gone = [
+                pk for pk, user_id, kind, key in SubscriptionDiscrepancy.objects.filter(
+                    user_id__in=checked, status='open', kind__in=SubscriptionDiscrepancy.RECONCILED_KINDS
+                ).values_list('pk', 'user_id', 'kind', 'key')
+                if (user_id, kind, key) not in still_open
+            ]
+            if gone:
+                self.stats['resolved'] += SubscriptionDiscrepancy.objects.filter(pk__in=gone).update(
+                    status='resolved', resolved_at=now
+                )
+            for user, found in checked.values():
+                for discrepancy in found:
+                    SubscriptionDiscrepancy.record(user, now=now, **discrepancy)
+
+            cursor.position = users[-1].pk
+            cursor.save(update_fields=['position', 'pass_started_at'])
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by PlanPurchase.expire_overdue() after each batch; bulk UPDATEs do not
+# send post_save. Arguments: user_ids (set of affected user ids)
+plan_purchases_expired = Signal()
@@ -0,0 +1,32 @@
+"""
+Periodic tasks for plan purchases
+"""
+
+import logging
+
+from celery import shared_task
+from django.conf import settings
+
+from .models import PlanPurchase
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def expire_plan_purchases():
+    """Expire overdue plan purchases (scheduled in CELERY_BEAT_SCHEDULE)"""
+    count = PlanPurchase.expire_overdue(batch_size=getattr(settings, 'PLAN_EXPIRY_BATCH_SIZE', 500))
+    if count:
+        logger.info(f"⏰ [PLAN_EXPIRY] Expired {count} plan purchases")
+    return count
+
+
+@shared_task
+def reconcile_subscriptions(max_users=None):
+    """Compare the next users after the reconciliation cursor with the external API (scheduled nightly)"""
+    from .reconciliation import SubscriptionReconciler
+
+    stats = SubscriptionReconciler().run(
+        max_users=max_users or getattr(settings, 'RECONCILIATION_MAX_USERS', 2000)
+    )
+    return dict(stats)
@@ -0,0 +1,240 @@
+"""
+Plan catalogue cache for the external API /store/plans endpoint
+
+Plans are kept in the shared Django cache with a soft and a hard TTL:
+- younger than the soft TTL: served as is
+- between soft and hard TTL: served stale while one background refresh runs
+- missing: one worker fetches, the others wait briefly for its result
+A last-known-good snapshot on disk is used when the API is unreachable.
+
+Each process also keeps the PlanIndex it last read. Within the soft TTL it
+is served without touching the shared cache; after that only the small
+version entry is read, and the pickled index is loaded again only when
+another worker published a different catalogue.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+from locks import SingleFlightLock
+
+logger = logging.getLogger(__name__)
+
+
+def plan_category(plan):
+    """Classify a plan as 'free', 'team' or 'license'"""
+    if float(plan.get('price', 0)) == 0:
+        return 'free'
+    name = plan.get('name', '').lower()
+    if 'team' in name or 'equipo' in name:
+        return 'team'
+    return 'license'
+
+
+class PlanIndex:
+    """
+    Immutable, pre-indexed view of the plan catalogue
+
+    Built once per fetch and cached as is, so lookups by id, by category
+    and in price order never rescan or re-sort the plan list.
+    """
+
+    CATEGORIES = ('free', 'team', 'license')
+
+    def __init__(self, plans):
+        self.plans = list(plans)
+        self.by_id = {str(plan.get('id')): plan for plan in self.plans}
+        self.by_category = {category: [] for category in self.CATEGORIES}
+        for plan in self.plans:
+            self.by_category[plan_category(plan)].append(plan)
+        self.sorted_by_price = sorted(self.plans, key=lambda plan: float(plan.get('price', 0)))
+        self.version = hashlib.sha1(
+            json.dumps(self.plans, sort_keys=True, default=str).encode()
+        ).hexdigest()[:12]
+
+    def __len__(self):
+        return len(self.plans)
+
+    def __iter__(self):
+        return iter(self.plans)
+
+    def get_plan(self, plan_id):
+        """Return the plan with this id (int or str), or None"""
+        return self.by_id.get(str(plan_id))
+
+    def plans_in_category(self, category):
+        return self.by_category.get(category, [])
+
+    def plans_sorted_by_price(self):
+        """Plans ordered by price, free first"""
+        return self.sorted_by_price
+
+    def free_plan(self):
+        free_plans = self.by_category['free']
+        return free_plans[0] if free_plans else None
+
+
+class PlanCatalogueCache:
+    """Stale-while-revalidate cache with a stampede lock and disk fallback"""
+
+    CACHE_KEY = 'external_api_plans'
+    VERSION_KEY = 'external_api_plans_version'
+    LOCK_KEY = 'external_api_plans_lock'
+    LOCK_TIMEOUT = 30  # seconds, longer than the /store/plans timeout
+    WAIT_FOR_FILL = 5  # seconds a worker waits for another worker's fetch
+
+    def __init__(self):
+        self.stats = Counter()
+        self._refresh_lock = SingleFlightLock(self.LOCK_KEY, self.LOCK_TIMEOUT)
+        self._local = None  # {'index', 'fetched_at'} last read by this process
+
+    @property
+    def soft_ttl(self):
+        return getattr(settings, 'PLAN_CACHE_SOFT_TTL', 5 * 60)
+
+    @property
+    def hard_ttl(self):
+        return getattr(settings, 'PLAN_CACHE_HARD_TTL', 60 * 60)
+
+    @property
+    def snapshot_path(self):
+        return getattr(settings, 'PLAN_CACHE_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'plans_snapshot.json'))
+
+    def _local_is_fresh(self):
+        local = self._local
+        return local is not None and time.time() - local['fetched_at'] < self.soft_ttl
+
+    def _local_entry(self, head):
+        """This process's index, if the shared cache still holds the same version (`head`)"""
+        local = self._local
+        if head and local is not None and local['index'].version == head['version']:
+            return self._adopt({'index': local['index'], 'fetched_at': head['fetched_at']})
+        return None
+
+    def _adopt(self, entry):
+        """Keep a shared cache entry as this process's copy"""
+        if entry:
+            self._local = entry
+        return entry
+
+    def _publish(self, index, timeout):
+        entry = {'index': index, 'fetched_at': time.time()}
+        cache.set_many({
+            self.CACHE_KEY: entry,
+            self.VERSION_KEY: {'version': index.version, 'fetched_at': entry['fetched_at']},
+        }, timeout)
+        self._local = entry
+
+    def get(self, fetch):
+        """
+        Return the PlanIndex, calling `fetch()` (which returns a plan list or
+        None) only when the cache needs filling. Returns None if no data is
+        available.
+        """
+        if self._local_is_fresh():
+            self.stats['hit'] += 1
+            return self._local['index']
+
+        entry = self._local_entry(cache.get(self.VERSION_KEY)) or self._adopt(cache.get(self.CACHE_KEY))
+        if entry:
+            age = time.time() - entry['fetched_at']
+            if age < self.soft_ttl:
+                self.stats['hit'] += 1
+                return entry['index']
+
+            self.stats['stale'] += 1
+            self._refresh_in_background(fetch)
+            return entry['index']
+
+        self.stats['miss'] += 1
+        if self._refresh_lock.acquire():
+            try:
+                index = self._refresh(fetch)
+            finally:
+                self._refresh_lock.release()
+            if index is not None:
+                return index
+        else:
+            # Another worker is fetching; wait for it instead of stampeding
+            deadline = time.time() + self.WAIT_FOR_FILL
+            while time.time() < deadline:
+                time.sleep(0.1)
+                entry = self._adopt(cache.get(self.CACHE_KEY))
+                if entry:
+                    return entry['index']
+                if not self._refresh_lock.locked():
+                    break  # the fetch failed; fall back to the snapshot now
+
+        return self._load_snapshot()
+
+    def _refresh(self, fetch):
+        """Fetch, publish to the cache and the disk snapshot"""
+        plans = fetch()
+        if plans is None:
+            return None
+        return self.store(plans)
+
+    def _refresh_in_background(self, fetch):
+        if not self._refresh_lock.acquire():
+            return  # a refresh is already running somewhere
+
+        def run():
+            try:
+                self._refresh(fetch)
+            except Exception as e:
+                logger.error(f"Background plan refresh failed: {e}")
+            finally:
+                self._refresh_lock.release()
+
+        threading.Thread(target=run, name='plan-catalogue-refresh', daemon=True).start()
+
+    def store(self, plans):
+        """Index and publish a freshly fetched plan list"""
+        index = PlanIndex(plans)
+        self._publish(index, self.hard_ttl)
+        self._save_snapshot(plans)
+        return index
+
+    def invalidate(self):
+        """Drop the shared entry; other processes notice within the soft TTL"""
+        cache.delete_many([self.CACHE_KEY, self.VERSION_KEY])
+        self._local = None
+
+    def _save_snapshot(self, plans):
+        path = self.snapshot_path
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write atomically so a reader never sees a half-written file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'plans': plans, 'saved_at': time.time()}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write plan snapshot {path}: {e}")
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                plans = json.load(f)['plans']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        logger.warning("External API unavailable, serving last-known-good plan snapshot")
+        self.stats['snapshot'] += 1
+        # Serve it from the cache for a soft TTL so we do not hammer a down API
+        index = PlanIndex(plans)
+        self._publish(index, self.soft_ttl)
+        return index
+
+
+# Global instance
+plan_catalogue = PlanCatalogueCache()
@@ -9,10 +9,13 @@ import logging
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
+from http_client import get_session
+from instrumentation import traced_service
 
 logger = logging.getLogger(__name__)
 
 
+@traced_service('WhatsAppPhoneVerificationService')
 class WhatsAppPhoneVerificationService:
     """Service to handle WhatsApp phone verification"""
     
@@ -79,7 +82,7 @@ class WhatsAppPhoneVerificationService:
             logger.info(f"📱 [WHATSAPP_SEND] URL: POST {url}")
             logger.info(f"📱 [WHATSAPP_SEND] Params: {json.dumps(params, indent=2)}")
             
-            response = requests.post(
+            response = get_session().post(
                 url,
                 params=params,
                 headers=headers,
@@ -148,7 +151,7 @@ class WhatsAppPhoneVerificationService:
             logger.info(f"📱 [WHATSAPP_VERIFY] URL: GET {url}")
             logger.info(f"📱 [WHATSAPP_VERIFY] Params: {json.dumps(params, indent=2)}")
             
-            response = requests.get(
+            response = get_session().get(
                 url,
                 params=params,
                 headers=headers,